@@ -0,0 +1,250 @@
+# Timed benchmarks over a synthetic tree, with JSON baselines.
+#
+#   python -m benchmarks.suite [--output baseline.json] [tree parameters...]
+#   python -m benchmarks.suite --compare baseline.json [--threshold 0.2]
+#
+# Each benchmark is run --repeat times and the fastest time is kept. When comparing,
+# the tree is generated with the baseline's parameters, and any benchmark more than
+# threshold (as a fraction) slower than the baseline is reported as a regression -
+# the exit status is then non-zero.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tagsets
+import tagsets.cli
+import tagsets.config
+import tagsets.filefinder
+import tagsets.filegrepper
+import tagsets.matcherindex
+import tagsets.query
+import tagsets.snapshot
+import tagsets.tagsearch
+from tagsets.tagset import TagSet
+
+from benchmarks import synthetic
+
+class _FileCollector(tagsets.filefinder.FileMatchVisitor):
+    def __init__(self):
+        self.files = []
+
+    def visit_file(self, path, matchers):
+        self.files.append( (path, matchers) )
+
+class _MatchCounter(tagsets.filegrepper.TextMatchVisitor):
+    def __init__(self):
+        self.matches = 0
+
+    def visit_match(self, captured_text, filename, linenumber, matcher):
+        self.matches += 1
+
+class Workload:
+    # The generated tree and config, and what's needed to benchmark the parts
+    def __init__(self, directory, params):
+        self.root = os.path.join(directory, "tree")
+        self.config_file = os.path.join(directory, "config.yaml")
+        self.snapshot_file = os.path.join(directory, "snapshot")
+        self.config_cache = os.path.join(directory, "config-cache")
+        synthetic.generate_tree(self.root, params)
+        synthetic.generate_config(self.config_file, self.root)
+
+        self.config = tagsets.config.Config.fromfile(self.config_file)
+        self.matchers = self.config.build_matchers()
+        collector = _FileCollector()
+        tagsets.filefinder.search_paths(collector, self.matchers)
+        self.files = collector.files
+        self.filenames = []
+        for dirpath, _, filenames in os.walk(self.root):
+            self.filenames += filenames
+
+        self.defs, self.refs, self.todos = self.search().tagsets
+        tagsets.snapshot.save(self.snapshot_file, [self.defs, self.refs, self.todos])
+
+    def search(self):
+        return tagsets.tagsearch.search_tagsets(self.config)
+
+def bench_walk(workload, engine):
+    def run():
+        tagsets.filefinder.search_paths(_FileCollector(), workload.matchers, engine)
+    return run
+
+def bench_classify(workload):
+    index = tagsets.matcherindex.MatcherIndex(workload.matchers)
+    def run():
+        classify = index.classify
+        for name in workload.filenames:
+            classify(name)
+    return run
+
+def bench_grep(workload, whole_file):
+    def run():
+        counter = _MatchCounter()
+        for path, filematchers in workload.files:
+            textmatchers = []
+            for fm in filematchers:
+                if fm.textmatcher not in textmatchers:
+                    textmatchers.append(fm.textmatcher)
+            tagsets.filegrepper.grep_file(path, textmatchers, counter, whole_file)
+    return run
+
+def _copy(tagset):
+    # A fresh set, so that no evaluated results are reused between runs
+    copied = TagSet(tagset.name, tagset.singular, tagset.plural)
+    for tag in tagset.tags:
+        copied.add_tag(tag)
+    return copied
+
+def bench_set_algebra(workload):
+    def run():
+        defs, refs, todos = _copy(workload.defs), _copy(workload.refs), _copy(workload.todos)
+        (refs - defs).count()
+        (defs - refs).count()
+        (defs & refs & todos).count()
+        (defs | refs).count()
+        (defs ^ refs).count()
+        defs.contains_no_duplicates()
+    return run
+
+SCRIPT = '''
+undefined = refs - defs
+unused = defs - refs
+require "every reference is defined": empty(undefined)
+require "most definitions are used": count(unused) <= count(defs) / 2
+require "definitions are unique": unique(defs)
+require "nothing is both done and to do": empty(defs & refs & todos)
+print "Undefined:", count(refs - defs), "unused:", count(defs - refs), "all:", count(defs | refs), count(defs ^ refs)
+'''
+
+def bench_script(workload):
+    plan = tagsets.query.compile_script(SCRIPT, ["defs", "refs", "todos"])
+    def run():
+        tsmap = { "defs": _copy(workload.defs), "refs": _copy(workload.refs), "todos": _copy(workload.todos) }
+        plan.run(tsmap, io.StringIO())
+    return run
+
+def bench_snapshot_load(workload):
+    def run():
+        tagsets.snapshot.load(workload.snapshot_file)
+    return run
+
+def bench_cli(workload):
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            tagsets.cli.main(['-c', workload.config_file, '--list-tags'])
+    return run
+
+def bench_startup(workload, *argv):
+    # A fresh interpreter running the command line, as the tagsets script does
+    env = dict(os.environ)
+    env['TAGSETS_CACHE_DIR'] = workload.config_cache
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(tagsets.__file__)))] +
+                                        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    command = [sys.executable, '-c', "import sys, tagsets.cli; tagsets.cli.main(sys.argv[1:])"] + list(argv)
+    def run():
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    return run
+
+def benchmarks(workload):
+    return [
+        ("walk.walk", bench_walk(workload, 'walk')),
+        ("walk.scandir", bench_walk(workload, 'scandir')),
+        ("walk.threaded", bench_walk(workload, 'threaded')),
+        ("classify", bench_classify(workload)),
+        ("grep.lines", bench_grep(workload, False)),
+        ("grep.whole_file", bench_grep(workload, True)),
+        ("set_algebra", bench_set_algebra(workload)),
+        ("script", bench_script(workload)),
+        ("snapshot.load", bench_snapshot_load(workload)),
+        ("cli.main", bench_cli(workload)),
+        ("startup.help", bench_startup(workload, '--help')),
+        ("startup.cached_config", bench_startup(workload, '-c', workload.config_file, '--list-tags')),
+        ("startup.uncached_config", bench_startup(workload, '-c', workload.config_file, '--no-config-cache', '--list-tags')),
+    ]
+
+def timed(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run_benchmarks(params, repeat, selected = None):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="tagsets-bench-") as directory:
+        workload = Workload(directory, params)
+        for name, run in benchmarks(workload):
+            if selected and not any(name.startswith(s) for s in selected):
+                continue
+            results[name] = timed(run, repeat)
+    return results
+
+# Returns (name, baseline, current, ratio) for each benchmark in both runs, and the
+# names of those slower than the baseline by more than threshold
+def compare(baseline, results, threshold):
+    rows = []
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / max(baseline[name], 1e-9)
+        rows.append( (name, baseline[name], results[name], ratio) )
+        if ratio > 1.0 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Tagsets benchmark suite")
+    synthetic.add_parameter_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each benchmark, the fastest of which is kept (default: %(default)s)")
+    parser.add_argument('--only', metavar='NAME', nargs='+',
+                        help="only run the benchmarks whose names start with one of these")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="save the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the results with a JSON baseline, using the baseline's tree parameters")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="slowdown, as a fraction of the baseline, reported as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    params = synthetic.parameters_from_args(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        params = synthetic.TreeParameters(**baseline['parameters'])
+
+    results = run_benchmarks(params, args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'parameters': params.as_dict(), 'results': results }, f, indent=2, sort_keys=True)
+
+    if baseline is None:
+        print("%-24s %12s" % ("benchmark", "time (s)"))
+        for name, seconds in results.items():
+            print("%-24s %12.4f" % (name, seconds))
+        return 0
+
+    rows, regressions = compare(baseline['results'], results, args.threshold)
+    print("%-24s %12s %12s %8s" % ("benchmark", "baseline (s)", "current (s)", "ratio"))
+    for name, before, after, ratio in rows:
+        print("%-24s %12.4f %12.4f %7.2fx%s" % (name, before, after, ratio,
+                                                "  REGRESSION" if name in regressions else ""))
+    if regressions:
+        print("%i regression(s) above %.0f%%: %s" % (len(regressions), 100 * args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
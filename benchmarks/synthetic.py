@@ -0,0 +1,176 @@
+# Deterministic generator for synthetic source trees and matching tag configs.
+#
+# The same parameters and seed always produce the same tree, so that benchmark runs
+# on different checkouts search identical inputs.
+#
+#   python -m benchmarks.synthetic DIRECTORY [--depth 3] [--fanout 4] [--files 10] ...
+
+import argparse
+import os
+import random
+
+FILLER = [
+    "static int counter = 0;",
+    "for (i = 0; i < count; i++) {",
+    "    result += values[i] * scale;",
+    "}",
+    "/* Nothing to see here */",
+    "return status;",
+    "if (buffer == NULL) goto error;",
+    "#include <stdio.h>",
+]
+
+EXTENSIONS = [".c", ".h", ".txt", ".o"]
+
+class TreeParameters:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "%r" % self.as_dict()
+
+    # depth       - levels of subdirectories below the root
+    # fanout      - subdirectories in each directory above the deepest level
+    # files       - files in each directory
+    # file_size   - approximate size of each file, in bytes
+    # tag_density - probability of each line holding a tag
+    # tags        - number of distinct tag strings
+    def __init__(self, depth = 3, fanout = 4, files = 10, file_size = 4096,
+                 tag_density = 0.05, tags = 1000, seed = 1):
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.file_size = file_size
+        self.tag_density = tag_density
+        self.tags = tags
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+def _file_lines(rng, params):
+    size = 0
+    while size < params.file_size:
+        if rng.random() < params.tag_density:
+            n = rng.randrange(params.tags)
+            kind = rng.random()
+            if kind < 0.4:
+                line = "/* def[TAG_%i] */" % n
+            elif kind < 0.9:
+                line = "do_something(); /* ref[TAG_%i] */" % n
+            else:
+                line = "/* TODO: tidy up TAG_%i */" % n
+        else:
+            line = rng.choice(FILLER)
+        size += len(line) + 1
+        yield line
+
+def generate_tree(root, params):
+    # Returns the number of files written
+    rng = random.Random(params.seed)
+    written = 0
+    pending = [ (root, 0) ]
+    while pending:
+        path, level = pending.pop(0)
+        os.makedirs(path, exist_ok=True)
+        for i in range(params.files):
+            filename = os.path.join(path, "file%i%s" % (i, EXTENSIONS[i % len(EXTENSIONS)]))
+            with open(filename, 'w') as f:
+                f.write("\n".join(_file_lines(rng, params)))
+                f.write("\n")
+            written += 1
+        if level < params.depth:
+            for i in range(params.fanout):
+                pending.append( (os.path.join(path, "dir%i" % i), level + 1) )
+        # An ignored directory in each directory, as version control would leave
+        if level == 0:
+            os.makedirs(os.path.join(path, ".git"), exist_ok=True)
+    return written
+
+CONFIG = """basepath: "%(root)s"
+
+ignoredirs:
+  - ".git"
+
+tagsets:
+
+  - defs:
+      singular: "definition"
+      plural: "definitions"
+      regex: 'def\\[(TAG_\\d+)\\]'
+      search:
+        - glob:
+            paths:
+              - "."
+            files:
+              - "*.c"
+              - "*.h"
+
+  - refs:
+      singular: "reference"
+      plural: "references"
+      regex: 'ref\\[(TAG_\\d+)\\]'
+      search:
+        - glob:
+            paths:
+              - "."
+            files:
+              - "*.c"
+              - "*.txt"
+            ignore:
+              - "*.o"
+
+  - todos:
+      singular: "todo"
+      plural: "todos"
+      regex: 'TODO: (.*\\S)'
+      search:
+        - glob:
+            paths:
+              - "."
+            files:
+              - "*"
+"""
+
+def generate_config(filename, root):
+    with open(filename, 'w') as f:
+        f.write(CONFIG % { 'root': os.path.abspath(root) })
+
+def add_parameter_arguments(parser):
+    defaults = TreeParameters()
+    parser.add_argument('--depth', type=int, default=defaults.depth,
+                        help="levels of subdirectories (default: %(default)s)")
+    parser.add_argument('--fanout', type=int, default=defaults.fanout,
+                        help="subdirectories per directory (default: %(default)s)")
+    parser.add_argument('--files', type=int, default=defaults.files,
+                        help="files per directory (default: %(default)s)")
+    parser.add_argument('--file-size', type=int, default=defaults.file_size,
+                        help="approximate bytes per file (default: %(default)s)")
+    parser.add_argument('--tag-density', type=float, default=defaults.tag_density,
+                        help="probability of a line holding a tag (default: %(default)s)")
+    parser.add_argument('--tags', type=int, default=defaults.tags,
+                        help="number of distinct tags (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=defaults.seed,
+                        help="random seed (default: %(default)s)")
+
+def parameters_from_args(args):
+    return TreeParameters(args.depth, args.fanout, args.files, args.file_size,
+                          args.tag_density, args.tags, args.seed)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic source tree and tag config")
+    parser.add_argument('directory', help="directory to generate the tree in")
+    add_parameter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    params = parameters_from_args(args)
+    written = generate_tree(os.path.join(args.directory, "tree"), params)
+    generate_config(os.path.join(args.directory, "config.yaml"), os.path.join(args.directory, "tree"))
+    print("Generated %i files in %s" % (written, args.directory))
+
+if __name__ == '__main__':
+    main()
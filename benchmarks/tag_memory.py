@@ -0,0 +1,52 @@
+# Memory benchmark for a synthetic scan producing many tags, comparing the compact
+# Tag representation with a plain __dict__ based record holding its own strings.
+#
+#   python -m benchmarks.tag_memory [--tags 1000000] [--files 20000] [--tagstrs 50000]
+
+import argparse
+import gc
+import tracemalloc
+
+import tagsets.tagset
+from tagsets.tagset import Tag
+
+class DictTag():
+    def __init__(self, tagstr, filename, linenumber):
+        self.tagstr = tagstr
+        self.filename = filename
+        self.linenumber = linenumber
+
+def synthetic_scan(tagclass, ntags, nfiles, ntagstrs):
+    # Filenames and captured strings are built afresh for each tag, as they are
+    # when they come from the directory walk and the regex matches
+    tags = []
+    for i in range(ntags):
+        fileno = i % nfiles
+        filename = "/src/dir%i/file%i.c" % (fileno % 97, fileno)
+        tags.append(tagclass("TAG_%i" % (i % ntagstrs), filename, i))
+    return tags
+
+def measure(tagclass, ntags, nfiles, ntagstrs):
+    tagsets.tagset.FILES = tagsets.tagset.FileTable()
+    gc.collect()
+    tracemalloc.start()
+    tags = synthetic_scan(tagclass, ntags, nfiles, ntagstrs)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tags
+    return current, peak
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Tag memory benchmark")
+    parser.add_argument('--tags', type=int, default=1000000, help="number of tags to create")
+    parser.add_argument('--files', type=int, default=20000, help="number of distinct files")
+    parser.add_argument('--tagstrs', type=int, default=50000, help="number of distinct tag strings")
+    args = parser.parse_args(argv)
+
+    print("%-10s %14s %14s" % ("tag class", "retained (MB)", "peak (MB)"))
+    for tagclass in (DictTag, Tag):
+        current, peak = measure(tagclass, args.tags, args.files, args.tagstrs)
+        print("%-10s %14.1f %14.1f" % (tagclass.__name__, current / 1e6, peak / 1e6))
+
+if __name__ == '__main__':
+    main()
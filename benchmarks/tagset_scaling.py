@@ -0,0 +1,80 @@
+# Micro-benchmark comparing the indexed TagSet operations with the linear scans
+# they replaced, over growing numbers of tags.
+#
+#   python -m benchmarks.tagset_scaling [--sizes 500 1000 2000 4000]
+
+import argparse
+import time
+
+from tagsets.tagset import Tag, TagSet
+
+# The previous, linear scan implementations
+
+def linear_contains(tagset, tag):
+    for t in tagset.tags:
+        if t.tagstr == tag.tagstr:
+            return True
+    return False
+
+def linear_intersection(tagset, otherset):
+    return [tag for tag in tagset.tags if linear_contains(otherset, tag)]
+
+def linear_minus(tagset, otherset):
+    return [tag for tag in tagset.tags if not linear_contains(otherset, tag)]
+
+def linear_contains_no_duplicates(tagset):
+    for t1 in tagset.tags:
+        for t2 in tagset.tags:
+            if t1.tagstr == t2.tagstr and t1 != t2:
+                return False
+    return True
+
+# Benchmark
+
+def build_tagsets(size):
+    # Twice as many references as definitions, half of them to defined tags
+    defs = TagSet("defs", "definition", "definitions")
+    refs = TagSet("refs", "reference", "references")
+    for i in range(size):
+        defs.add_tag(Tag("TAG_%i" % i, "defs.txt", i + 1))
+    for i in range(2 * size):
+        refs.add_tag(Tag("TAG_%i" % (i if i % 2 else size + i), "refs.txt", i + 1))
+    return defs, refs
+
+def timed(operation):
+    start = time.perf_counter()
+    operation()
+    return time.perf_counter() - start
+
+OPERATIONS = [
+    ("intersection",
+     lambda defs, refs: linear_intersection(refs, defs),
+     lambda defs, refs: refs.intersection(defs).count()),
+    ("minus",
+     lambda defs, refs: linear_minus(refs, defs),
+     lambda defs, refs: refs.minus(defs).count()),
+    ("no duplicates",
+     lambda defs, refs: linear_contains_no_duplicates(defs),
+     lambda defs, refs: defs.contains_no_duplicates()),
+]
+
+def run(sizes):
+    results = []
+    for size in sizes:
+        defs, refs = build_tagsets(size)
+        for name, linear, indexed in OPERATIONS:
+            results.append( (name, size, timed(lambda: linear(defs, refs)), timed(lambda: indexed(defs, refs))) )
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="TagSet scaling micro-benchmark")
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+', default=[500, 1000, 2000, 4000],
+                        help="numbers of definitions to benchmark with")
+    args = parser.parse_args(argv)
+
+    print("%-14s %8s %12s %12s %9s" % ("operation", "defs", "linear (s)", "indexed (s)", "speedup"))
+    for name, size, linear, indexed in run(args.sizes):
+        print("%-14s %8i %12.4f %12.4f %8.0fx" % (name, size, linear, indexed, linear / max(indexed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
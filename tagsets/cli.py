@@ -1,14 +1,24 @@
 import argparse
 import logging
-import logging.config
 import os
-import yaml
+import sys
 
 import tagsets.config
 import tagsets.filefinder
 import tagsets.filegrepper
+import tagsets.output
+import tagsets.query
+import tagsets.regexprofile
+import tagsets.scancache
+import tagsets.snapshot
+import tagsets.stats
 import tagsets.tagsearch
 import tagsets.script
+import tagsets.watch
+
+# Modules that are slow to import - yaml, pykwalify (through tagsets.config),
+# tagsets.pipeline (asyncio) and tagsets.tagstore (sqlite3) - are only imported
+# when they're used, so that startup stays fast
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +27,10 @@ def create_parser():
 
     parser.add_argument('-c', '--tag-config',
                         metavar='FILE',
-                        required=True,
-                        help="specify which tag configuration file to use")
+                        help="specify which tag configuration file to use - required unless the tag sets are loaded with --load-snapshot")
+    parser.add_argument('--no-config-cache',
+                        action='store_true',
+                        help="always parse and validate the tag configuration file, rather than using the cached copy from an earlier run - the cache is kept in $TAGSETS_CACHE_DIR, or $XDG_CACHE_HOME/tagsets or ~/.cache/tagsets")
 
     parser.add_argument('-v', '--verbose',
                         action='count',
@@ -27,6 +39,89 @@ def create_parser():
                         metavar='FILE',
                         help="Python logging configuaration file - for greater control of log output")
 
+    parser.add_argument('--walker',
+                        choices=sorted(tagsets.filefinder.ENGINES),
+                        default='walk',
+                        help="directory walking engine to use when searching for files - gitindex only searches the files tracked by git, read from the repository's index, and threaded lists directories concurrently, for high-latency filesystems (default: walk)")
+    parser.add_argument('--fanout',
+                        metavar='N',
+                        type=int,
+                        help="with --walker threaded, number of directories listed at once (default: %i)" % tagsets.filefinder.DEFAULT_FANOUT)
+
+    parser.add_argument('-j', '--jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of processes to use for searching files for tags (default: 1)")
+
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        help="walk, read and search files concurrently, in an asynchronous pipeline")
+    parser.add_argument('--readers',
+                        metavar='N',
+                        type=int,
+                        default=4,
+                        help="with --pipeline, number of threads reading files (default: 4)")
+    parser.add_argument('--match-workers',
+                        metavar='N',
+                        type=int,
+                        default=2,
+                        help="with --pipeline, number of threads searching files' contents (default: 2)")
+    parser.add_argument('--queue-size',
+                        metavar='N',
+                        type=int,
+                        default=64,
+                        help="with --pipeline, number of files queued between each stage (default: 64)")
+
+    parser.add_argument('--whole-file',
+                        action='store_true',
+                        help="match regexes against whole files at once rather than line by line - faster on large files, and lets tags span lines")
+
+    parser.add_argument('--cache',
+                        metavar='FILE',
+                        help="persistent scan cache - files that haven't changed since the last run with the same cache aren't searched again")
+
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help="after the initial search, keep the tag sets up to date as files change and repeat the requested action after each change")
+
+    parser.add_argument('--stats',
+                        nargs='?',
+                        const='text',
+                        choices=['text', 'json'],
+                        help="report counts of the directories, files, bytes, lines and tags searched, and the time taken by each phase, on stderr (default format: text)")
+
+    parser.add_argument('--profile-regexes',
+                        metavar='N',
+                        nargs='?',
+                        type=int,
+                        const=10,
+                        help="time each tag set's regex separately, and report the N slowest regexes and files on stderr (default N: 10)")
+
+    parser.add_argument('--regex-budget',
+                        metavar='SECONDS',
+                        type=float,
+                        help="abort with an error naming the tag set if any single application of a regex - to a line, or to a file with --whole-file - takes longer than this")
+
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help="with --list-tags, print each tag as soon as it's found, prefixed with its tag set's name and a tab, rather than waiting until the search has finished")
+
+    parser.add_argument('--group',
+                        action='store_true',
+                        help="with --stream, group the tags by tag set as --list-tags does, holding them in temporary files until the search has finished")
+
+    parser.add_argument('--tag-store',
+                        metavar='FILE',
+                        help="hold the tags found in an SQLite database rather than in memory - for very large numbers of tags, and so that they can be queried afterwards")
+
+    parser.add_argument('--save-snapshot',
+                        metavar='FILE',
+                        help="save the tag sets found to a snapshot file, which --load-snapshot can read back")
+    parser.add_argument('--load-snapshot',
+                        metavar='FILE',
+                        help="load the tag sets from a snapshot file saved by --save-snapshot, rather than searching for them")
+
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--list-tags',
                        action='store_true',
@@ -39,15 +134,21 @@ def create_parser():
                        help="process the tag sets using the specified python script")
     parser.add_argument_group()
 
+    parser.add_argument('--explain',
+                        action='store_true',
+                        help="with --run-script, print the script's query plan on stderr before running it")
+
     return parser
 
 def configure_logging(logger_configuration_file, verbosity):
     # Set logging level
     if logger_configuration_file:
         if os.path.exists(logger_configuration_file):
+            from logging.config import dictConfig
+            import yaml
             with open(logger_configuration_file, 'rt') as f:
                 logconf = yaml.safe_load(f.read())
-                logging.config.dictConfig(logconf)
+                dictConfig(logconf)
         else:
             print("Failure loading logging configuration")
             exit(1)
@@ -63,29 +164,151 @@ def main(argv = None):
     # read command line arguments
     parser=create_parser()
     args=parser.parse_args(argv)
+    if args.tag_config is None and args.load_snapshot is None:
+        parser.error("a tag configuration file (-c) is required unless --load-snapshot is used")
+    if args.load_snapshot is not None and (args.watch or args.stream or args.tag_store):
+        parser.error("--watch, --stream and --tag-store need a search, so can't be used with --load-snapshot")
+    if args.stream and not args.list_tags:
+        parser.error("--stream can only be used with --list-tags")
+    if args.group and not args.stream:
+        parser.error("--group can only be used with --stream")
+    if args.pipeline and args.jobs > 1:
+        parser.error("--pipeline can't be used with --jobs")
+    if args.pipeline and args.regex_budget is not None:
+        # The budget is enforced with SIGALRM, which the pipeline's matching threads can't receive
+        parser.error("--pipeline can't be used with --regex-budget")
+    if args.explain and not args.run_script:
+        parser.error("--explain can only be used with --run-script")
+    if args.fanout is not None and args.walker != 'threaded':
+        parser.error("--fanout can only be used with --walker threaded")
+    if args.fanout is not None and args.fanout < 1:
+        parser.error("--fanout must be at least 1")
 
     configure_logging(args.log_config_file, args.verbose)
     logger.debug("arguments = " + str(args))
 
+    stats = tagsets.stats.Stats() if args.stats else None
+
+    if args.load_snapshot is not None:
+        try:
+            with tagsets.stats.phase(stats, 'snapshot'):
+                tss = tagsets.snapshot.load(args.load_snapshot)
+        except (OSError, tagsets.snapshot.SnapshotError) as e:
+            print("Unable to load snapshot: %s" % e, file=sys.stderr)
+            exit(1)
+        plan = compile_script(args, [ts.name for ts in tss])
+        if args.save_snapshot is not None:
+            tagsets.snapshot.save(args.save_snapshot, tss)
+        with tagsets.stats.phase(stats, 'script'):
+            passed = run_action(args, tss, dict( (ts.name, ts) for ts in tss ), plan)
+        if stats is not None:
+            print(stats.to_json() if args.stats == 'json' else stats.format(), file=sys.stderr)
+        if not passed:
+            exit(1)
+        return
+
     # read tag configuration file
-    config = tagsets.config.Config.fromfile(args.tag_config)
+    with tagsets.stats.phase(stats, 'config'):
+        cache_dir = None if args.no_config_cache else tagsets.config.default_cache_dir()
+        config = tagsets.config.Config.fromfile(args.tag_config, cache_dir)
+    plan = compile_script(args, config.tagconfs)
 
     # build search path tree and search for tags
-    matchers = config.build_matchers()
-    tss = config.get_initial_tagsets()
-    tsmap = dict([ (ts.name, ts) for ts in tss ])
-    grepper = tagsets.tagsearch.TagMatcherVisitor(tsmap)
-    tagsets.filefinder.search_paths(grepper, matchers)
+    grep_options = {'whole_file': args.whole_file}
+    cache = None
+    if args.cache:
+        cache = tagsets.scancache.ScanCache.load(args.cache, grep_options)
+    profile = None
+    if args.profile_regexes is not None or args.regex_budget is not None:
+        profile = tagsets.regexprofile.RegexProfile(args.regex_budget)
+    walker_options = None
+    if args.fanout is not None:
+        walker_options = { 'fanout': args.fanout }
+    pipeline = None
+    if args.pipeline:
+        from tagsets.pipeline import PipelineOptions
+        pipeline = PipelineOptions(args.readers, args.match_workers, args.queue_size)
+    store = None
+    if args.tag_store:
+        from tagsets.tagstore import SqliteTagStore
+        store = SqliteTagStore(args.tag_store)
+    streamer = None
+    if args.stream:
+        streamer = tagsets.output.TagStreamer(tagsets.output.BufferedTextWriter(sys.stdout), args.group)
+    try:
+        # Streamed tags only need to be kept if they'll be listed again later
+        result = tagsets.tagsearch.search_tagsets(config, args.walker, args.jobs, grep_options, cache, stats, profile,
+                                                  streamer.tag_found if streamer else None,
+                                                  keep_tags = streamer is None or args.watch,
+                                                  pipeline = pipeline, walker_options = walker_options,
+                                                  store = store)
+    except tagsets.regexprofile.RegexBudgetExceeded as e:
+        print("Search aborted: %s" % e, file=sys.stderr)
+        exit(1)
+    if cache is not None:
+        cache.save()
+    tss = result.tagsets
+    tsmap = result.tsmap
+    if args.save_snapshot is not None:
+        with tagsets.stats.phase(stats, 'snapshot'):
+            tagsets.snapshot.save(args.save_snapshot, tss)
 
     # perform requested action
+    passed = True
+    with tagsets.stats.phase(stats, 'script'):
+        if streamer is not None:
+            streamer.finish(tss)
+        else:
+            passed = run_action(args, tss, tsmap, plan)
+
+    if stats is not None:
+        print(stats.to_json() if args.stats == 'json' else stats.format(), file=sys.stderr)
+    if args.profile_regexes is not None:
+        print(profile.format(args.profile_regexes), file=sys.stderr)
+
+    if args.watch:
+        # Changes are listed in full by run_action
+        result.grepper.on_tag = None
+        updater = tagsets.watch.TagSetUpdater(result.matchers, result.grepper, tss, args.walker, walker_options)
+        tagsets.watch.watch(updater, lambda: run_action(args, tss, tsmap, plan))
+        if cache is not None:
+            cache.save()
+
+    if store is not None:
+        store.close()
+    if not passed and not args.watch:
+        exit(1)
+
+# Scripts are compiled before the search, so that mistakes in them are reported
+# without waiting for it
+def compile_script(args, tagset_names):
+    if not args.run_script:
+        return None
+    try:
+        plan = tagsets.query.compile_file(args.run_script, tagset_names)
+    except (OSError, tagsets.query.ScriptError) as e:
+        print("Script error: %s" % e, file=sys.stderr)
+        exit(1)
+    if args.explain:
+        print(plan.explain(), file=sys.stderr)
+    return plan
+
+# Returns False if a script's requirements weren't met
+def run_action(args, tss, tsmap, plan = None):
     if args.list_tags:
+        out = tagsets.output.BufferedTextWriter(sys.stdout)
         for ts in tss:
-            print()
-            ts.print_summary()
-        print()
+            out.write("\n")
+            ts.print_summary(out)
+        out.write("\n")
+        out.flush()
 
     elif args.run_script:
-        print("TODO Should run script: %s" % args.run_script)
+        try:
+            return plan.run(tsmap)
+        except tagsets.query.ScriptError as e:
+            print("Script error: %s" % e, file=sys.stderr)
+            return False
 
     elif args.run_py_script:
         runner = tagsets.script.ScriptContext(tsmap)
@@ -93,3 +316,4 @@ def main(argv = None):
 
     else:
         print("Something went wrong!")
+    return True
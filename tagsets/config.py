@@ -1,7 +1,7 @@
+import hashlib
+import json
 import logging
 import os
-import pykwalify.core
-import yaml
 
 import tagsets.filefinder
 
@@ -12,6 +12,79 @@ logger = logging.getLogger(__name__)
 
 schema_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config-schema.yaml")
 
+# Config cache
+# ============
+#
+# Parsing and validating a config file costs more than many searches - mostly in
+# importing yaml and pykwalify - so the validated config data is cached. Each config
+# file has one entry, named after a hash of its path, holding the data as JSON with
+# a hash of the file's contents and the schema's; an entry whose hash doesn't match
+# is parsed again and overwritten. yaml and pykwalify are only imported when a config
+# file does have to be parsed.
+CONFIG_CACHE_VERSION = 2
+
+def default_cache_dir():
+    directory = os.environ.get('TAGSETS_CACHE_DIR')
+    if directory:
+        return directory
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tagsets')
+
+def _cache_file(cache_dir, filename):
+    path = os.path.abspath(filename)
+    name = hashlib.sha256(os.fsencode(path)).hexdigest()
+    return os.path.join(cache_dir, name + ".json")
+
+def _cache_key(data):
+    digest = hashlib.sha256(b"%i\0" % CONFIG_CACHE_VERSION)
+    with open(schema_file, 'rb') as f:
+        digest.update(f.read())
+    digest.update(b"\0")
+    digest.update(data)
+    return digest.hexdigest()
+
+# Returns the cached config data if the entry is for the given key, else None
+def _load_cached(cachefile, key):
+    try:
+        with open(cachefile, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.info("Ignoring unreadable cached config %s: %s" % (cachefile, e))
+        return None
+    if not isinstance(entry, dict) or entry.get('key') != key:
+        return None
+    return entry.get('config')
+
+def _save_cached(cachefile, key, config_ng):
+    try:
+        text = json.dumps({ 'key': key, 'config': config_ng })
+    except (TypeError, ValueError) as e:
+        logger.info("Not caching config that can't be stored as JSON: %s" % e)
+        return
+    # YAML data that JSON can't represent exactly - such as non-string keys - isn't cached
+    if json.loads(text)['config'] != config_ng:
+        logger.info("Not caching config that can't be stored exactly as JSON")
+        return
+    tmpname = "%s.%i.tmp" % (cachefile, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        with open(tmpname, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmpname, cachefile)
+    except OSError as e:
+        logger.info("Unable to cache config in %s: %s" % (cachefile, e))
+
+def parse_config(data):
+    # Parses and validates the contents of a config file
+    import pykwalify.core
+    import yaml
+    config_ng = yaml.safe_load(data)
+    c = pykwalify.core.Core(source_data=config_ng, schema_files=[schema_file])
+    c.validate()
+    return config_ng
+
 class ConfBC:
     def __repr__(self):
         return "<%s at %s>(%s)" % (
@@ -108,19 +181,23 @@ class FileSearchConf(SearchConf):
         return fms
 
 class TagConf(ConfBC):
-    def __init__(self, name, singular, plural, regex):
+    def __init__(self, name, singular, plural, regex, encoding = None, encodingerrors = None):
         self.name     = name
         self.singular = singular
         self.plural   = plural
         self.regex    = regex
+        self.encoding = encoding
+        self.encodingerrors = encodingerrors
         self.searches = []
 
     def repr_detail(self):
-        return "name=%r,singular=%r,plural=%r,regex=%r,searches=%r" % (
+        return "name=%r,singular=%r,plural=%r,regex=%r,encoding=%r,encodingerrors=%r,searches=%r" % (
             self.name,
             self.singular,
             self.plural,
             self.regex,
+            self.encoding,
+            self.encodingerrors,
             self.searches
         )
 
@@ -130,8 +207,10 @@ class TagConf(ConfBC):
         singular = tagconf_ng.get('singular')
         plural = tagconf_ng.get('plural')
         regex = tagconf_ng.get('regex')
+        encoding = tagconf_ng.get('encoding')
+        encodingerrors = tagconf_ng.get('encodingerrors')
 
-        temp = cls(name, singular, plural, regex)
+        temp = cls(name, singular, plural, regex, encoding, encodingerrors)
 
         searches_ng = tagconf_ng.get('search')
         for search_ng in searches_ng:
@@ -153,8 +232,11 @@ class TagConf(ConfBC):
     def add_search(self, search):
         self.searches.append(search)
 
-    def get_filematchers(self, basepath):
-        ttm = TagTextMatcher(self.name, self.regex)
+    # encoding and encodingerrors are the defaults for tag sets that don't set them
+    def get_filematchers(self, basepath, encoding = None, encodingerrors = None):
+        ttm = TagTextMatcher(self.name, self.regex,
+                             self.encoding or encoding,
+                             self.encodingerrors or encodingerrors)
 
         tfms = []
         for search in self.searches:
@@ -165,12 +247,16 @@ class Config(ConfBC):
     def __init__(self):
         self.basepath = os.getcwd()
         self.ignoredirs = []
+        self.encoding = None
+        self.encodingerrors = None
         self.tagconfs = {}
 
     def repr_detail(self):
-        return "basepath=%r,ignoredirs=%r,tagconfs=%r" % (
+        return "basepath=%r,ignoredirs=%r,encoding=%r,encodingerrors=%r,tagconfs=%r" % (
             self.basepath,
             self.ignoredirs,
+            self.encoding,
+            self.encodingerrors,
             self.tagconfs
         )
 
@@ -184,6 +270,8 @@ class Config(ConfBC):
             temp.basepath = os.path.abspath(temp.basepath)
 
         temp.ignoredirs = config_ng.get('ignoredirs', [])
+        temp.encoding = config_ng.get('encoding')
+        temp.encodingerrors = config_ng.get('encodingerrors')
         
         for tsc in config_ng['tagsets']:
             # There should actually only ever be one mapping per item in the sequence
@@ -194,15 +282,23 @@ class Config(ConfBC):
 
         return temp
 
+    # With a cache_dir, the validated config is cached there - see default_cache_dir()
     @classmethod
-    def fromfile(cls, filename):
-        f = open(filename, 'r')
-        config_ng = yaml.safe_load(f)
-        f.close()
-
-        # Validate
-        c = pykwalify.core.Core(source_data=config_ng, schema_files=[schema_file])
-        c.validate()
+    def fromfile(cls, filename, cache_dir = None):
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        config_ng = None
+        if cache_dir is not None:
+            cachefile = _cache_file(cache_dir, filename)
+            key = _cache_key(data)
+            config_ng = _load_cached(cachefile, key)
+            if config_ng is not None:
+                logger.info("Using cached config %s" % cachefile)
+        if config_ng is None:
+            config_ng = parse_config(data)
+            if cache_dir is not None:
+                _save_cached(cachefile, key, config_ng)
 
         config = cls.fromyaml(config_ng)
         logger.info("Loaded config: %r" % config)
@@ -215,7 +311,7 @@ class Config(ConfBC):
         fms = []
 
         for tagconf in self.tagconfs.values():
-            fms += tagconf.get_filematchers(self.basepath)
+            fms += tagconf.get_filematchers(self.basepath, self.encoding, self.encodingerrors)
 
         # Apply any global config
         for fm in fms:
@@ -226,10 +322,14 @@ class Config(ConfBC):
 
         return fms
 
-    def get_initial_tagsets(self):
+    # With a tagsets.tagstore.SqliteTagStore, the tag sets are held in the store
+    def get_initial_tagsets(self, store = None):
         tss = []
 
         for tagconf in self.tagconfs.values():
-            tss.append(TagSet(tagconf.name, tagconf.singular, tagconf.plural))
+            if store is not None:
+                tss.append(store.tagset(tagconf.name, tagconf.singular, tagconf.plural))
+            else:
+                tss.append(TagSet(tagconf.name, tagconf.singular, tagconf.plural))
 
         return tss
@@ -1,8 +1,12 @@
+import concurrent.futures
 import fnmatch
 import logging
 import os
 from abc import ABCMeta, abstractmethod
 
+import tagsets.gitindex
+from tagsets.matcherindex import MatcherIndex, matchers_of
+
 logger = logging.getLogger(__name__)
 
 # Defines the interface needed by the find_files function
@@ -48,7 +52,6 @@ class FileMatcher(FileMatcherBase):
             self.ignorepatterns
         )
 
-    # TODO implement include_subdirs = False
     def __init__(self, path, include_subdirs = True):
         super().__init__()
         self.path = path
@@ -67,14 +70,15 @@ class FileMatcher(FileMatcherBase):
         self.ignoredirs.append(dirname)
 
     def interested_in_subdirs_of(self, path):
-        return ( os.path.commonprefix([self.path,path]) == path or
-                 ( os.path.commonprefix([self.path,path]) == self.path and
+        return ( _is_within(self.path, path) or
+                 ( _is_within(path, self.path) and
                    self.include_subdirs and
                    os.path.basename(path) not in self.ignoredirs) )
 
     def interested_in_files_in(self, path):
-        return (os.path.commonprefix([self.path,path]) == self.path and
-                os.path.basename(path) not in self.ignoredirs)
+        return ( (path == self.path or
+                  (self.include_subdirs and _is_within(path, self.path))) and
+                 os.path.basename(path) not in self.ignoredirs)
 
     def interested_in_file(self, filename):
         interested = False
@@ -85,84 +89,334 @@ class FileMatcher(FileMatcherBase):
         if interested:
             for pattern in self.ignorepatterns:
                 if fnmatch.fnmatch(filename, pattern):
-                    logger.info("%s would be interested in '%s' because it matches '%s', but has excluded it because it matches '%s'" % (self, filename, interestpattern, pattern))
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("%s would be interested in '%s' because it matches '%s', but has excluded it because it matches '%s'" % (self, filename, interestpattern, pattern))
                     interested = False
-        if interested:
+        if interested and logger.isEnabledFor(logging.INFO):
             logger.info("%s is interested in '%s' because it matches '%s'" % (self, filename, interestpattern))
         return interested
 
-def search_paths(visitor, matchers):
-    # In principal, this could walk the entire filesystem, but use of matchers enables
-    # the walk to be constrained to just a sub-set
-
-    # This is the set of active matchers
-    active_matchers = set(matchers)
-    # This is a stack of tuples of (<path below which there is no interest>, set of matchers)
-    inactive_matchers = []
-    
-    for root, dirs, files in os.walk("/", followlinks=True):
-
-        logger.info("Walking: %s" % root)
-
-        logger.debug("  Checking whether to re-activate any matchers")
-        while inactive_matchers:
-            top = inactive_matchers.pop()
-            if os.path.commonprefix([top[0], root]) == top[0]:
-                inactive_matchers.append(top)
-                break
-            else:
-                logger.debug("    Reactivating %s" % top[1])
-                active_matchers |= top[1]
-
-        logger.debug("  Active matchers now: %s" % active_matchers)
-        logger.debug("  Inactive matchers now: %s" % inactive_matchers)
-
-        logger.debug("  Checking for parties interested in files in the current directory")
-        matchers_interested_in_files = set()
-        for matcher in active_matchers:
-            if matcher.interested_in_files_in(root):
-                logger.debug("    %s is interested in files in %s" % (matcher, root))
-                matchers_interested_in_files.add(matcher)
-
-        if matchers_interested_in_files:
-            logger.debug("  Some parties interested - walking the file list")
+def _is_within(path, root):
+    # Component-wise test of whether path is root or lies below it
+    if path == root:
+        return True
+    if not root.endswith(os.sep):
+        root += os.sep
+    return path.startswith(root)
+
+def plan_walk_roots(matchers):
+    # Work out the smallest set of disjoint directories that need to be walked
+    # to cover all of the matchers, as a list of (root, [matchers]) tuples.
+    # Matchers whose path lies beneath another matcher's path share that walk.
+    # Matchers that don't declare a path are planned from the filesystem root.
+    planned = sorted(((os.path.abspath(getattr(m, 'path', os.sep)), m) for m in matchers),
+                     key=lambda pm: pm[0].split(os.sep))
+
+    # Sorting by path components places every path immediately after its ancestors,
+    # so each path only needs to be compared with the most recent root
+    roots = []
+    for path, matcher in planned:
+        if roots and _is_within(path, roots[-1][0]):
+            roots[-1][1].append(matcher)
+        else:
+            roots.append( (path, [matcher]) )
+
+    logger.info("Planned walk roots: %r" % roots)
+    return roots
+
+# stats is an optional tagsets.stats.Stats to count the directories and files seen.
+# walker_options are passed to the engine as keyword arguments, e.g. fanout for
+# the threaded engine.
+def search_paths(visitor, matchers, engine = 'walk', stats = None, walker_options = None):
+    # Only the directories beneath the planned roots are walked, so the cost of
+    # the walk depends on the configured trees rather than the host's filesystem.
+    # Interest in each directory comes from a single lookup in the matcher index.
+    if engine not in ENGINES:
+        raise ValueError("Unknown walker engine %r (choose from %s)" % (engine, ", ".join(sorted(ENGINES))))
+
+    index = MatcherIndex(matchers)
+    for root, _ in plan_walk_roots(matchers):
+        search_subtree(visitor, index, root, engine, stats, walker_options)
+
+# Searches the directory tree at path, which may be anywhere in the trees indexed
+def search_subtree(visitor, index, path, engine = 'walk', stats = None, walker_options = None):
+    state = index.state_for(path)
+    if state is not None:
+        ENGINES[engine](visitor, index, path, state, stats, **(walker_options or {}))
+
+def _count_walk(stats, directories, considered, accepted):
+    if stats is not None:
+        stats.directories += directories
+        stats.files_considered += considered
+        stats.files_accepted += accepted
+
+def _search_root(visitor, index, top, state, stats = None):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    classify = index.classify
+
+    # States of the directories os.walk has yet to reach
+    states = {top: state}
+    directories = considered = accepted = 0
+
+    for root, dirs, files in os.walk(top, followlinks=True):
+        state = states.pop(root)
+        if debug:
+            logger.debug("Walking: %s" % root)
+        directories += 1
+        visitor.visit_directory(root)
+
+        groups_interested_in_files = state[2]
+        if groups_interested_in_files:
+            considered += len(files)
             for f in files:
-                logger.debug("    Considering %s" % f)
-                matchers_interested_in_current_file = set()
-                for matcher in matchers_interested_in_files:
-                    if matcher.interested_in_file(f):
-                        logger.debug("      %s is interested" % matcher)
-                        matchers_interested_in_current_file.add(matcher)
-                if matchers_interested_in_current_file:
-                    logger.debug("    interest expressed in file: %s" % f)
-                    visitor.visit_file(os.path.join(root,f), matchers_interested_in_current_file)
-
-        logger.debug("  Checking whether to deactivate any (dis-)interested parties")
-        matchers_to_deactivate = set()
-        for matcher in active_matchers:
-            if not matcher.interested_in_subdirs_of(root):
-                logger.debug("    Deactivating %r is not interested in subdirs of %s" % (matcher, root))
-                matchers_to_deactivate.add(matcher)
-        if matchers_to_deactivate:
-            inactive_matchers.append( (root, matchers_to_deactivate) )
-            active_matchers -= matchers_to_deactivate
-
-        logger.debug("  Walking the directory list (%s)" % dirs)
-        origdirs = dirs[:]
-        for d in origdirs:
-            logger.debug("    Considering %s" % d)
-            relevant = False
-            path = os.path.join(root, d)
-            for matcher in active_matchers:
-                if matcher.interested_in_subdirs_of(path) or matcher.interested_in_files_in(path):
-                    logger.debug("    %r is interested in %s" % (matcher, path))
-                    relevant = True
-            if not relevant:
-                dirs.remove(d)
-
-        logger.debug("  Subdirs of interest: %r" % dirs)
+                groups = classify(f)
+                if groups:
+                    groups &= groups_interested_in_files
+                    if groups:
+                        accepted += 1
+                        visitor.visit_file(os.path.join(root, f), matchers_of(groups))
+
+        subdirs = []
+        for d in dirs:
+            childstate = index.child_state(state, d)
+            if childstate is not None:
+                states[os.path.join(root, d)] = childstate
+                subdirs.append(d)
+        dirs[:] = subdirs
+
+        if debug:
+            logger.debug("  Subdirs of interest: %r" % dirs)
         # and loop
 
+    _count_walk(stats, directories, considered, accepted)
+
+# Walks with os.scandir, so the directory entry types cached from the listing are
+# used rather than stat'ing, and the DirEntry objects are handed to the visitor
+def _scandir_root(visitor, index, top, state, stats = None):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    classify = index.classify
+    child_state = index.child_state
+
+    # Stack of (directory, state) - children are pushed in reverse so that the
+    # visit order is the same as os.walk's
+    pending = [ (top, state) ]
+    directories = considered = accepted = 0
+
+    while pending:
+        path, state = pending.pop()
+        if debug:
+            logger.debug("Scanning: %s" % path)
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            if debug:
+                logger.debug("Unable to scan %s: %s" % (path, e))
+            continue
+        directories += 1
+        visitor.visit_directory(path)
+
+        groups_interested_in_files = state[2]
+        subdirs = []
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    childstate = child_state(state, entry.name)
+                    if childstate is not None:
+                        subdirs.append( (entry.path, childstate) )
+                elif groups_interested_in_files:
+                    considered += 1
+                    groups = classify(entry.name)
+                    if groups:
+                        groups &= groups_interested_in_files
+                        if groups:
+                            accepted += 1
+                            visitor.visit_entry(entry, matchers_of(groups))
+
+        subdirs.reverse()
+        pending += subdirs
+
+    _count_walk(stats, directories, considered, accepted)
+
+DEFAULT_FANOUT = 8
+
+def _list_directory(path):
+    # Returns ([subdirectory entries], [file entries]) for path, or None if it can't
+    # be listed
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+    except OSError:
+        return None
+    return dirs, files
+
+# Lists directories in a pool of fanout threads, ahead of the walk, for filesystems
+# where each listing is a slow round trip (e.g. NFS). The walk itself - deciding
+# which directories are of interest, and visiting them - stays in the calling
+# thread, in the same order as os.walk's, so the results are the same as the other
+# engines'. Only the next few directories the walk will reach are listed ahead of
+# it, so memory use doesn't depend on the size of the tree.
+def _threaded_root(visitor, index, top, state, stats = None, fanout = DEFAULT_FANOUT):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    classify = index.classify
+    child_state = index.child_state
+    lookahead = 2 * fanout
+
+    # Stack of [directory, state, listing future or None] - children are pushed in
+    # reverse so that the visit order is the same as os.walk's
+    pending = [ [top, state, None] ]
+    directories = considered = accepted = 0
+
+    pool = concurrent.futures.ThreadPoolExecutor(fanout)
+    try:
+        while pending:
+            # Keep the directories at the top of the stack being listed
+            for item in reversed(pending[-lookahead:]):
+                if item[2] is None:
+                    item[2] = pool.submit(_list_directory, item[0])
+
+            path, state, listing = pending.pop()
+            listing = listing.result()
+            if listing is None:
+                if debug:
+                    logger.debug("Unable to list %s" % path)
+                continue
+            if debug:
+                logger.debug("Walking: %s" % path)
+            dirs, files = listing
+            directories += 1
+            visitor.visit_directory(path)
+
+            groups_interested_in_files = state[2]
+            if groups_interested_in_files:
+                considered += len(files)
+                for entry in files:
+                    groups = classify(entry.name)
+                    if groups:
+                        groups &= groups_interested_in_files
+                        if groups:
+                            accepted += 1
+                            visitor.visit_entry(entry, matchers_of(groups))
+
+            subdirs = []
+            for entry in dirs:
+                childstate = child_state(state, entry.name)
+                if childstate is not None:
+                    subdirs.append( [entry.path, childstate, None] )
+            subdirs.reverse()
+            pending += subdirs
+    finally:
+        for item in pending:
+            if item[2] is not None:
+                item[2].cancel()
+        pool.shutdown()
+
+    _count_walk(stats, directories, considered, accepted)
+
+# Lists the files tracked by git rather than walking the tree, so that untracked
+# files - build output, for example - are never even looked at. Falls back to
+# walking when top isn't in a git worktree or its index can't be read. Files that
+# are tracked but missing from the worktree are left out; submodules and sparse
+# directories are searched in the same way (or walked) in their turn.
+def _gitindex_root(visitor, index, top, state, stats = None):
+    tracked = tagsets.gitindex.tracked_files(top)
+    if tracked is None:
+        logger.info("No usable git index for %s - walking it instead" % top)
+        _search_root(visitor, index, top, state, stats)
+        return
+    worktree, entries = tracked
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Listing tracked files in: %s" % top)
+    classify = index.classify
+    child_state = index.child_state
+    prefix = os.path.relpath(top, worktree)
+    prefix = "" if prefix == os.curdir else prefix.replace(os.sep, '/') + '/'
+    # Directories left out of a sparse index are single entries ending in /
+    if prefix and any(mode & tagsets.gitindex.MODE_TYPE_MASK == tagsets.gitindex.MODE_DIRECTORY and
+                      prefix.startswith(path.rstrip('/') + '/') for path, mode in entries):
+        logger.info("%s is in a directory left out of the sparse index - walking it instead" % top)
+        _search_root(visitor, index, top, state, stats)
+        return
+
+    # States of the directories seen so far, by path relative to the worktree
+    states = { prefix.rstrip('/'): state }
+    directories = considered = accepted = 0
+    visitor.visit_directory(top)
+    directories += 1
+
+    for path, mode in entries:
+        if not path.startswith(prefix):
+            continue
+        dirname, _, name = path.rstrip('/').rpartition('/')
+
+        dirstate = states.get(dirname, False)
+        if dirstate is False:
+            # Work down from the nearest directory whose state is known
+            parent, _, child = dirname.rpartition('/')
+            missing = [child]
+            while parent not in states:
+                parent, _, child = parent.rpartition('/')
+                missing.append(child)
+            dirstate = states[parent]
+            for child in reversed(missing):
+                parent = parent + '/' + child if parent else child
+                if dirstate is not None:
+                    dirstate = child_state(dirstate, child)
+                    if dirstate is not None:
+                        directories += 1
+                        visitor.visit_directory(os.path.join(worktree, parent))
+                states[parent] = dirstate
+        if dirstate is None:
+            continue
+
+        mode_type = mode & tagsets.gitindex.MODE_TYPE_MASK
+        if mode_type in (tagsets.gitindex.MODE_GITLINK, tagsets.gitindex.MODE_DIRECTORY):
+            # A submodule, which has an index of its own, or a directory left out of
+            # a sparse index, which has to be walked
+            substate = child_state(dirstate, name)
+            if substate is not None:
+                _count_walk(stats, directories, considered, accepted)
+                directories = considered = accepted = 0
+                engine = _gitindex_root if mode_type == tagsets.gitindex.MODE_GITLINK else _search_root
+                engine(visitor, index, os.path.join(worktree, path.rstrip('/')), substate, stats)
+            continue
+
+        groups_interested_in_files = dirstate[2]
+        if groups_interested_in_files:
+            considered += 1
+            groups = classify(name)
+            if groups:
+                groups &= groups_interested_in_files
+                if groups:
+                    filename = os.path.join(worktree, path)
+                    if os.path.isfile(filename):
+                        accepted += 1
+                        visitor.visit_file(filename, matchers_of(groups))
+
+    _count_walk(stats, directories, considered, accepted)
+
+ENGINES = {
+    'walk': _search_root,
+    'scandir': _scandir_root,
+    'gitindex': _gitindex_root,
+    'threaded': _threaded_root,
+}
+
 # Base class - this acts as the glue between the search function and the interested parties
 # The assumption is that the concrete subclass will understand the interested party's concrete subclass
 class FileMatchVisitor(metaclass=ABCMeta):
@@ -172,3 +426,12 @@ class FileMatchVisitor(metaclass=ABCMeta):
     @abstractmethod
     def visit_file(self, path, matchers):
         raise NotImplementedError
+
+    # Called instead of visit_file by walkers that have an os.DirEntry for the file,
+    # so that visitors can use its cached stat information
+    def visit_entry(self, entry, matchers):
+        self.visit_file(entry.path, matchers)
+
+    # Called for each directory searched, before any of the files in it are visited
+    def visit_directory(self, path):
+        pass
@@ -1,9 +1,24 @@
+import codecs
+import concurrent.futures
+import functools
+import io
+import locale
 import logging
+import mmap
+import os
 import re
 from abc import ABCMeta, abstractmethod
 
+import tagsets.regexprofile
+import tagsets.stats
+
 logger = logging.getLogger(__name__)
 
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
 class TextMatcher(metaclass=ABCMeta):
     def __repr__(self):
         return "<%s at %s>(%s)" % (
@@ -15,24 +30,510 @@ class TextMatcher(metaclass=ABCMeta):
     def repr_detail(self):
         return "regex=%r" % self.regex
 
-    def __init__(self, regex):
+    # encoding is the encoding of the files to be searched (by default, the locale's
+    # preferred encoding), and errors is what to do when they can't be decoded - one
+    # of ERROR_POLICIES
+    def __init__(self, regex, encoding = None, errors = None):
         self.regex = regex
+        self.pattern = re.compile(regex)
+        self.literal = required_literal(self.pattern)
+        if encoding is not None:
+            codecs.lookup(encoding)
+        if errors is not None and errors not in ERROR_POLICIES:
+            raise ValueError("Unknown encoding error policy %r (choose from %s)" % (errors, ", ".join(ERROR_POLICIES)))
+        self.encoding = encoding
+        self.errors = errors or DEFAULT_ERROR_POLICY
+
+# What to do with text that can't be decoded:
+#   strict  - raise UnicodeDecodeError
+#   replace - replace it with U+FFFD
+#   ignore  - leave it out
+#   skip    - stop searching the file (with the matchers using that encoding)
+ERROR_POLICIES = ('strict', 'replace', 'ignore', 'skip')
+DEFAULT_ERROR_POLICY = 'replace'
+
+_searchable_encodings = {}
+
+def bytes_searchable(encoding):
+    # True if text in the encoding can be searched as bytes: ASCII characters are
+    # encoded as themselves and never appear within the encoding of another character.
+    # Only then can regexes and literals be applied to the raw file contents, and NUL
+    # bytes be taken as a sign of binary content.
+    searchable = _searchable_encodings.get(encoding)
+    if searchable is None:
+        try:
+            info = codecs.lookup(encoding)
+        except LookupError:
+            info = None
+        if info is None:
+            searchable = False
+        elif info.name == 'utf-8':
+            searchable = True
+        else:
+            # A single byte encoding that is a superset of ASCII
+            ascii = bytes(range(128))
+            searchable = (ascii.decode(encoding, 'replace') == ascii.decode('ascii') and
+                          len(bytes(range(256)).decode(encoding, 'replace')) == 256)
+        _searchable_encodings[encoding] = searchable
+    return searchable
+
+def required_literal(pattern):
+    # Finds the longest run of literal text that every match of a compiled pattern
+    # must contain, or None if there isn't one that can be relied upon
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (re.error, TypeError):
+        return None
+
+    runs = []
+    current = []
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                current.append(chr(av))
+            elif op == sre_constants.SUBPATTERN and (len(av) < 4 or not (av[1] or av[2])):
+                # A plain group is just part of the sequence
+                walk(av[-1])
+            else:
+                runs.append("".join(current))
+                del current[:]
+    walk(parsed)
+    runs.append("".join(current))
+
+    longest = max(runs, key=len)
+    return longest or None
+
+def _refers_to_groups(parsed):
+    # True if a parsed pattern contains backreferences or group conditionals, whose
+    # group numbers would change when the pattern is embedded in another pattern
+    for op, av in parsed:
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        pending = [av]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                if _refers_to_groups(item):
+                    return True
+            elif isinstance(item, (tuple, list)):
+                pending.extend(item)
+    return False
+
+def _unicode_sensitive(parsed, flags = 0):
+    # True if a parsed pattern could match differently when applied to encoded bytes
+    # rather than to decoded text: if it uses character classes (\w, \d, \s), word
+    # boundaries, case folding, non-ASCII characters, or anything that matches "any
+    # character but" - which is one byte of a multi-byte character in bytes
+    if flags & re.IGNORECASE:
+        return True
+    for op, av in parsed:
+        if op in (sre_constants.ANY, sre_constants.NOT_LITERAL, sre_constants.NEGATE, sre_constants.CATEGORY):
+            return True
+        if op == sre_constants.LITERAL and av >= 128:
+            return True
+        if op == sre_constants.RANGE and av[1] >= 128:
+            return True
+        if op == sre_constants.AT and av in (sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY):
+            return True
+        if op == sre_constants.IN:
+            if _unicode_sensitive(av):
+                return True
+            continue
+        if op == sre_constants.SUBPATTERN and len(av) >= 4 and av[1] & re.IGNORECASE:
+            return True
+        pending = [av]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                if _unicode_sensitive(item):
+                    return True
+            elif isinstance(item, (tuple, list)):
+                pending.extend(item)
+    return False
+
+_NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+# All of the matchers to be applied to a file, compiled together.
+#
+# The matchers' regexes are combined into a single alternation which is used to
+# scan each line once; only the (rare) lines where the alternation finds something
+# are then searched with each matcher's own regex, so the results are exactly those
+# of applying every regex separately. Regexes that can't be safely embedded in the
+# alternation are applied to every line.
+class CompiledMatchers:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "matchers=%r" % self.matchers
+
+    def __init__(self, matchers):
+        self.matchers = list(matchers)
+        # (findall, matcher index) pairs
+        self.findalls = [ (m.pattern.findall, i) for i, m in enumerate(self.matchers) ]
+
+        combinable = [ m for m in self.matchers
+                       if not _refers_to_groups(sre_parse.parse(m.regex, m.pattern.flags)) ]
+        # Matchers that must be applied to every line
+        self.unscanned = [ (m.pattern.findall, i) for i, m in enumerate(self.matchers)
+                           if m not in combinable ]
+        self.scan = None
+        if combinable:
+            try:
+                self.scan = re.compile("|".join("(?:%s)" % m.regex for m in combinable)).search
+            except re.error:
+                self.unscanned = self.findalls
+
+        # True if the regexes match the same in bytes as in text, whatever the text
+        self.bytes_safe = not any(_unicode_sensitive(sre_parse.parse(m.regex, m.pattern.flags), m.pattern.flags)
+                                  for m in self.matchers)
+        self._buffer_patterns = {}
+        self._literals = {}
+
+    # Patterns for scanning a whole file's bytes in one go, with ^ and $ matching at
+    # line boundaries. None if any regex can't be expressed as a bytes pattern. Unless
+    # bytes_safe is set, the patterns only match the same as the regexes in ASCII text.
+    def buffer_patterns(self, encoding):
+        patterns = self._buffer_patterns.get(encoding)
+        if patterns is None:
+            patterns = []
+            if bytes_searchable(encoding) and all(ord(c) < 128 for m in self.matchers for c in m.regex):
+                try:
+                    patterns = [
+                        re.compile(m.regex.encode(encoding), (m.pattern.flags & ~re.UNICODE) | re.MULTILINE)
+                        for m in self.matchers ]
+                except (re.error, UnicodeEncodeError, ValueError):
+                    patterns = []
+            self._buffer_patterns[encoding] = patterns
+        return patterns or None
+
+    # The matchers' required literals, encoded for searching raw file contents
+    def literals(self, encoding):
+        literals = self._literals.get(encoding)
+        if literals is None:
+            literals = []
+            searchable = bytes_searchable(encoding)
+            for m in self.matchers:
+                try:
+                    literals.append(m.literal.encode(encoding) if m.literal and searchable else None)
+                except UnicodeEncodeError:
+                    literals.append(None)
+            self._literals[encoding] = literals
+        return literals
+
+    # The matchers that could match somewhere in buf - those whose required literal
+    # appears in it, and those without a required literal
+    def prefilter(self, buf, encoding):
+        found = {}
+        candidates = []
+        for m, literal in zip(self.matchers, self.literals(encoding)):
+            if literal is not None:
+                if literal not in found:
+                    found[literal] = buf.find(literal) != -1
+                if not found[literal]:
+                    continue
+            candidates.append(m)
+        return candidates
+
+# The most recently used sets of matchers stay compiled, so that a long-running
+# watch - or a library caller - doesn't keep every set it has ever used
+@functools.lru_cache(maxsize=256)
+def _compile_matchers(matchers):
+    return CompiledMatchers(matchers)
+
+def compile_matchers(matchers):
+    return _compile_matchers(tuple(matchers))
+
+# Files at least this large are memory mapped rather than read in whole-file mode
+MMAP_THRESHOLD = 1024 * 1024
+
+# Files with a NUL byte in this many bytes at their start are taken to be binary, and
+# aren't searched
+BINARY_PREFIX = 8192
+
+# stats is an optional tagsets.stats.Stats to count the files, bytes and lines read
+# profile is an optional tagsets.regexprofile.RegexProfile to time each regex with
+def grep_file(path, matchers, visitor, whole_file = False, stats = None, profile = None):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Grepping %s with:" % path)
+        for g in matchers:
+            logger.info("  %r" % g)
+
+    groups = encoding_groups(matchers)
+    buf = read_file(path, groups, whole_file, stats)
+    if buf is not None:
+        grep_buffer(buf, path, matchers, groups, visitor, whole_file, stats, profile)
+
+# Returns the matchers' positions, grouped by (encoding, error policy)
+def encoding_groups(matchers):
+    default_encoding = None
+    groups = {}
+    for position, m in enumerate(matchers):
+        encoding = m.encoding
+        if encoding is None:
+            if default_encoding is None:
+                default_encoding = locale.getpreferredencoding(False)
+            encoding = default_encoding
+        groups.setdefault( (encoding, m.errors), [] ).append(position)
+    return groups
+
+# Returns the contents of a file to be grepped with the matchers in groups, or None
+# if the file is binary. In whole-file mode, large files are returned memory mapped,
+# and must be closed by the caller (which grep_buffer does).
+def read_file(path, groups, whole_file = False, stats = None):
+    detect_binary = all(bytes_searchable(encoding) for encoding, _ in groups)
+
+    # Only the start of the file is read until it's known not to be binary
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if whole_file and size >= MMAP_THRESHOLD:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            prefix = buf[:BINARY_PREFIX]
+        elif size > BINARY_PREFIX and detect_binary:
+            buf = None
+            prefix = f.read(BINARY_PREFIX)
+        else:
+            buf = prefix = f.read()
+        if detect_binary and b'\0' in prefix:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Binary content in %s - skipping" % path)
+            if stats is not None:
+                stats.files_binary += 1
+                stats.bytes_read += len(prefix)
+            return None
+        if buf is None:
+            f.seek(0)
+            buf = f.read()
+    if stats is not None:
+        stats.files_grepped += 1
+        stats.bytes_read += len(buf)
+    return buf
+
+# Greps a file's contents, as returned by read_file
+def grep_buffer(buf, path, matchers, groups, visitor, whole_file = False, stats = None, profile = None):
+    info = logger.isEnabledFor(logging.INFO)
+    located = []
+    try:
+        for (encoding, errors), positions in groups.items():
+            group = [matchers[p] for p in positions]
+            try:
+                found, lines = _grep_buffer(buf, group, encoding, errors, whole_file, path, profile)
+            except UnicodeDecodeError as e:
+                if errors != 'skip':
+                    raise
+                logger.warning("Skipping %s, which can't be decoded as %s: %s" % (path, encoding, e))
+                continue
+            if found is None:
+                if info:
+                    logger.info("  No required literals present in %s - skipping" % path)
+                continue
+            if stats is not None:
+                stats.lines_scanned += lines if lines is not None else _count_lines(buf)
+            located += [ (linenumber, positions[index], captured)
+                         for linenumber, index, _, captured in found ]
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
 
-# TODO should eventually consider what encoding to use (option in config file?)
-def grep_file(path, matchers, visitor):
-    logger.info("Grepping %s with:" % path)
-    for g in matchers:
-        logger.info("  %r" % g)
+    if len(groups) > 1:
+        # By line, then by matcher
+        located.sort(key=lambda hit: hit[:2])
+    for linenumber, position, captured in located:
+        g = matchers[position]
+        if info:
+            logger.info("Found \"%s\" at line %i for %r" % (captured, linenumber, g))
+        visitor.visit_match(captured, path, linenumber, g)
 
-    f = open(path, 'r')
+# Locates the matches of matchers that all use the same encoding, returning them
+# with indexes into matchers, and the number of lines scanned (None in whole-file
+# mode, where they haven't been counted) - or None if the buffer can't hold any
+# matches
+def _grep_buffer(buf, matchers, encoding, errors, whole_file, path, profile):
+    if errors == 'skip':
+        errors = 'strict'
+
+    # Skip the file, or the matchers, whose required literals aren't in it
+    compiled = compile_matchers(matchers)
+    candidates = compiled.prefilter(buf, encoding)
+    if not candidates:
+        return None, 0
+    if len(candidates) < len(compiled.matchers):
+        compiled = compile_matchers(candidates)
+
+    if profile is not None:
+        with profile.budget_alarm():
+            if whole_file:
+                located = _locate_matches(buf, compiled, encoding, errors, path, profile)
+                lines = None
+            else:
+                located, lines = _profile_lines(buf, compiled, encoding, errors, path, profile)
+    elif whole_file:
+        located = _locate_matches(buf, compiled, encoding, errors)
+        lines = None
+    else:
+        located, lines = _locate_lines(buf, compiled, encoding, errors)
+
+    if compiled.matchers != matchers:
+        positions = dict( (id(m), i) for i, m in enumerate(matchers) )
+        indexes = [ positions[id(m)] for m in compiled.matchers ]
+        located = [ (linenumber, indexes[index], start, captured)
+                    for linenumber, index, start, captured in located ]
+    return located, lines
+
+def _scan_line(linenumber, linestr, compiled, located):
+    scan = compiled.scan
+    if scan is not None and scan(linestr):
+        applicable = compiled.findalls
+    elif compiled.unscanned:
+        applicable = compiled.unscanned
+    else:
+        return
+    for findall, index in applicable:
+        for m in findall(linestr):
+            located.append( (linenumber, index, None, m) )
+
+def _count_lines(buf):
+    if not len(buf):
+        return 0
+    if isinstance(buf, mmap.mmap):
+        buf = buf[:]
+    # Lines end with LF, CRLF or a lone CR
+    newlines = buf.count(b'\n') + buf.count(b'\r') - buf.count(b'\r\n')
+    return newlines + (buf[-1:] not in (b'\n', b'\r'))
+
+# Returns the located matches and the number of lines scanned
+def _locate_lines(buf, compiled, encoding, errors = 'strict'):
+    literals = compiled.literals(encoding)
+    crlf = buf.count(b'\r')
+    if (None in literals or '\n'.encode(encoding) != b'\n'
+        or (crlf and crlf != buf.count(b'\r\n'))):
+        return _scan_all_lines(buf, compiled, encoding, errors)
+
+    # Every matcher has a required literal, so only the lines containing one of
+    # them need to be decoded and scanned
+    lines = {}
+    for literal in set(literals):
+        pos = buf.find(literal)
+        while pos != -1:
+            start = buf.rfind(b'\n', 0, pos) + 1
+            end = buf.find(b'\n', pos)
+            if end == -1:
+                end = len(buf)
+            lines[start] = end
+            pos = buf.find(literal, max(end, pos + 1))
+
+    located = []
+    linenumber = 1
+    offset = 0
+    for start in sorted(lines):
+        linenumber += buf.count(b'\n', offset, start)
+        offset = start
+        linestr = buf[start:lines[start]].decode(encoding, errors)
+        if crlf:
+            linestr = linestr.rstrip('\r')
+        _scan_line(linenumber, linestr, compiled, located)
+    return located, len(lines)
+
+def _scan_all_lines(buf, compiled, encoding, errors = 'strict'):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    located = []
+    linenumber = 0
+    f = io.TextIOWrapper(io.BytesIO(buf), encoding=encoding, errors=errors)
     for linenumber,linestr in enumerate(f, start=1):
         linestr = linestr.rstrip('\n')
-        logger.debug("line #%i is: %s" % (linenumber, linestr))
-        for g in matchers:
-            for m in re.findall(g.regex, linestr):
-                logger.info("Found \"%s\" at line %i for %r" %
-                            (m, linenumber, g))
-                visitor.visit_match(m, path, linenumber, g)
+        if debug:
+            logger.debug("line #%i is: %s" % (linenumber, linestr))
+        _scan_line(linenumber, linestr, compiled, located)
+    return located, linenumber
+
+# Scans every line with each regex separately, timing each one
+def _profile_lines(buf, compiled, encoding, errors, path, profile):
+    run = profile.run
+    matchers = compiled.matchers
+    located = []
+    linenumber = 0
+    f = io.TextIOWrapper(io.BytesIO(buf), encoding=encoding, errors=errors)
+    for linenumber,linestr in enumerate(f, start=1):
+        linestr = linestr.rstrip('\n')
+        nbytes = len(linestr.encode(encoding, 'replace'))
+        for findall, index in compiled.findalls:
+            for m in run(matchers[index], path, linenumber, nbytes, 1, findall, linestr):
+                located.append( (linenumber, index, None, m) )
+    return located, linenumber
+
+def _captured(match, groups, encoding = None, errors = 'strict'):
+    # The same captured value as re.findall gives for a match
+    if groups == 0:
+        captured = match.group(0)
+        return captured if encoding is None else captured.decode(encoding, errors)
+    if encoding is None:
+        captured = match.groups('')
+    else:
+        captured = tuple(g.decode(encoding, errors) for g in match.groups(b''))
+    return captured[0] if groups == 1 else captured
+
+# Runs the regexes over the whole file at once, so that there's no per-line work;
+# line numbers are only worked out for the matches, by counting the newlines between
+# them. Matches may span lines, and are reported at the line where they start.
+# CRLF and lone CR line endings are first turned into LF, as text mode does, so that
+# the matches and their line numbers are the same as the line by line scan's.
+# With a profile, each regex's pass over the file is timed.
+def _locate_matches(buf, compiled, encoding, errors = 'strict', path = None, profile = None):
+    patterns = compiled.buffer_patterns(encoding)
+    if patterns is not None and not compiled.bytes_safe and _NON_ASCII.search(buf):
+        patterns = None
+    if patterns is None:
+        # Fall back to running the text regexes over the decoded file
+        text = buf[:].decode(encoding, errors)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        patterns = [ re.compile(m.regex, m.pattern.flags | re.MULTILINE) for m in compiled.matchers ]
+        newline = '\n'
+        encoding = None
+    else:
+        text = buf
+        if buf.find(b'\r') != -1:
+            text = buf[:].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        newline = b'\n'
+
+    if profile is not None:
+        lines = _count_lines(buf)
+
+    hits = []
+    for index, pattern in enumerate(patterns):
+        groups = pattern.groups
+        if profile is None:
+            matches = pattern.finditer(text)
+        else:
+            matches = profile.run(compiled.matchers[index], path, None, len(text), lines,
+                                  list, pattern.finditer(text))
+        for match in matches:
+            hits.append( (match.start(), index, _captured(match, groups, encoding, errors)) )
+
+    # Resolve line numbers in offset order, then report in the same order as the
+    # line by line scan: by line, then by matcher, then by position
+    if isinstance(text, mmap.mmap):
+        count_newlines = lambda start, end: text[start:end].count(newline)
+    else:
+        count_newlines = lambda start, end: text.count(newline, start, end)
+    hits.sort(key=lambda hit: hit[0])
+    linenumber = 1
+    offset = 0
+    located = []
+    for start, index, captured in hits:
+        linenumber += count_newlines(offset, start)
+        offset = start
+        located.append( (linenumber, index, start, captured) )
+    located.sort(key=lambda hit: hit[:3])
+    return located
 
 class TextMatchVisitor(metaclass=ABCMeta):
     def __init__(self):
@@ -41,3 +542,151 @@ class TextMatchVisitor(metaclass=ABCMeta):
     @abstractmethod
     def visit_match(self, captured_text, filename, linenumber, matcher):
         raise NotImplementedError
+
+# Parallel grepping
+# =================
+#
+# Work items are (path, matchers, size) tuples, where size may be None if it isn't
+# already known. Each worker process is given the table of all matchers once, and
+# work items refer to matchers by their index in that table. Workers return compact
+# batches of (item index, matcher index, captured text, line number) tuples, along
+# with their stats counts and regex profile data if those are being collected,
+# which are merged into the visitor in the order the work items were enumerated - so the
+# results don't depend on how the pool scheduled the work.
+
+# Files at least this large are grepped in a task of their own
+LARGE_FILE_SIZE = 1024 * 1024
+# Maximum number of small files grepped by a single task
+BATCH_SIZE = 64
+
+_worker_matchers = None
+_worker_options = None
+_worker_stats = False
+_worker_profile = None
+
+# profile is a RegexProfile to copy the budget of, or None
+def _init_worker(matchers, options, stats = False, profile = None):
+    global _worker_matchers, _worker_options, _worker_stats, _worker_profile
+    _worker_matchers = matchers
+    _worker_options = options
+    _worker_stats = stats
+    _worker_profile = profile
+
+class _MatchBatch(TextMatchVisitor):
+    def __init__(self):
+        self.matches = []
+        self.item = None
+        self.positions = None
+
+    def visit_match(self, captured_text, filename, linenumber, matcher):
+        self.matches.append( (self.item, self.positions[id(matcher)], captured_text, linenumber) )
+
+def _grep_batch(batch):
+    collector = _MatchBatch()
+    stats = tagsets.stats.Stats() if _worker_stats else None
+    profile = None
+    if _worker_profile is not None:
+        profile = tagsets.regexprofile.RegexProfile(_worker_profile.budget)
+    for item, path, matcherids in batch:
+        matchers = [_worker_matchers[i] for i in matcherids]
+        collector.item = item
+        collector.positions = dict( (id(m), pos) for pos, m in enumerate(matchers) )
+        grep_file(path, matchers, collector, stats=stats, profile=profile, **_worker_options)
+    return (collector.matches,
+            stats.counts() if stats is not None else None,
+            profile.data() if profile is not None else None)
+
+def _grep_initialised_batch(initargs, batch):
+    # For process pools that can't initialise their workers (before Python 3.7)
+    _init_worker(*initargs)
+    return _grep_batch(batch)
+
+def _file_size(path, size):
+    if size is not None:
+        return size
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+def _schedule(workitems, matcherids):
+    # Largest files first, so a single huge file doesn't start last and decide the
+    # total runtime; small files are batched to keep the per-task overhead down
+    sizes = [_file_size(path, size) for path, _, size in workitems]
+    batches = []
+    batch = []
+    for i in sorted(range(len(workitems)), key=lambda i: -sizes[i]):
+        path, matchers, _ = workitems[i]
+        task = (i, path, [matcherids[id(m)] for m in matchers])
+        if sizes[i] >= LARGE_FILE_SIZE:
+            batches.append([task])
+        else:
+            batch.append(task)
+            if len(batch) == BATCH_SIZE:
+                batches.append(batch)
+                batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+# options are passed on to grep_file; the workers' counts are added to stats, and
+# their regex timings to profile. on_item, if given, is called with each work item's
+# index just before its matches are merged.
+def grep_files(workitems, visitor, jobs, options = None, stats = None, profile = None, on_item = None):
+    table = []
+    matcherids = {}
+    for _, matchers, _ in workitems:
+        for m in matchers:
+            if id(m) not in matcherids:
+                matcherids[id(m)] = len(table)
+                table.append(m)
+
+    batches = _schedule(workitems, matcherids)
+    logger.info("Grepping %i files in %i batches with %i jobs" % (len(workitems), len(batches), jobs))
+
+    # Workers start with empty profiles of their own
+    worker_profile = None
+    if profile is not None:
+        worker_profile = tagsets.regexprofile.RegexProfile(profile.budget)
+
+    initargs = (table, options or {}, stats is not None, worker_profile)
+    try:
+        pool = concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=initargs)
+        submit = lambda batch: pool.submit(_grep_batch, batch)
+    except TypeError:
+        # Before Python 3.7, the workers are given the table with each batch instead
+        pool = concurrent.futures.ProcessPoolExecutor(jobs)
+        submit = lambda batch: pool.submit(_grep_initialised_batch, initargs, batch)
+
+    with pool:
+        futures = {}
+        remaining = {}
+        for batch in batches:
+            future = submit(batch)
+            remaining[future] = len(batch)
+            for task in batch:
+                futures[task[0]] = future
+
+        # Merge results in enumeration order, dropping each batch's results once
+        # all of its items have been merged
+        results = {}
+        for item, (path, matchers, _) in enumerate(workitems):
+            future = futures.pop(item)
+            if future not in results:
+                batch_matches = {}
+                matches, counts, profile_data = future.result()
+                for match in matches:
+                    batch_matches.setdefault(match[0], []).append(match)
+                results[future] = batch_matches
+                if stats is not None:
+                    stats.add_counts(counts)
+                if profile is not None:
+                    profile.add_data(profile_data)
+            if on_item is not None:
+                on_item(item)
+            for _, pos, captured_text, linenumber in results[future].pop(item, []):
+                visitor.visit_match(captured_text, path, linenumber, matchers[pos])
+            remaining[future] -= 1
+            if not remaining[future]:
+                del results[future]
+                del remaining[future]
@@ -0,0 +1,162 @@
+import logging
+import os
+import re
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Reading the files tracked by git, straight from a repository's index file
+# (see git's Documentation/gitformat-index.txt) - without running git.
+#
+# Versions 2, 3 and 4 are understood. Indexes that can't be relied upon to list
+# every tracked file - split indexes, whose entries are partly held in a shared
+# index - aren't, and None is returned for them so that the caller can fall back
+# to walking the directory tree.
+
+class GitIndexError(Exception):
+    pass
+
+# Object types, from the top bits of the entry modes
+MODE_TYPE_MASK = 0o170000
+MODE_FILE = 0o100000
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+MODE_DIRECTORY = 0o040000
+
+_HEADER = struct.Struct('>4sII')
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+
+# Offsets in an entry: ctime, mtime, dev, ino come before the mode, and uid, gid,
+# size and the object name after it
+_MODE_OFFSET = 24
+_OBJECT_OFFSET = 40
+
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE_MASK = 0x3000
+FLAG_NAME_MASK = 0x0fff
+
+def find_worktree(path):
+    # Returns (worktree root, git directory) for the repository that path is in,
+    # or None if it isn't in one
+    path = os.path.abspath(path)
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return path, dotgit
+        if os.path.isfile(dotgit):
+            # Worktrees and submodules have a file pointing at their git directory
+            try:
+                with open(dotgit) as f:
+                    line = f.readline().strip()
+            except OSError:
+                return None
+            if not line.startswith('gitdir:'):
+                return None
+            gitdir = line[len('gitdir:'):].strip()
+            return path, os.path.normpath(os.path.join(path, gitdir))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def _object_size(gitdir):
+    # SHA-256 repositories say so in their config - which, for a linked worktree,
+    # is in the common git directory
+    configs = [ os.path.join(gitdir, 'config') ]
+    try:
+        with open(os.path.join(gitdir, 'commondir')) as f:
+            configs.append(os.path.join(gitdir, f.read().strip(), 'config'))
+    except OSError:
+        pass
+    for config in configs:
+        try:
+            with open(config) as f:
+                if re.search(r'^\s*objectformat\s*=\s*sha256\s*$', f.read(), re.MULTILINE | re.IGNORECASE):
+                    return 32
+        except OSError:
+            pass
+    return 20
+
+def _varint(data, offset):
+    # git's offset encoding, as used for the prefix lengths of version 4 paths
+    c = data[offset]
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+def parse_index(data, object_size = 20):
+    # Returns a list of (path, mode) for the entries in the index data, with paths
+    # as bytes relative to the worktree root, in the index's (sorted) order. Entries
+    # for unmerged paths are only listed once. Returns None for split indexes.
+    if len(data) < _HEADER.size:
+        raise GitIndexError("index is truncated")
+    signature, version, count = _HEADER.unpack_from(data, 0)
+    if signature != b'DIRC':
+        raise GitIndexError("not a git index")
+    if version not in (2, 3, 4):
+        raise GitIndexError("unsupported index version %i" % version)
+
+    flags_offset = _OBJECT_OFFSET + object_size
+    entries = []
+    previous = b''
+    offset = _HEADER.size
+    try:
+        for _ in range(count):
+            start = offset
+            mode = _UINT32.unpack_from(data, start + _MODE_OFFSET)[0]
+            flags = _UINT16.unpack_from(data, start + flags_offset)[0]
+            offset = start + flags_offset + 2
+            if flags & FLAG_EXTENDED:
+                offset += 2
+
+            if version == 4:
+                strip, offset = _varint(data, offset)
+                end = data.index(b'\0', offset)
+                path = previous[:len(previous) - strip] + data[offset:end]
+                offset = end + 1
+            else:
+                end = data.index(b'\0', offset)
+                path = data[offset:end]
+                # Entries are padded with 1-8 NULs to a multiple of 8 bytes
+                offset = start + ((end - start) // 8 + 1) * 8
+
+            if path != previous or not entries:
+                entries.append( (path, mode) )
+            previous = path
+    except (struct.error, ValueError, IndexError):
+        raise GitIndexError("index is truncated")
+
+    # Extensions follow the entries; each has a 4 byte signature and 4 byte size
+    while offset + 8 <= len(data) - object_size:
+        extension = data[offset:offset + 4]
+        if extension == b'link':
+            return None
+        size = _UINT32.unpack_from(data, offset + 4)[0]
+        offset += 8 + size
+
+    return entries
+
+def tracked_files(path):
+    # Returns (worktree root, [(path relative to the root, mode)]) for the repository
+    # that path is in, or None if it isn't in one or its index can't be used
+    found = find_worktree(path)
+    if found is None:
+        return None
+    root, gitdir = found
+    indexfile = os.path.join(gitdir, 'index')
+    try:
+        with open(indexfile, 'rb') as f:
+            data = f.read()
+        entries = parse_index(data, _object_size(gitdir))
+    except (OSError, GitIndexError) as e:
+        logger.info("Unable to read git index %s: %s" % (indexfile, e))
+        return None
+    if entries is None:
+        logger.info("Git index %s is a split index" % indexfile)
+        return None
+    return root, [ (os.fsdecode(p), mode) for p, mode in entries ]
@@ -0,0 +1,229 @@
+import fnmatch
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+def path_components(path):
+    return [c for c in os.path.abspath(path).split(os.sep) if c]
+
+# A set of equivalent file matchers (same path, recursion, ignored directories and
+# file patterns) - possibly from different tagsets - that only need to be checked once
+class MatcherGroup:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "path=%r, include_subdirs=%r, matchers=%r" % (
+            self.path,
+            self.include_subdirs,
+            self.matchers
+        )
+
+    @staticmethod
+    def key_of(matcher):
+        return (os.path.abspath(matcher.path),
+                matcher.include_subdirs,
+                frozenset(matcher.ignoredirs),
+                frozenset(matcher.filepatterns),
+                frozenset(matcher.ignorepatterns))
+
+    def __init__(self, matcher):
+        self.path = os.path.abspath(matcher.path)
+        self.include_subdirs = matcher.include_subdirs
+        self.ignoredirs = frozenset(matcher.ignoredirs)
+        self.filepatterns = frozenset(matcher.filepatterns)
+        self.ignorepatterns = frozenset(matcher.ignorepatterns)
+        self.representative = matcher
+        self.matchers = frozenset([matcher])
+
+    def add_matcher(self, matcher):
+        self.matchers |= {matcher}
+
+    def interested_in_file(self, filename):
+        return self.representative.interested_in_file(filename)
+
+_WILDCARDS = re.compile(r'[*?[]')
+
+# Classifies filenames against the file patterns of many groups at once.
+#
+# Patterns are compiled by shape: literal names, '*suffix' and 'prefix*' patterns
+# become dictionary lookups (so '*.c' and '*.h' are a single dict hit), '*' always
+# matches and anything else falls back to a precompiled regex.
+class PatternTable:
+    def __init__(self):
+        self.exact = {}
+        # length -> {suffix/prefix: groups}
+        self.suffixes = {}
+        self.prefixes = {}
+        self.always = frozenset()
+        self.regexes = []
+
+    def add(self, pattern, group):
+        pattern = os.path.normcase(pattern)
+        if not _WILDCARDS.search(pattern):
+            self.exact[pattern] = self.exact.get(pattern, frozenset()) | {group}
+        elif pattern == '*':
+            self.always |= {group}
+        elif pattern.startswith('*') and not _WILDCARDS.search(pattern, 1):
+            table = self.suffixes.setdefault(len(pattern) - 1, {})
+            table[pattern[1:]] = table.get(pattern[1:], frozenset()) | {group}
+        elif pattern.endswith('*') and not _WILDCARDS.search(pattern[:-1]):
+            table = self.prefixes.setdefault(len(pattern) - 1, {})
+            table[pattern[:-1]] = table.get(pattern[:-1], frozenset()) | {group}
+        else:
+            self.regexes.append( (re.compile(fnmatch.translate(pattern)).match, group) )
+
+    def lookup(self, filename):
+        hits = self.always
+        groups = self.exact.get(filename)
+        if groups:
+            hits = hits | groups
+        for length, table in self.suffixes.items():
+            groups = table.get(filename[-length:])
+            if groups:
+                hits = hits | groups
+        for length, table in self.prefixes.items():
+            groups = table.get(filename[:length])
+            if groups:
+                hits = hits | groups
+        for match, group in self.regexes:
+            if group not in hits and match(filename):
+                hits = hits | {group}
+        return hits
+
+class FilenameClassifier:
+    def __init__(self, groups):
+        self.include = PatternTable()
+        self.ignore = PatternTable()
+        for group in groups:
+            for pattern in group.filepatterns:
+                self.include.add(pattern, group)
+            for pattern in group.ignorepatterns:
+                self.ignore.add(pattern, group)
+        self.has_ignores = bool(self.ignore.exact or self.ignore.suffixes or self.ignore.prefixes
+                                or self.ignore.always or self.ignore.regexes)
+        self.normcase = os.path.normcase('A') != 'A'
+
+    # Returns the set of groups interested in a filename
+    def classify(self, filename):
+        if self.normcase:
+            filename = os.path.normcase(filename)
+        hits = self.include.lookup(filename)
+        if hits and self.has_ignores:
+            ignored = self.ignore.lookup(filename)
+            if ignored:
+                hits = hits - ignored
+        return hits
+
+class PathTrieNode:
+    def __init__(self):
+        self.children = {}
+        # Groups whose path is exactly this node
+        self.groups = []
+        # The subset of groups that continue into subdirectories
+        self.recursive_groups = frozenset()
+
+# Compiles a list of FileMatchers into a component-wise trie of directory names.
+#
+# The interest in a directory is described by a state tuple:
+#   (trie node or None, groups inherited from ancestor directories, groups interested in files)
+# The state of a child directory is derived from its parent's state in a single step,
+# and is None when nothing is interested in the child or anything beneath it.
+class MatcherIndex:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "groups=%r" % self.groups
+
+    def __init__(self, matchers):
+        self.root = PathTrieNode()
+        self.groups = []
+        # Every directory name ignored by any group - names outside this set can't
+        # change which inherited groups remain interested
+        self.ignored_names = frozenset()
+
+        bykey = {}
+        for matcher in matchers:
+            key = MatcherGroup.key_of(matcher)
+            group = bykey.get(key)
+            if group is None:
+                group = bykey[key] = MatcherGroup(matcher)
+                self.groups.append(group)
+                self._insert(group)
+                self.ignored_names |= group.ignoredirs
+            else:
+                group.add_matcher(matcher)
+
+        self.classifier = FilenameClassifier(self.groups)
+        self.classify = self.classifier.classify
+
+    def _insert(self, group):
+        node = self.root
+        for component in path_components(group.path):
+            node = node.children.setdefault(component, PathTrieNode())
+        node.groups.append(group)
+        if group.include_subdirs:
+            node.recursive_groups |= {group}
+
+    def root_state(self):
+        return (self.root, frozenset(), frozenset(self.root.groups))
+
+    def child_state(self, state, name):
+        parent, inherited, _ = state
+
+        if parent is None:
+            # Below every matcher's path - only ignored directories can change anything
+            if name not in self.ignored_names:
+                return state
+            inherited = frozenset(g for g in inherited if name not in g.ignoredirs)
+            return (None, inherited, inherited) if inherited else None
+
+        node = parent.children.get(name)
+        if parent.recursive_groups:
+            inherited = inherited | parent.recursive_groups
+        if name in self.ignored_names:
+            inherited = frozenset(g for g in inherited if name not in g.ignoredirs)
+
+        if node is None:
+            return (None, inherited, inherited) if inherited else None
+
+        if node.groups:
+            files = inherited | frozenset(g for g in node.groups if name not in g.ignoredirs)
+        else:
+            files = inherited
+        return (node, inherited, files)
+
+    def state_for(self, path):
+        # Look up the state of an arbitrary directory, one path component at a time
+        state = self.root_state()
+        for component in path_components(path):
+            state = self.child_state(state, component)
+            if state is None:
+                break
+        return state
+
+    def groups_interested_in_files(self, path):
+        state = self.state_for(path)
+        if state is None:
+            return frozenset()
+        return state[2]
+
+def matchers_of(groups):
+    if len(groups) == 1:
+        for group in groups:
+            return group.matchers
+    matchers = set()
+    for group in groups:
+        matchers |= group.matchers
+    return matchers
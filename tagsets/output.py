@@ -0,0 +1,111 @@
+import codecs
+import sys
+import tempfile
+import threading
+
+from tagsets.tagset import format_tag, summary_heading
+
+# Collects text written to it and passes it on to the underlying stream in large
+# writes - when buffer_size characters have built up, or when text has been waiting
+# for flush_interval seconds, so that output still appears promptly when tags are
+# found slowly. The waiting text is flushed by a timer thread, so it's written even
+# if nothing else is written for a long time.
+class BufferedTextWriter:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "stream=%r, buffered=%i" % (self.stream, self.size)
+
+    def __init__(self, stream = None, buffer_size = 65536, flush_interval = 0.5):
+        self.stream = stream if stream is not None else sys.stdout
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.parts = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def write(self, text):
+        with self.lock:
+            self.parts.append(text)
+            self.size += len(text)
+            if self.size >= self.buffer_size or self.flush_interval <= 0:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.parts:
+            self.stream.write("".join(self.parts))
+            self.parts = []
+            self.size = 0
+        self.stream.flush()
+
+# Writes tags out as they're found.
+#
+# Ungrouped, each tag is written straight away as a line prefixed with the name of
+# its tag set and a tab. Grouped, each tag set's tags are held in a spooled
+# temporary file - in memory up to spool_size bytes, then on disk - and
+# written out in the same form as --list-tags when finish() is called, so memory
+# use doesn't grow with the number of tags.
+class TagStreamer:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "writer=%r, group=%r" % (self.writer, self.group)
+
+    def __init__(self, writer, group = False, spool_size = 1024 * 1024):
+        self.writer = writer
+        self.group = group
+        self.spool_size = spool_size
+        self.spools = {}
+
+    def tag_found(self, tagset, tag):
+        if not self.group:
+            self.writer.write("%s\t%s" % (tagset.name, format_tag(tag)))
+            return
+        spool = self.spools.get(tagset.name)
+        if spool is None:
+            spool = self.spools[tagset.name] = tempfile.SpooledTemporaryFile(self.spool_size)
+        spool.write(format_tag(tag).encode('utf-8', 'surrogateescape'))
+
+    # tagsets gives the order of the groups
+    def finish(self, tagsets = ()):
+        if self.group:
+            for ts in tagsets:
+                self.writer.write("\n")
+                self.writer.write(summary_heading(ts.plural))
+                spool = self.spools.pop(ts.name, None)
+                if spool is not None:
+                    # Chunks may end part way through a character
+                    decoder = codecs.getincrementaldecoder('utf-8')('surrogateescape')
+                    spool.seek(0)
+                    for chunk in iter(lambda: spool.read(65536), b""):
+                        self.writer.write(decoder.decode(chunk))
+                    self.writer.write(decoder.decode(b"", True))
+                    spool.close()
+            self.writer.write("\n")
+        self.writer.flush()
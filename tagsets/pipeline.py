@@ -0,0 +1,270 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+
+import tagsets.filefinder
+import tagsets.filegrepper
+import tagsets.regexprofile
+import tagsets.stats
+
+logger = logging.getLogger(__name__)
+
+# Asynchronous search pipeline
+# ============================
+#
+# Rather than walking, reading and matching each file in turn, the stages run
+# concurrently, connected by bounded queues:
+#
+#   enumerator  - walks the directory tree in a thread of its own
+#   dispatcher  - numbers the files, and replays cached matches (in the event loop)
+#   readers     - read the files, in a thread pool
+#   matchers    - apply the regexes to the files' contents, in a thread pool
+#
+# When a queue is full, the stage feeding it waits, and no more than max_pending
+# files are in flight at once - so memory use stays bounded however far ahead the
+# walk gets. Results are handed to the TagMatcherVisitor in the order the files were
+# enumerated, so the tag sets end up exactly as they would from a sequential search.
+
+class PipelineOptions:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "readers=%r, matchers=%r, queue_size=%r" % (self.readers, self.matchers, self.queue_size)
+
+    def __init__(self, readers = 4, matchers = 2, queue_size = 64):
+        self.readers = readers
+        self.matchers = matchers
+        self.queue_size = queue_size
+
+    @property
+    def max_pending(self):
+        return 2 * self.queue_size + self.readers + self.matchers
+
+class _Stopped(Exception):
+    pass
+
+class _Enumerator(tagsets.filefinder.FileMatchVisitor):
+    # Passes the files found by the walk, in its thread, to the event loop's queue
+    def __init__(self, loop, queue, want_stat):
+        self.loop = loop
+        self.queue = queue
+        self.want_stat = want_stat
+        self.stopped = False
+
+    def put(self, item):
+        if self.stopped:
+            raise _Stopped()
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def visit_file(self, path, matchers, st = None):
+        if st is None and self.want_stat:
+            st = os.stat(path)
+        self.put( (path, matchers, st) )
+
+    def visit_entry(self, entry, matchers):
+        st = None
+        if self.want_stat:
+            try:
+                st = entry.stat()
+            except OSError:
+                pass
+        self.visit_file(entry.path, matchers, st)
+
+class _Item:
+    __slots__ = ('seq', 'path', 'textmatchers', 'cached', 'groups', 'buf', 'matches', 'counts', 'profile_data')
+
+    def __init__(self, seq, path, textmatchers, cached):
+        self.seq = seq
+        self.path = path
+        self.textmatchers = textmatchers
+        self.cached = cached
+        self.groups = None
+        self.buf = None
+        self.matches = []
+        self.counts = None
+        self.profile_data = None
+
+class _MatchRecorder(tagsets.filegrepper.TextMatchVisitor):
+    def __init__(self, matches):
+        self.matches = matches
+
+    def visit_match(self, captured_text, filename, linenumber, matcher):
+        self.matches.append( (captured_text, linenumber, matcher) )
+
+class _Pipeline:
+    def __init__(self, grepper, matchers, engine, options, stats, walker_options = None):
+        self.grepper = grepper
+        self.matchers = matchers
+        self.engine = engine
+        self.walker_options = walker_options
+        self.options = options
+        self.stats = stats
+        self.whole_file = grepper.grep_options.get('whole_file', False)
+        self.profile = grepper.profile
+
+    # Stage functions, run in the thread pools
+
+    def read(self, item):
+        stats = tagsets.stats.Stats() if self.stats is not None else None
+        item.groups = tagsets.filegrepper.encoding_groups(item.textmatchers)
+        item.buf = tagsets.filegrepper.read_file(item.path, item.groups, self.whole_file, stats)
+        if stats is not None:
+            item.counts = stats.counts()
+
+    def match(self, item):
+        stats = tagsets.stats.Stats() if self.stats is not None else None
+        profile = None
+        if self.profile is not None:
+            profile = tagsets.regexprofile.RegexProfile(self.profile.budget)
+        buf, item.buf = item.buf, None
+        tagsets.filegrepper.grep_buffer(buf, item.path, item.textmatchers, item.groups, _MatchRecorder(item.matches),
+                                        self.whole_file, stats, profile)
+        if stats is not None:
+            item.counts = dict( (k, v + item.counts.get(k, 0)) for k, v in stats.counts().items() )
+        if profile is not None:
+            item.profile_data = profile.data()
+
+    # Coroutines
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        options = self.options
+        self.walked = asyncio.Queue(options.queue_size)
+        self.to_read = asyncio.Queue(options.queue_size)
+        self.to_match = asyncio.Queue(options.queue_size)
+        self.pending = asyncio.Semaphore(options.max_pending)
+        self.completed = {}
+        self.next_seq = 0
+
+        enumerator = _Enumerator(loop, self.walked, self.grepper.cache is not None)
+        walk_pool = concurrent.futures.ThreadPoolExecutor(1)
+        read_pool = concurrent.futures.ThreadPoolExecutor(options.readers)
+        match_pool = concurrent.futures.ThreadPoolExecutor(options.matchers)
+        workers = ([ asyncio.ensure_future(self.reader(loop, read_pool)) for _ in range(options.readers) ] +
+                   [ asyncio.ensure_future(self.matcher(loop, match_pool)) for _ in range(options.matchers) ])
+        walk = loop.run_in_executor(walk_pool, self.walk, enumerator)
+        finished = asyncio.ensure_future(self.drain(walk))
+        try:
+            # The workers never finish unless they fail, so stop as soon as any
+            # stage fails
+            done, _ = await asyncio.wait(workers + [finished], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            enumerator.stopped = True
+            for task in workers + [finished]:
+                task.cancel()
+            # Let the walk thread see that it's been stopped
+            while not walk.done():
+                while not self.walked.empty():
+                    self.walked.get_nowait()
+                await asyncio.sleep(0.01)
+            for pool in (walk_pool, read_pool, match_pool):
+                pool.shutdown()
+        walk.result()
+
+    def walk(self, enumerator):
+        try:
+            try:
+                tagsets.filefinder.search_paths(enumerator, self.matchers, self.engine, self.stats,
+                                                self.walker_options)
+            finally:
+                # The end of the walk, even if it failed
+                enumerator.put(None)
+        except _Stopped:
+            pass
+
+    async def drain(self, walk):
+        await self.dispatch(walk)
+        await self.to_read.join()
+        await self.to_match.join()
+
+    async def dispatch(self, walk):
+        grepper = self.grepper
+        seq = 0
+        while True:
+            entry = await self.walked.get()
+            if entry is None:
+                break
+            path, filematchers, st = entry
+            await self.pending.acquire()
+
+            textmatchers = grepper.textmatchers_for(filematchers)
+            cached = []
+            if grepper.cache is not None:
+                cached, textmatchers = grepper.cache.lookup(path, st, textmatchers)
+            item = _Item(seq, path, textmatchers, cached)
+            seq += 1
+            if textmatchers:
+                await self.to_read.put(item)
+            else:
+                if self.stats is not None:
+                    self.stats.files_cached += 1
+                self.complete(item)
+        await walk
+
+    async def reader(self, loop, pool):
+        while True:
+            item = await self.to_read.get()
+            try:
+                await loop.run_in_executor(pool, self.read, item)
+                if item.buf is None:
+                    self.complete(item)
+                else:
+                    await self.to_match.put(item)
+            finally:
+                self.to_read.task_done()
+
+    async def matcher(self, loop, pool):
+        while True:
+            item = await self.to_match.get()
+            try:
+                await loop.run_in_executor(pool, self.match, item)
+                self.complete(item)
+            finally:
+                self.to_match.task_done()
+
+    def complete(self, item):
+        # Hands results to the grepper in enumeration order
+        self.completed[item.seq] = item
+        while self.next_seq in self.completed:
+            item = self.completed.pop(self.next_seq)
+            self.next_seq += 1
+            self.emit(item)
+            self.pending.release()
+
+    def emit(self, item):
+        grepper = self.grepper
+        for matcher, matches in item.cached:
+            for captured_text, linenumber in matches:
+                grepper.add_tag(captured_text, item.path, linenumber, matcher)
+        for captured_text, linenumber, matcher in item.matches:
+            grepper.visit_match(captured_text, item.path, linenumber, matcher)
+        if self.stats is not None and item.counts is not None:
+            self.stats.add_counts(item.counts)
+        if self.profile is not None and item.profile_data is not None:
+            self.profile.add_data(item.profile_data)
+
+# Searches the matchers' trees with the given walker engine and greps the files
+# found for a TagMatcherVisitor, as search_paths followed by grepper.finish() would
+def search(grepper, matchers, engine = 'walk', options = None, stats = None, walker_options = None):
+    if engine not in tagsets.filefinder.ENGINES:
+        raise ValueError("Unknown walker engine %r (choose from %s)" % (engine, ", ".join(sorted(tagsets.filefinder.ENGINES))))
+    if grepper.profile is not None and grepper.profile.budget is not None:
+        # The budget is enforced with SIGALRM, which only the main thread receives
+        raise ValueError("Regex budgets can't be enforced in the pipeline's matching threads")
+    pipeline = _Pipeline(grepper, matchers, engine, options or PipelineOptions(), stats, walker_options)
+    logger.info("Searching with pipeline %r" % pipeline.options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(pipeline.run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
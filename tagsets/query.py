@@ -0,0 +1,481 @@
+import json
+import logging
+import re
+
+import tagsets.output
+from tagsets.script import colored
+from tagsets.tagset import Tag, format_tag, summary_heading
+
+logger = logging.getLogger(__name__)
+
+# Tag set scripts
+# ===============
+#
+# A small declarative language for checking tag sets, run with -s/--run-script:
+#
+#   # Comments start with a hash
+#   undefined = refs - defs
+#   unused = defs - refs
+#   require "every reference is defined": empty(undefined)
+#   require "at least 90% of defs are referenced": count(defs & refs) >= 0.9 * count(defs)
+#   require "definitions are unique": unique(defs) and not contains(defs, "TBD")
+#   print "Undefined references:", count(undefined)
+#   print undefined if not empty(undefined)
+#
+# One statement a line:
+#   name = set           names a set expression; names can't be reassigned
+#   require "text": cond reports whether the condition holds
+#   print item, ... [if cond]
+#                        prints strings and numbers on a line, and sets as listings
+#
+# Sets are tag set names (from the config), assigned names, and the set operators,
+# with Python's precedence: - (minus), then &, ^ and | (loosest).
+# Numbers: literals, count(set), + - * / and parentheses; dividing by zero is an
+# error, reported with the statement's line when the script is run.
+# Conditions: empty(set), unique(set), contains(set, "tag"), comparisons of numbers
+# (== != < <= > >=), and, or, not and parentheses.
+#
+# A script is compiled once into a QueryPlan, before any tags are searched for, so
+# that mistakes - syntax errors, unknown names - are reported straight away. The
+# plan holds each distinct set expression once, however many times it's written or
+# used, and when the plan is run each is evaluated at most once, by the tag sets'
+# own (indexed, lazily evaluated) set operations.
+
+class ScriptError(Exception):
+    def __init__(self, message, filename = "<script>", linenumber = None):
+        super().__init__(message, filename, linenumber)
+        self.message = message
+        self.filename = filename
+        self.linenumber = linenumber
+
+    def __str__(self):
+        if self.linenumber is None:
+            return "%s: %s" % (self.filename, self.message)
+        return "%s:%i: %s" % (self.filename, self.linenumber, self.message)
+
+KEYWORDS = frozenset(['require', 'print', 'if', 'and', 'or', 'not', 'count', 'empty', 'unique', 'contains'])
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d*)?|\.\d+)
+      | (?P<name>[A-Za-z_]\w*)
+      | (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<op>==|!=|<=|>=|[-&|^=()<>+*/,:])
+      | (?P<comment>\#.*)
+      | (?P<end>$)
+    )""", re.VERBOSE)
+
+def tokenize(line, filename = "<script>", linenumber = None):
+    # Returns a list of (kind, value) for the line, ending with ('end', None)
+    tokens = []
+    position = 0
+    while True:
+        match = _TOKEN.match(line, position)
+        if match is None:
+            raise ScriptError("unexpected character %r" % line[position:].lstrip()[:1], filename, linenumber)
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'end' or kind == 'comment':
+            tokens.append( ('end', None) )
+            return tokens
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ScriptError("bad string %s" % value, filename, linenumber)
+        elif kind == 'name' and value in KEYWORDS:
+            kind = 'keyword'
+        tokens.append( (kind, value) )
+
+# Set operators, loosest first, and the names of the TagSet methods that apply them
+SET_OPERATORS = [ ('|', 'union'), ('^', 'symmetric_difference'), ('&', 'intersection'), ('-', 'minus') ]
+COMPARISONS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<':  lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>':  lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+ARITHMETIC = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+}
+
+# Compiled scripts
+#
+# Set expressions are nodes, numbered in the order they need evaluating: a node is
+# either ('tagset', name) or (method name, left node, right node). Numbers and
+# conditions are trees of tuples that refer to set nodes by number:
+#   ('number', value), ('count', node), ('arithmetic', op, left, right)
+#   ('empty', node), ('unique', node), ('contains', node, tagstr),
+#   ('compare', op, left, right), ('and', left, right), ('or', left, right), ('not', cond)
+# Statements are ('require', description, cond, linenumber) and
+# ('print', [items], cond or None, linenumber), where items are ('string', text),
+# numbers, and ('set', node, title).
+class QueryPlan:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "filename=%r, nodes=%i, statements=%i" % (self.filename, len(self.nodes), len(self.statements))
+
+    def __init__(self, filename = "<script>"):
+        self.filename = filename
+        self.nodes = []
+        self.node_ids = {}
+        # Number of references to each node, from statements and other nodes
+        self.uses = []
+        self.names = {}
+        self.statements = []
+
+    def node(self, *node):
+        nodeid = self.node_ids.get(node)
+        if nodeid is None:
+            nodeid = self.node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.uses.append(0)
+            for operand in node[1:] if node[0] != 'tagset' else ():
+                self.uses[operand] += 1
+        return nodeid
+
+    def tagsets_used(self):
+        return sorted(node[1] for node in self.nodes if node[0] == 'tagset')
+
+    # Checks that the tag sets the script refers to exist
+    def check(self, tsmap):
+        missing = [ name for name in self.tagsets_used() if name not in tsmap ]
+        if missing:
+            raise ScriptError("unknown tag set%s: %s" % ("s" if len(missing) > 1 else "", ", ".join(missing)), self.filename)
+
+    def explain(self):
+        lines = ["Query plan for %s" % self.filename]
+        for nodeid, node in enumerate(self.nodes):
+            if node[0] == 'tagset':
+                description = "tag set %s" % node[1]
+            else:
+                description = "%s #%i #%i" % node
+            shared = "  (shared by %i uses)" % self.uses[nodeid] if self.uses[nodeid] > 1 else ""
+            lines.append("  #%-4i %s%s" % (nodeid, description, shared))
+        lines.append("%i statements" % len(self.statements))
+        return "\n".join(lines)
+
+    # Runs the script against the tag sets (name -> TagSet), writing its output to
+    # out (by default stdout). Returns True if all of its requirements were met.
+    def run(self, tsmap, out = None):
+        self.check(tsmap)
+        return _Evaluation(self, tsmap, tagsets.output.BufferedTextWriter(out)).run()
+
+class _Evaluation:
+    def __init__(self, plan, tsmap, out):
+        self.plan = plan
+        self.tsmap = tsmap
+        self.out = out
+        self.sets = [None] * len(plan.nodes)
+        # Line number of the statement being run, for errors
+        self.linenumber = None
+
+    def run(self):
+        passed = True
+        requirements = 0
+        try:
+            for statement in self.plan.statements:
+                self.linenumber = statement[-1]
+                if statement[0] == 'require':
+                    _, description, condition, linenumber = statement
+                    requirements += 1
+                    result = self.condition(condition)
+                    passed = passed and result
+                    self.out.write("%s : %s\n" % (description, colored("pass", 'green') if result else colored("FAIL", 'red')))
+                else:
+                    _, items, condition, linenumber = statement
+                    if condition is None or self.condition(condition):
+                        self.print_items(items)
+            if requirements:
+                self.out.write("Overall result: %s\n" % (colored("pass", 'green') if passed else colored("FAIL", 'red')))
+        finally:
+            self.out.flush()
+        return passed
+
+    def set(self, nodeid):
+        # Each node is only built once; the set operations themselves are lazy and
+        # keep their results
+        ts = self.sets[nodeid]
+        if ts is None:
+            node = self.plan.nodes[nodeid]
+            if node[0] == 'tagset':
+                ts = self.tsmap[node[1]]
+            else:
+                ts = getattr(self.set(node[1]), node[0])(self.set(node[2]))
+            self.sets[nodeid] = ts
+        return ts
+
+    def number(self, value):
+        kind = value[0]
+        if kind == 'number':
+            return value[1]
+        if kind == 'count':
+            return self.set(value[1]).count()
+        try:
+            return ARITHMETIC[value[1]](self.number(value[2]), self.number(value[3]))
+        except ZeroDivisionError:
+            raise ScriptError("division by zero", self.plan.filename, self.linenumber)
+
+    def condition(self, condition):
+        kind = condition[0]
+        if kind == 'empty':
+            return self.set(condition[1]).is_empty()
+        if kind == 'unique':
+            return self.set(condition[1]).contains_no_duplicates()
+        if kind == 'contains':
+            return self.set(condition[1]).contains(Tag(condition[2], "", 0))
+        if kind == 'compare':
+            return COMPARISONS[condition[1]](self.number(condition[2]), self.number(condition[3]))
+        if kind == 'and':
+            return self.condition(condition[1]) and self.condition(condition[2])
+        if kind == 'or':
+            return self.condition(condition[1]) or self.condition(condition[2])
+        return not self.condition(condition[1])
+
+    def print_items(self, items):
+        text = []
+        for item in items:
+            if item[0] == 'string':
+                text.append(item[1])
+            elif item[0] == 'set':
+                if text:
+                    self.out.write(" ".join(text) + "\n")
+                    text = []
+                ts = self.set(item[1])
+                self.out.write(summary_heading(item[2] if item[2] is not None else ts.plural))
+                self.out.writelines(format_tag(tag) for tag in ts)
+            else:
+                number = self.number(item)
+                text.append("%g" % number if isinstance(number, float) else str(number))
+        if text:
+            self.out.write(" ".join(text) + "\n")
+
+_KIND_NAMES = { 'name': "a name", 'string': "a string", 'number': "a number", 'op': "an operator",
+                'end': "the end of the line" }
+
+class _Parser:
+    def __init__(self, plan, tagset_names, tokens, linenumber):
+        self.plan = plan
+        self.tagset_names = tagset_names
+        self.tokens = tokens
+        self.position = 0
+        self.linenumber = linenumber
+
+    def is_tagset(self, name):
+        if self.tagset_names is None:
+            return name not in self.plan.names
+        return name in self.tagset_names
+
+    def error(self, message):
+        return ScriptError(message, self.plan.filename, self.linenumber)
+
+    def peek(self, kind, value = None):
+        token = self.tokens[self.position]
+        return token[0] == kind and (value is None or token[1] == value)
+
+    def accept(self, kind, value = None):
+        if self.peek(kind, value):
+            token = self.tokens[self.position]
+            self.position += 1
+            return token
+        return None
+
+    def expect(self, kind, value = None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.tokens[self.position]
+            raise self.error("expected %s but found %s" % (
+                repr(value) if value is not None else _KIND_NAMES[kind],
+                "the end of the line" if found[0] == 'end' else repr(found[1])))
+        return token
+
+    # Statements
+
+    def statement(self):
+        if self.accept('end'):
+            return
+        if self.accept('keyword', 'require'):
+            description = self.expect('string')[1]
+            self.accept('op', ':')
+            self.plan.statements.append( ('require', description, self.condition(), self.linenumber) )
+        elif self.accept('keyword', 'print'):
+            items = [ self.print_item() ]
+            while self.accept('op', ','):
+                items.append(self.print_item())
+            condition = self.condition() if self.accept('keyword', 'if') else None
+            self.plan.statements.append( ('print', items, condition, self.linenumber) )
+        elif self.peek('name') and self.tokens[self.position + 1] == ('op', '='):
+            name = self.expect('name')[1]
+            self.expect('op', '=')
+            if name in self.plan.names or (self.tagset_names is not None and name in self.tagset_names):
+                raise self.error("%s is already defined" % name)
+            self.plan.names[name] = self.set_expression()
+        else:
+            raise self.error("expected an assignment, require or print")
+        self.expect('end')
+
+    def print_item(self):
+        token = self.accept('string')
+        if token is not None:
+            return ('string', token[1])
+        if self.peek('keyword', 'count') or self.peek('number'):
+            return self.number()
+        start = self.position
+        nodeid = self.set_expression()
+        self.plan.uses[nodeid] += 1
+        tokens = self.tokens[start:self.position]
+        if len(tokens) == 1 and self.is_tagset(tokens[0][1]):
+            # A tag set is listed under its heading, as --list-tags does
+            title = None
+        else:
+            title = " ".join(str(t[1]) for t in tokens).replace("( ", "(").replace(" )", ")")
+        return ('set', nodeid, title)
+
+    # Sets
+
+    def set_expression(self, level = 0):
+        if level == len(SET_OPERATORS):
+            return self.set_atom()
+        op, method = SET_OPERATORS[level]
+        left = self.set_expression(level + 1)
+        while self.accept('op', op):
+            right = self.set_expression(level + 1)
+            left = self.plan.node(method, left, right)
+        return left
+
+    def set_atom(self):
+        if self.accept('op', '('):
+            nodeid = self.set_expression()
+            self.expect('op', ')')
+            return nodeid
+        name = self.expect('name')[1]
+        if name in self.plan.names:
+            return self.plan.names[name]
+        if not self.is_tagset(name):
+            raise self.error("unknown tag set %s" % name)
+        return self.plan.node('tagset', name)
+
+    def set_argument(self):
+        nodeid = self.set_expression()
+        self.plan.uses[nodeid] += 1
+        return nodeid
+
+    # Numbers
+
+    def number(self):
+        left = self.term()
+        while self.peek('op', '+') or self.peek('op', '-'):
+            op = self.expect('op')[1]
+            left = ('arithmetic', op, left, self.term())
+        return left
+
+    def term(self):
+        left = self.factor()
+        while self.peek('op', '*') or self.peek('op', '/'):
+            op = self.expect('op')[1]
+            left = ('arithmetic', op, left, self.factor())
+        return left
+
+    def factor(self):
+        token = self.accept('number')
+        if token is not None:
+            return ('number', token[1])
+        if self.accept('op', '-'):
+            return ('arithmetic', '-', ('number', 0), self.factor())
+        if self.accept('keyword', 'count'):
+            self.expect('op', '(')
+            nodeid = self.set_argument()
+            self.expect('op', ')')
+            return ('count', nodeid)
+        self.expect('op', '(')
+        value = self.number()
+        self.expect('op', ')')
+        return value
+
+    # Conditions
+
+    def condition(self):
+        left = self.conjunction()
+        while self.accept('keyword', 'or'):
+            left = ('or', left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept('keyword', 'and'):
+            left = ('and', left, self.negation())
+        return left
+
+    def negation(self):
+        if self.accept('keyword', 'not'):
+            return ('not', self.negation())
+        for function in ('empty', 'unique'):
+            if self.accept('keyword', function):
+                self.expect('op', '(')
+                nodeid = self.set_argument()
+                self.expect('op', ')')
+                return (function, nodeid)
+        if self.accept('keyword', 'contains'):
+            self.expect('op', '(')
+            nodeid = self.set_argument()
+            self.expect('op', ',')
+            tagstr = self.expect('string')[1]
+            self.expect('op', ')')
+            return ('contains', nodeid, tagstr)
+        if self.peek('op', '('):
+            # Either a parenthesised condition or a comparison starting with a
+            # parenthesised number - try the comparison first
+            start = self.position
+            nodes = len(self.plan.nodes)
+            uses = list(self.plan.uses)
+            try:
+                return self.comparison()
+            except ScriptError:
+                self.position = start
+                for node in self.plan.nodes[nodes:]:
+                    del self.plan.node_ids[node]
+                del self.plan.nodes[nodes:]
+                self.plan.uses[:] = uses
+            self.expect('op', '(')
+            condition = self.condition()
+            self.expect('op', ')')
+            return condition
+        return self.comparison()
+
+    def comparison(self):
+        left = self.number()
+        token = self.tokens[self.position]
+        if token[0] != 'op' or token[1] not in COMPARISONS:
+            raise self.error("expected a comparison")
+        self.position += 1
+        return ('compare', token[1], left, self.number())
+
+# Compiles the text of a script. tagset_names are the names of the tag sets it can
+# refer to; with None, any name that isn't assigned is taken to be a tag set, to be
+# checked when the plan is run.
+def compile_script(text, tagset_names = None, filename = "<script>"):
+    plan = QueryPlan(filename)
+    names = None if tagset_names is None else frozenset(tagset_names)
+    for linenumber, line in enumerate(text.splitlines(), 1):
+        tokens = tokenize(line, filename, linenumber)
+        _Parser(plan, names, tokens, linenumber).statement()
+    logger.info("Compiled %r" % plan)
+    return plan
+
+def compile_file(filename, tagset_names = None):
+    with open(filename) as f:
+        return compile_script(f.read(), tagset_names, filename)
@@ -0,0 +1,140 @@
+import contextlib
+import signal
+import threading
+import time
+
+# Raised when a single application of a regex takes longer than the budget
+class RegexBudgetExceeded(Exception):
+    def __init__(self, tagset, regex, path, linenumber, budget):
+        super().__init__(tagset, regex, path, linenumber, budget)
+        self.tagset = tagset
+        self.regex = regex
+        self.path = path
+        self.linenumber = linenumber
+        self.budget = budget
+
+    def __str__(self):
+        where = self.path if self.linenumber is None else "%s:%i" % (self.path, self.linenumber)
+        return "regex %r of tagset '%s' took longer than its budget of %gs matching %s" % (
+            self.regex, self.tagset, self.budget, where)
+
+class _BudgetAlarm(Exception):
+    pass
+
+def _raise_alarm(signum, frame):
+    raise _BudgetAlarm()
+
+def matcher_name(matcher):
+    return getattr(matcher, 'name', matcher.regex)
+
+# Per-regex profile of a search.
+#
+# When grep_file is given a profile, each matcher's regex is applied on its own
+# (rather than through the combined prescan) so that its cost can be measured:
+# the time spent in it, how often it was applied, the lines and bytes it was
+# applied to and the matches it found, as well as the total regex time per file.
+#
+# With a budget, any single application of a regex - to a line, or to a whole file
+# in whole-file mode - that takes more than budget seconds raises
+# RegexBudgetExceeded. In the main thread of a process, on platforms with interval
+# timers, a runaway match is interrupted when the budget runs out (the regex engine
+# checks for signals while matching); elsewhere it's only detected once it finishes.
+class RegexProfile:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "budget=%r, regexes=%i, files=%i" % (self.budget, len(self.regexes), len(self.files))
+
+    def __init__(self, budget = None):
+        self.budget = budget
+        # (tagset name, regex) -> [seconds, applications, lines, bytes, matches]
+        self.regexes = {}
+        # path -> seconds
+        self.files = {}
+        self._alarm = False
+
+    # Enables interrupting runaway matches for the duration, where that's possible
+    @contextlib.contextmanager
+    def budget_alarm(self):
+        if (self.budget is None or self._alarm or not hasattr(signal, 'setitimer')
+            or threading.current_thread() is not threading.main_thread()):
+            yield
+            return
+        previous = signal.signal(signal.SIGALRM, _raise_alarm)
+        self._alarm = True
+        try:
+            yield
+        finally:
+            self._alarm = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    # Applies function(*args) - an application of matcher's regex to nbytes bytes
+    # over lines lines of path - timing it and checking it against the budget.
+    # Returns function's result, which must be the list of matches found.
+    def run(self, matcher, path, linenumber, nbytes, lines, function, *args):
+        alarm = self._alarm
+        start = time.perf_counter()
+        try:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, self.budget)
+            result = function(*args)
+        except _BudgetAlarm:
+            raise RegexBudgetExceeded(matcher_name(matcher), matcher.regex, path, linenumber, self.budget) from None
+        finally:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        elapsed = time.perf_counter() - start
+        if self.budget is not None and elapsed > self.budget:
+            raise RegexBudgetExceeded(matcher_name(matcher), matcher.regex, path, linenumber, self.budget)
+
+        key = (matcher_name(matcher), matcher.regex)
+        entry = self.regexes.get(key)
+        if entry is None:
+            entry = self.regexes[key] = [0.0, 0, 0, 0, 0]
+        entry[0] += elapsed
+        entry[1] += 1
+        entry[2] += lines
+        entry[3] += nbytes
+        entry[4] += len(result)
+        self.files[path] = self.files.get(path, 0.0) + elapsed
+        return result
+
+    # The data collected, and adding data collected elsewhere (e.g. by a worker process)
+    def data(self):
+        return self.regexes, self.files
+
+    def add_data(self, data):
+        regexes, files = data
+        for key, values in regexes.items():
+            entry = self.regexes.get(key)
+            if entry is None:
+                self.regexes[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    entry[i] += value
+        for path, seconds in files.items():
+            self.files[path] = self.files.get(path, 0.0) + seconds
+
+    def worst_regexes(self, count = 10):
+        return sorted(self.regexes.items(), key=lambda item: -item[1][0])[:count]
+
+    def worst_files(self, count = 10):
+        return sorted(self.files.items(), key=lambda item: -item[1])[:count]
+
+    def format(self, count = 10):
+        lines = ["Slowest regexes", "==============="]
+        lines.append("%10s %10s %10s %12s %8s  %s" % ("time (s)", "applied", "lines", "bytes", "matches", "tagset: regex"))
+        for (name, regex), (seconds, applications, nlines, nbytes, matches) in self.worst_regexes(count):
+            lines.append("%10.4f %10i %10i %12i %8i  %s: %s" % (seconds, applications, nlines, nbytes, matches, name, regex))
+        lines.append("")
+        lines.append("Slowest files")
+        lines.append("=============")
+        for path, seconds in self.worst_files(count):
+            lines.append("%10.4f  %s" % (seconds, path))
+        return "\n".join(lines)
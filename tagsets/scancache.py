@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import pickle
+
+logger = logging.getLogger(__name__)
+
+# Persistent cache of the matches found in each file, so that unchanged files don't
+# need to be grepped again on the next run.
+#
+# Each file's entry holds the file's identity (size, mtime_ns, inode) and the matches
+# found by each regex, keyed by a signature of the regex, its encoding and the grep
+# options that affect its results. Changing one tagset's regex therefore only invalidates that
+# tagset's matches - files are only re-grepped with the matchers whose signatures
+# aren't already in the entry.
+class ScanCache:
+    VERSION = 1
+
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "filename=%r, entries=%i" % (self.filename, len(self.entries))
+
+    def __init__(self, filename, grep_options = None):
+        self.filename = filename
+        self.options = sorted((grep_options or {}).items())
+        # path -> (identity, {signature: [(captured text, line number), ...]})
+        self.entries = {}
+        # The entries for the files seen in this run - only these are saved
+        self.current = {}
+        self.signatures = {}
+
+    @classmethod
+    def load(cls, filename, grep_options = None):
+        cache = cls(filename, grep_options)
+        try:
+            with open(filename, 'rb') as f:
+                version, entries = pickle.load(f)
+        except FileNotFoundError:
+            return cache
+        except Exception as e:
+            logger.warning("Ignoring unreadable scan cache %s: %s" % (filename, e))
+            return cache
+        if version == cls.VERSION:
+            cache.entries = entries
+        logger.info("Loaded scan cache %s with %i files" % (filename, len(cache.entries)))
+        return cache
+
+    def save(self):
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, 'wb') as f:
+            pickle.dump( (self.VERSION, self.current), f, pickle.HIGHEST_PROTOCOL )
+        os.replace(tmpname, self.filename)
+        logger.info("Saved scan cache %s with %i files" % (self.filename, len(self.current)))
+
+    def signature(self, matcher):
+        signature = self.signatures.get(id(matcher))
+        if signature is None:
+            key = repr( (matcher.regex, matcher.encoding, matcher.errors, self.options) ).encode('utf-8')
+            signature = self.signatures[id(matcher)] = hashlib.sha1(key).hexdigest()
+        return signature
+
+    @staticmethod
+    def identity(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    # Returns the cached matches for the matchers that have them, as a list of
+    # (matcher, [(captured text, line number), ...]), and the list of matchers that
+    # still need to be grepped. Their matches should then be passed to record().
+    def lookup(self, path, st, matchers):
+        identity = self.identity(st)
+        # The file may have changed since it was last seen in this run, e.g. in watch mode
+        entry = self.current.get(path)
+        if entry is None:
+            entry = self.entries.pop(path, None)
+        if entry is None or entry[0] != identity:
+            entry = (identity, {})
+        self.current[path] = entry
+
+        results = entry[1]
+        cached = []
+        missing = []
+        for matcher in matchers:
+            matches = results.get(self.signature(matcher))
+            if matches is None:
+                results[self.signature(matcher)] = []
+                missing.append(matcher)
+            else:
+                cached.append( (matcher, matches) )
+        return cached, missing
+
+    def record(self, path, matcher, captured_text, linenumber):
+        entry = self.current.get(path)
+        if entry is not None:
+            matches = entry[1].get(self.signature(matcher))
+            if matches is not None:
+                matches.append( (captured_text, linenumber) )
@@ -1,8 +1,11 @@
 
-from termcolor import colored
-
 # Script commands
 
+# termcolor is only imported when a script prints something, to keep startup fast
+def colored(text, color):
+    import termcolor
+    return termcolor.colored(text, color)
+
 def require(description, assertion):
     print("%s : %s" % (description, colored("pass", 'green') if assertion else colored("FAIL", 'red')))
 
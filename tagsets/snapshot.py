@@ -0,0 +1,172 @@
+import array
+import logging
+import os
+import struct
+import sys
+
+import tagsets.tagset
+from tagsets.tagset import Tag, TagSet
+
+logger = logging.getLogger(__name__)
+
+# Snapshots of the tag sets found by a search, so that scripts can be run against
+# the same search again and again without repeating it.
+#
+# The format is compact and quick to load: every string - tag set names, filenames
+# and tag strings - is stored once, in a string table, and each tag is three
+# integers (tag string, filename and line number) stored as arrays, one per tag set:
+#
+#   header      magic, version, number of strings, number of tuples, number of tag sets
+#   strings     the length of each string in bytes, then all the strings (UTF-8)
+#   tuples      tags captured by regexes with several groups are tuples of strings;
+#               for each, its length and then its strings' numbers
+#   tag sets    the numbers of the name, singular and plural strings and the number
+#               of tags, then the tags' tag strings, filenames and line numbers
+#
+# Integers are unsigned 32 bit little-endian. A tag string number with the top bit
+# set is the number of a tuple.
+
+class SnapshotError(Exception):
+    pass
+
+MAGIC = b'TAGSNAP\0'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sIIII')
+_TAGSET = struct.Struct('<IIII')
+_UINT32 = struct.Struct('<I')
+_TUPLE = 0x80000000
+
+def _uint32s(values = ()):
+    return array.array('I', values)
+
+def _to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _from_bytes(data, offset, count):
+    values = _uint32s()
+    end = offset + count * values.itemsize
+    if end > len(data):
+        raise SnapshotError("snapshot is truncated")
+    values.frombytes(data[offset:end])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, end
+
+class _StringTable:
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+        self.tuples = []
+        self.tuple_ids = {}
+
+    def intern(self, string):
+        stringid = self.ids.get(string)
+        if stringid is None:
+            stringid = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return stringid
+
+    def intern_tagstr(self, tagstr):
+        if type(tagstr) is not tuple:
+            return self.intern(tagstr)
+        tupleid = self.tuple_ids.get(tagstr)
+        if tupleid is None:
+            tupleid = self.tuple_ids[tagstr] = len(self.tuples)
+            self.tuples.append( tuple(self.intern(s) for s in tagstr) )
+        return tupleid | _TUPLE
+
+# Writes the tag sets (TagSets or expressions) to filename
+def save(filename, tagsets):
+    table = _StringTable()
+    bodies = []
+    for ts in tagsets:
+        tags = ts.tags
+        fileids = {}
+        tagstrs = _uint32s(table.intern_tagstr(t.tagstr) for t in tags)
+        filenames = _uint32s()
+        for t in tags:
+            # Tags only hold the number of their file in the run's file table
+            stringid = fileids.get(t.fileid)
+            if stringid is None:
+                stringid = fileids[t.fileid] = table.intern(t.filename)
+            filenames.append(stringid)
+        linenumbers = _uint32s(t.linenumber for t in tags)
+        heading = _TAGSET.pack(table.intern(ts.name), table.intern(ts.singular), table.intern(ts.plural), len(tags))
+        bodies.append( (heading, tagstrs, filenames, linenumbers) )
+
+    encoded = [ s.encode('utf-8', 'surrogateescape') for s in table.strings ]
+    tmpname = filename + ".tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(encoded), len(table.tuples), len(bodies)))
+        f.write(_to_bytes(_uint32s(len(s) for s in encoded)))
+        f.write(b''.join(encoded))
+        for t in table.tuples:
+            f.write(_to_bytes(_uint32s((len(t),) + t)))
+        for heading, tagstrs, filenames, linenumbers in bodies:
+            f.write(heading)
+            f.write(_to_bytes(tagstrs))
+            f.write(_to_bytes(filenames))
+            f.write(_to_bytes(linenumbers))
+    os.replace(tmpname, filename)
+    logger.info("Saved snapshot %s with %i tag sets and %i strings" % (filename, len(bodies), len(encoded)))
+
+# Reads the tag sets saved in filename, returning a list of TagSets in the order
+# they were saved
+def load(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise SnapshotError("%s is not a tag set snapshot" % filename)
+    magic, version, nstrings, ntuples, ntagsets = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise SnapshotError("%s is not a tag set snapshot" % filename)
+    if version != VERSION:
+        raise SnapshotError("%s is a version %i snapshot - only version %i is supported" % (filename, version, VERSION))
+
+    try:
+        lengths, offset = _from_bytes(data, _HEADER.size, nstrings)
+        strings = []
+        for length in lengths:
+            end = offset + length
+            strings.append(sys.intern(data[offset:end].decode('utf-8', 'surrogateescape')))
+            offset = end
+        if offset > len(data):
+            raise SnapshotError("snapshot is truncated")
+
+        tuples = []
+        for _ in range(ntuples):
+            length = _UINT32.unpack_from(data, offset)[0]
+            ids, offset = _from_bytes(data, offset + _UINT32.size, length)
+            tuples.append( tuple(strings[i] for i in ids) )
+
+        loaded = []
+        new_tag = Tag.__new__
+        files = tagsets.tagset.FILES
+        fileids = {}
+        for _ in range(ntagsets):
+            name, singular, plural, ntags = _TAGSET.unpack_from(data, offset)
+            tagstrs, offset = _from_bytes(data, offset + _TAGSET.size, ntags)
+            filenames, offset = _from_bytes(data, offset, ntags)
+            linenumbers, offset = _from_bytes(data, offset, ntags)
+
+            ts = TagSet(strings[name], strings[singular], strings[plural])
+            for tagstr, stringid, linenumber in zip(tagstrs, filenames, linenumbers):
+                # The tags are built directly, interning each filename only once
+                fileid = fileids.get(stringid)
+                if fileid is None:
+                    fileid = fileids[stringid] = files.intern(strings[stringid])
+                tag = new_tag(Tag)
+                tag.tagstr = tuples[tagstr & ~_TUPLE] if tagstr & _TUPLE else strings[tagstr]
+                tag.fileid = fileid
+                tag.linenumber = linenumber
+                ts.add_tag(tag)
+            loaded.append(ts)
+    except (struct.error, IndexError) as e:
+        raise SnapshotError("%s is corrupt: %s" % (filename, e))
+
+    logger.info("Loaded snapshot %s with %i tag sets" % (filename, len(loaded)))
+    return loaded
@@ -0,0 +1,103 @@
+import contextlib
+import json
+import time
+
+# Counters and phase timings for a search.
+#
+# Collecting stats is optional - the walkers, grepper and visitors take a Stats
+# object (or None) and only do the extra bookkeeping when they've been given one.
+#
+# Phases may be nested, and each phase's time excludes the time spent in the
+# phases nested within it; e.g. with sequential grepping, files are grepped during
+# the walk, and the time taken to grep them is counted as 'grep' rather than 'walk'.
+class Stats:
+    COUNTERS = (
+        'directories',       # directories visited by the walk
+        'files_considered',  # files listed in directories some matcher is interested in
+        'files_accepted',    # files that some matcher is interested in
+        'files_cached',      # accepted files whose matches were all replayed from the scan cache
+        'files_binary',      # files skipped because they look like binary files
+        'files_grepped',     # files read and searched for tags
+        'bytes_read',
+        'lines_scanned',     # lines the regexes were applied to
+    )
+
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "%r" % self.as_dict()
+
+    def __init__(self):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        # tagset name -> number of tags found
+        self.matches = {}
+        # phase name -> seconds
+        self.phases = {}
+        # Time spent in nested phases, for each phase in progress
+        self._nested = []
+
+    def count_match(self, tagset_name):
+        self.matches[tagset_name] = self.matches.get(tagset_name, 0) + 1
+
+    def counts(self):
+        return dict( (counter, getattr(self, counter)) for counter in self.COUNTERS )
+
+    # Adds counts collected elsewhere, e.g. by a worker process
+    def add_counts(self, counts):
+        for counter, value in counts.items():
+            setattr(self, counter, getattr(self, counter) + value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def as_dict(self):
+        return {
+            'counts': self.counts(),
+            'matches': dict(self.matches),
+            'phases': dict(self.phases),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def format(self):
+        lines = ["Search statistics", "================="]
+        for counter in self.COUNTERS:
+            lines.append("%-20s %12i" % (counter.replace('_', ' '), getattr(self, counter)))
+        if self.matches:
+            lines.append("")
+            lines.append("Tags found")
+            for name in sorted(self.matches):
+                lines.append("  %-18s %12i" % (name, self.matches[name]))
+        if self.phases:
+            lines.append("")
+            lines.append("Time (seconds)")
+            for name, seconds in self.phases.items():
+                lines.append("  %-18s %12.3f" % (name, seconds))
+        return "\n".join(lines)
+
+@contextlib.contextmanager
+def _untimed():
+    yield
+
+# Times a phase if stats are being collected
+def phase(stats, name):
+    if stats is None:
+        return _untimed()
+    return stats.phase(name)
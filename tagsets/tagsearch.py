@@ -1,8 +1,12 @@
+import collections
+import os
+
 import tagsets.tagset
 import tagsets.filefinder
 import tagsets.filegrepper
+import tagsets.stats
 
-from tagsets.filegrepper import grep_file
+from tagsets.filegrepper import grep_file, grep_files
 
 class TagFileMatcher(tagsets.filefinder.FileMatcher):
     def repr_detail(self):
@@ -24,10 +28,10 @@ class TagTextMatcher(tagsets.filegrepper.TextMatcher):
         )
 
     def repr_detail(self):
-        return "%r, %r" % (self.name, self.regex)
+        return "%r, %r, encoding=%r, errors=%r" % (self.name, self.regex, self.encoding, self.errors)
 
-    def __init__(self, name, regex):
-        super().__init__(regex)
+    def __init__(self, name, regex, encoding = None, errors = None):
+        super().__init__(regex, encoding, errors)
         self.name = name
 
 class TagMatcherVisitor(tagsets.filefinder.FileMatchVisitor,
@@ -42,18 +46,158 @@ class TagMatcherVisitor(tagsets.filefinder.FileMatchVisitor,
     def repr_detail(self):
         return "%r" % self.tsmap
 
-    def __init__(self, tsmap):
+    # With jobs > 1, visiting files only records work items, which are grepped by
+    # a pool of processes when finish() is called.
+    # grep_options are keyword arguments for grep_file.
+    # With a ScanCache, the matches of unchanged files are replayed from the cache
+    # and only new or changed files are grepped. With jobs > 1, the replays are
+    # queued with the work items, so that every tag is added in the order the files
+    # were visited.
+    # With a tagsets.stats.Stats, the files grepped and tags found are counted, and
+    # the time spent grepping is timed as the 'grep' phase.
+    # With a tagsets.regexprofile.RegexProfile, each regex is timed separately.
+    # on_tag is called with each tag set and tag as the tag is found; with keep_tags
+    # false, the tags are only passed to on_tag and not added to the tag sets.
+    def __init__(self, tsmap, jobs = 1, grep_options = None, cache = None, stats = None, profile = None,
+                 on_tag = None, keep_tags = True):
         self.tsmap = tsmap
+        self.jobs = jobs
+        self.grep_options = grep_options or {}
+        self.cache = cache
+        self.stats = stats
+        self.profile = profile
+        self.on_tag = on_tag
+        self.keep_tags = keep_tags
+        self.workitems = []
+        # (number of work items queued before it, filename, cached matches)
+        self.replays = []
 
-    def visit_file(self, filename, filematchers):
-        textmatchers = set()
+    def textmatchers_for(self, filematchers):
+        textmatchers = []
         for filematcher in filematchers:
-            textmatchers.add(filematcher.textmatcher)
-        grep_file(filename, textmatchers, self)
+            if filematcher.textmatcher not in textmatchers:
+                textmatchers.append(filematcher.textmatcher)
+        return textmatchers
+
+    # st is the file's stat result, if the walker already has it
+    def visit_file(self, filename, filematchers, st = None):
+        textmatchers = self.textmatchers_for(filematchers)
+
+        if self.cache is not None:
+            if st is None:
+                st = os.stat(filename)
+            cached, textmatchers = self.cache.lookup(filename, st, textmatchers)
+            if self.jobs > 1:
+                if cached:
+                    self.replays.append( (len(self.workitems), filename, cached) )
+            else:
+                self.replay(filename, cached)
+            if not textmatchers:
+                if self.stats is not None:
+                    self.stats.files_cached += 1
+                return
+
+        if self.jobs > 1:
+            self.workitems.append( (filename, textmatchers, st.st_size if st else None) )
+        elif self.stats is None:
+            grep_file(filename, textmatchers, self, profile=self.profile, **self.grep_options)
+        else:
+            with self.stats.phase('grep'):
+                grep_file(filename, textmatchers, self, stats=self.stats, profile=self.profile, **self.grep_options)
+
+    def visit_entry(self, entry, filematchers):
+        st = None
+        if self.jobs > 1 or self.cache is not None:
+            try:
+                st = entry.stat()
+            except OSError:
+                pass
+        self.visit_file(entry.path, filematchers, st)
+
+    def replay(self, filename, cached):
+        for matcher, matches in cached:
+            for captured_text, linenumber in matches:
+                self.add_tag(captured_text, filename, linenumber, matcher)
+
+    def finish(self):
+        workitems, self.workitems = self.workitems, []
+        replays, self.replays = collections.deque(self.replays), []
+        # Replays the cached matches of the files visited before the work item
+        def replay_before(item):
+            while replays and replays[0][0] <= item:
+                _, filename, cached = replays.popleft()
+                self.replay(filename, cached)
+
+        if workitems:
+            with tagsets.stats.phase(self.stats, 'grep'):
+                grep_files(workitems, self, self.jobs, self.grep_options, self.stats, self.profile,
+                           on_item = replay_before)
+        replay_before(len(workitems))
 
     def visit_match(self, captured_text, filename, linenumber, matcher):
+        self.add_tag(captured_text, filename, linenumber, matcher)
+        if self.cache is not None:
+            self.cache.record(filename, matcher, captured_text, linenumber)
+
+    def add_tag(self, captured_text, filename, linenumber, matcher):
         t = tagsets.tagset.Tag(captured_text, filename, linenumber)
-        self.tsmap[matcher.name].add_tag(t)
+        ts = self.tsmap[matcher.name]
+        if self.keep_tags:
+            ts.add_tag(t)
+        if self.on_tag is not None:
+            self.on_tag(ts, t)
+        if self.stats is not None:
+            self.stats.count_match(matcher.name)
+
+class SearchResult:
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "tagsets=%r, stats=%r" % (self.tagsets, self.stats)
+
+    def __init__(self, matchers, tagsets, grepper, stats, profile = None):
+        self.matchers = matchers
+        self.tagsets = tagsets
+        self.tsmap = dict([ (ts.name, ts) for ts in tagsets ])
+        self.grepper = grepper
+        self.stats = stats
+        self.profile = profile
+
+# Searches for the tags of a loaded tagsets.config.Config.
+# Pass a tagsets.stats.Stats to have the search counted and timed, and a
+# tagsets.regexprofile.RegexProfile to have each regex timed - they're available as
+# the result's stats and profile afterwards.
+# on_tag and keep_tags are as for TagMatcherVisitor.
+# With tagsets.pipeline.PipelineOptions, the files are walked, read and grepped
+# concurrently by the asynchronous pipeline, rather than with jobs processes.
+# walker_options are passed to the walker engine.
+# With a tagsets.tagstore.SqliteTagStore, the tags are stored in it rather than
+# in memory.
+def search_tagsets(config, engine = 'walk', jobs = 1, grep_options = None, cache = None, stats = None,
+                   profile = None, on_tag = None, keep_tags = True, pipeline = None, walker_options = None,
+                   store = None):
+    matchers = config.build_matchers()
+    tss = config.get_initial_tagsets(store)
+    tsmap = dict([ (ts.name, ts) for ts in tss ])
+
+    grepper = TagMatcherVisitor(tsmap, jobs, grep_options, cache, stats, profile, on_tag, keep_tags)
+    if pipeline is not None:
+        with tagsets.stats.phase(stats, 'pipeline'):
+            from tagsets.pipeline import search as pipeline_search
+            pipeline_search(grepper, matchers, engine, pipeline, stats, walker_options)
+    else:
+        with tagsets.stats.phase(stats, 'walk'):
+            tagsets.filefinder.search_paths(grepper, matchers, engine, stats, walker_options)
+        grepper.finish()
+    if store is not None:
+        store.flush()
+
+    return SearchResult(matchers, tss, grepper, stats, profile)
 
 # TODO - I should probably consider recording paths relative to some specified base path
 
@@ -1,8 +1,32 @@
 import logging
+import os
+import sys
+import weakref
 
 logger = logging.getLogger(__name__)
 
+# Table of the filenames that tags have been found in, shared by all the tags in a
+# run, so that each filename is only stored once and tags only hold a small integer
+class FileTable():
+    def __init__(self):
+        self.filenames = []
+        self.fileids = {}
+
+    def intern(self, filename):
+        fileid = self.fileids.get(filename)
+        if fileid is None:
+            fileid = self.fileids[filename] = len(self.filenames)
+            self.filenames.append(filename)
+        return fileid
+
+    def __len__(self):
+        return len(self.filenames)
+
+FILES = FileTable()
+
 class Tag():
+    __slots__ = ('tagstr', 'fileid', 'linenumber')
+
     def __repr__(self):
         return "<%s at %s>(%s)" % (
             self.__class__.__name__,
@@ -18,11 +42,40 @@ class Tag():
         )
 
     def __init__(self, tagstr, filename, linenumber):
-        self.tagstr = tagstr
-        self.filename = filename
+        self.tagstr = sys.intern(tagstr) if type(tagstr) is str else tagstr
+        self.fileid = FILES.intern(filename)
         self.linenumber = linenumber
 
-class TagSet():
+    # File ids are only meaningful within a run, so tags are pickled with their filename
+    def __reduce__(self):
+        return (self.__class__, (self.tagstr, self.filename, self.linenumber))
+
+    @property
+    def filename(self):
+        return FILES.filenames[self.fileid]
+
+    @filename.setter
+    def filename(self, filename):
+        self.fileid = FILES.intern(filename)
+
+def summary_heading(plural):
+    return "%s\n%s\n" % (plural, '=' * len(plural))
+
+def format_tag(tag):
+    return "%s:%s : %s\n" % (tag.filename, tag.linenumber, tag.tagstr)
+
+# Set operations
+#
+# Membership of a tag set is defined by tag string. Operations keep the tags (not
+# just the strings) of their operands:
+#   a & b  (intersection)          the tags of a whose string is in b
+#   a - b  (minus)                 the tags of a whose string isn't in b
+#   a | b  (union)                 the tags of a, followed by the tags of b
+#   a ^ b  (symmetric_difference)  (a - b) | (b - a)
+#
+# Operations don't calculate anything - they build a TagSetExpression, which is only
+# evaluated when its contents are needed.
+class TagSetBase():
     def __repr__(self):
         return "<%s at %s>(%s)" % (
             self.__class__.__name__,
@@ -30,6 +83,27 @@ class TagSet():
             self.repr_detail()
         )
 
+    def __iter__(self):
+        return iter(self.tags)
+
+    def intersection(self, otherset):
+        return TagSetExpression.create('intersection', self, otherset)
+
+    def minus(self, otherset):
+        return TagSetExpression.create('minus', self, otherset)
+
+    def union(self, otherset):
+        return TagSetExpression.create('union', self, otherset)
+
+    def symmetric_difference(self, otherset):
+        return TagSetExpression.create('symmetric_difference', self, otherset)
+
+    __and__ = intersection
+    __sub__ = minus
+    __or__ = union
+    __xor__ = symmetric_difference
+
+class TagSet(TagSetBase):
     def repr_detail(self):
         return "name=%r, singular=%r, plural=%r, tags=%r" % (
             self.name,
@@ -43,47 +117,192 @@ class TagSet():
         self.singular = singular
         self.plural = plural
         self.tags = []
+        # tag string -> the tags with that string, in the order they were added
+        self.tags_by_str = {}
+        # Changes whenever tags are added or removed
+        self.version = 0
 
     def add_tag(self, tag):
         self.tags.append(tag)
+        occurrences = self.tags_by_str.get(tag.tagstr)
+        if occurrences is None:
+            self.tags_by_str[tag.tagstr] = [tag]
+        else:
+            occurrences.append(tag)
+        self.version += 1
+
+    # Removes the tags found in a file, or in any file below a directory
+    def discard_tags_from(self, path):
+        below = path.rstrip(os.sep) + os.sep
+        tags = self.tags
+        self.tags = []
+        self.tags_by_str = {}
+        for t in tags:
+            if t.filename != path and not t.filename.startswith(below):
+                self.add_tag(t)
+        self.version += 1
 
-    def print_summary(self):
-        print(self.plural)
-        print('=' * len(self.plural))
-        for tag in self.tags:
-            print("%s:%s : %s" % (tag.filename, tag.linenumber, tag.tagstr))
+    # out is any file-like object with write() and writelines() - by default stdout
+    def print_summary(self, out = None):
+        if out is None:
+            out = sys.stdout
+        out.write(summary_heading(self.plural))
+        out.writelines(format_tag(tag) for tag in self.tags)
 
     def count(self):
         return len(self.tags)
 
     def contains(self, tag):
-        for t in self.tags:
-            if t.tagstr == tag.tagstr:
-                return True
-        return False
+        return tag.tagstr in self.tags_by_str
 
     def is_empty(self):
         return (self.count() == 0)
 
-    # TODO There MUST be a more pythonic way to write these functions!
-
     def contains_no_duplicates(self):
-        for t1 in self.tags:
-            for t2 in self.tags:
-                if t1.tagstr == t2.tagstr and t1 != t2:
-                    return False
+        # The same tag object added twice doesn't count as a duplicate
+        for occurrences in self.tags_by_str.values():
+            if len(occurrences) > 1 and len(set(map(id, occurrences))) > 1:
+                return False
         return True
 
-    def intersection(self, otherset):
-        newset = TagSet("<calculated>", self.singular, self.plural)
-        for tag in self.tags:
-            if otherset.contains(tag):
-                newset.add_tag(tag)
-        return newset
+    def evaluate(self):
+        return self
 
-    def minus(self, otherset):
-        newset = TagSet("<calculated>", self.singular, self.plural)
-        for tag in self.tags:
-            if not otherset.contains(tag):
-                newset.add_tag(tag)
-        return newset
+    def estimated_count(self):
+        return self.count()
+
+    def versions(self):
+        return ( (id(self), self.version), )
+
+# A lazily evaluated set operation.
+#
+# Expressions are only evaluated when their contents are needed, and the result is
+# kept until one of the underlying tag sets changes. Identical expressions are the
+# same object, so a subexpression shared between several expressions is only
+# evaluated once. Chains of the same operation are evaluated together, starting
+# from the operands estimated to be smallest.
+class TagSetExpression(TagSetBase):
+    name = "<calculated>"
+
+    def repr_detail(self):
+        return "%s, %r, %r" % (self.operation, self.left, self.right)
+
+    _expressions = weakref.WeakValueDictionary()
+
+    @classmethod
+    def create(cls, operation, left, right):
+        key = (operation, id(left), id(right))
+        expression = cls._expressions.get(key)
+        if expression is None:
+            expression = cls._expressions[key] = cls(operation, left, right)
+        return expression
+
+    def __init__(self, operation, left, right):
+        self.operation = operation
+        self.left = left
+        self.right = right
+        self.singular = left.singular
+        self.plural = left.plural
+        self._result = None
+        self._versions = None
+
+    # Reading the result
+
+    @property
+    def tags(self):
+        return self.evaluate().tags
+
+    @property
+    def tags_by_str(self):
+        return self.evaluate().tags_by_str
+
+    def print_summary(self, out = None):
+        self.evaluate().print_summary(out)
+
+    def count(self):
+        return self.evaluate().count()
+
+    def contains(self, tag):
+        return self.evaluate().contains(tag)
+
+    def is_empty(self):
+        return self.evaluate().is_empty()
+
+    def contains_no_duplicates(self):
+        return self.evaluate().contains_no_duplicates()
+
+    # Evaluation
+
+    def versions(self):
+        return self.left.versions() + self.right.versions()
+
+    def estimated_count(self):
+        if self._result is not None and self._versions == self.versions():
+            return self._result.count()
+        if self.operation == 'intersection':
+            return min(self.left.estimated_count(), self.right.estimated_count())
+        if self.operation == 'minus':
+            return self.left.estimated_count()
+        return self.left.estimated_count() + self.right.estimated_count()
+
+    def evaluate(self):
+        versions = self.versions()
+        if self._result is None or self._versions != versions:
+            self._result = TagSet(self.name, self.singular, self.plural)
+            for tag in getattr(self, '_evaluate_' + self.operation)():
+                self._result.add_tag(tag)
+            self._versions = versions
+        return self._result
+
+    def _chain(self):
+        # The leftmost operand and the right hand operands of a chain of this operation
+        operands = []
+        node = self
+        while isinstance(node, TagSetExpression) and node.operation == self.operation:
+            operands.append(node.right)
+            node = node.left
+        operands.reverse()
+        return node, operands
+
+    def _evaluate_intersection(self):
+        base, operands = self._chain()
+        # Narrow down the tag strings from the smallest operand up, stopping as soon
+        # as there are none left - in which case the base isn't needed at all
+        operands.sort(key=lambda operand: operand.estimated_count())
+        strs = None
+        for operand in operands:
+            index = operand.evaluate().tags_by_str
+            if strs is None:
+                strs = set(index)
+            else:
+                strs = set(s for s in strs if s in index)
+            if not strs:
+                return []
+        return [t for t in base.evaluate().tags if t.tagstr in strs]
+
+    def _evaluate_minus(self):
+        base, operands = self._chain()
+        tags = base.evaluate().tags
+        for operand in operands:
+            if not tags:
+                break
+            index = operand.evaluate().tags_by_str
+            tags = [t for t in tags if t.tagstr not in index]
+        return tags
+
+    def _evaluate_union(self):
+        base, operands = self._chain()
+        tags = []
+        seen = set()
+        for operand in [base] + operands:
+            for t in operand.evaluate().tags:
+                if id(t) not in seen:
+                    seen.add(id(t))
+                    tags.append(t)
+        return tags
+
+    def _evaluate_symmetric_difference(self):
+        left = self.left.evaluate()
+        right = self.right.evaluate()
+        return ([t for t in left.tags if t.tagstr not in right.tags_by_str] +
+                [t for t in right.tags if t.tagstr not in left.tags_by_str])
@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from tagsets.tagset import Tag, TagSet, TagSetBase, format_tag, summary_heading
+
+logger = logging.getLogger(__name__)
+
+# Tag sets held in an SQLite database rather than in memory, for searches that find
+# more tags than will comfortably fit in memory - and so that the tags can be
+# queried with SQL once the run is over.
+#
+# Tags are added in batches of batch_size, each in a transaction of its own, and
+# reading a tag set flushes any that are pending. Intersections, differences and
+# unions of tag sets in the same store are SQL queries too - views - so that their
+# tags are never all held in memory; combining a stored tag set with an in-memory
+# one falls back to a TagSetExpression, which loads the stored tags.
+#
+# Filenames are stored as bytes, so that any filename can be stored. Tags captured
+# from several groups are tuples, stored as JSON with their number of parts.
+class SqliteTagStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tagsets (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            singular TEXT NOT NULL,
+            plural TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            name BLOB UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            tagset INTEGER NOT NULL REFERENCES tagsets (id),
+            tagstr TEXT NOT NULL,
+            parts INTEGER NOT NULL,
+            file INTEGER NOT NULL REFERENCES files (id),
+            line INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS tags_by_str ON tags (tagset, tagstr);
+        CREATE INDEX IF NOT EXISTS tags_by_file ON tags (file);
+    """
+
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "filename=%r, pending=%i" % (self.filename, len(self.pending))
+
+    def __init__(self, filename, batch_size = 10000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(self.SCHEMA)
+        # filename -> file id
+        self.fileids = dict( (os.fsdecode(name), fileid)
+                             for fileid, name in self.connection.execute("SELECT id, name FROM files") )
+        self.pending = []
+        # Changes whenever tags are added or removed
+        self.version = 0
+
+    # Returns the stored tag set with the given name, emptied
+    def tagset(self, name, singular, plural):
+        self.flush()
+        with self.connection:
+            row = self.connection.execute("SELECT id FROM tagsets WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                tagsetid = self.connection.execute("INSERT INTO tagsets (name, singular, plural) VALUES (?, ?, ?)",
+                                                   (name, singular, plural)).lastrowid
+            else:
+                tagsetid = row[0]
+                self.connection.execute("UPDATE tagsets SET singular = ?, plural = ? WHERE id = ?",
+                                        (singular, plural, tagsetid))
+                self.connection.execute("DELETE FROM tags WHERE tagset = ?", (tagsetid,))
+        self.version += 1
+        return SqliteTagSet(self, tagsetid, name, singular, plural)
+
+    # Returns all of the tag sets in the store, e.g. to query a previous run's results
+    def tagsets(self):
+        self.flush()
+        return [ SqliteTagSet(self, tagsetid, name, singular, plural)
+                 for tagsetid, name, singular, plural
+                 in self.connection.execute("SELECT id, name, singular, plural FROM tagsets ORDER BY id") ]
+
+    def fileid(self, filename):
+        fileid = self.fileids.get(filename)
+        if fileid is None:
+            self.flush()
+            with self.connection:
+                self.connection.execute("INSERT OR IGNORE INTO files (name) VALUES (?)", (os.fsencode(filename),))
+                fileid = self.connection.execute("SELECT id FROM files WHERE name = ?",
+                                                 (os.fsencode(filename),)).fetchone()[0]
+            self.fileids[filename] = fileid
+        return fileid
+
+    def add(self, tagsetid, tag):
+        tagstr = tag.tagstr
+        if type(tagstr) is tuple:
+            row = (tagsetid, json.dumps(tagstr), len(tagstr), self.fileid(tag.filename), tag.linenumber)
+        else:
+            row = (tagsetid, tagstr, 0, self.fileid(tag.filename), tag.linenumber)
+        self.pending.append(row)
+        self.version += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany("INSERT INTO tags (tagset, tagstr, parts, file, line) VALUES (?, ?, ?, ?, ?)",
+                                            self.pending)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Stored %i tags in %s" % (len(self.pending), self.filename))
+            self.pending = []
+
+    def execute(self, sql, parameters = ()):
+        self.flush()
+        return self.connection.execute(sql, parameters)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+def _encode_tagstr(tagstr):
+    return json.dumps(tagstr) if type(tagstr) is tuple else tagstr
+
+# A tag set defined by a query over a store's tags: the tags matching predicate (an
+# SQL expression over the tags table), in the order given by the SQL expressions
+# in order.
+class SqliteTagSetView(TagSetBase):
+    name = "<calculated>"
+
+    def repr_detail(self):
+        return "store=%r, predicate=%r" % (self.store, self.predicate)
+
+    def __init__(self, store, singular, plural, predicate, order):
+        self.store = store
+        self.singular = singular
+        self.plural = plural
+        self.predicate = predicate
+        self.order = order
+        self._result = None
+        self._versions = None
+
+    def __iter__(self):
+        query = ("SELECT tagstr, parts, files.name, line FROM tags JOIN files ON files.id = tags.file WHERE %s ORDER BY %s" %
+                 (self.predicate, ", ".join(self.order)))
+        for tagstr, parts, filename, linenumber in self.store.execute(query):
+            if parts:
+                tagstr = tuple(json.loads(tagstr))
+            yield Tag(tagstr, os.fsdecode(filename), linenumber)
+
+    @property
+    def tags(self):
+        return list(self)
+
+    @property
+    def tags_by_str(self):
+        return self.evaluate().tags_by_str
+
+    # out is any file-like object with write() and writelines() - by default stdout
+    def print_summary(self, out = None):
+        if out is None:
+            out = sys.stdout
+        out.write(summary_heading(self.plural))
+        out.writelines(format_tag(tag) for tag in self)
+
+    def count(self):
+        return self.store.execute("SELECT COUNT(*) FROM tags WHERE %s" % self.predicate).fetchone()[0]
+
+    def contains(self, tag):
+        return self.store.execute("SELECT 1 FROM tags WHERE (%s) AND tagstr = ? LIMIT 1" % self.predicate,
+                                  (_encode_tagstr(tag.tagstr),)).fetchone() is not None
+
+    def is_empty(self):
+        return self.store.execute("SELECT 1 FROM tags WHERE %s LIMIT 1" % self.predicate).fetchone() is None
+
+    def contains_no_duplicates(self):
+        return self.store.execute("SELECT 1 FROM tags WHERE %s GROUP BY tagstr HAVING COUNT(*) > 1 LIMIT 1" %
+                                  self.predicate).fetchone() is None
+
+    # Loads the tags into an in-memory TagSet, for combining with in-memory tag sets
+    def evaluate(self):
+        versions = self.versions()
+        if self._result is None or self._versions != versions:
+            self._result = TagSet(self.name, self.singular, self.plural)
+            for tag in self:
+                self._result.add_tag(tag)
+            self._versions = versions
+        return self._result
+
+    def estimated_count(self):
+        return self.count()
+
+    def versions(self):
+        return ( (id(self.store), self.store.version), )
+
+    # Set operations, with the same results as TagSetExpression's
+
+    def _view_with(self, otherset):
+        return isinstance(otherset, SqliteTagSetView) and otherset.store is self.store
+
+    def intersection(self, otherset):
+        if not self._view_with(otherset):
+            return super().intersection(otherset)
+        return SqliteTagSetView(self.store, self.singular, self.plural,
+                                "(%s) AND tagstr IN (SELECT tagstr FROM tags WHERE %s)" % (self.predicate, otherset.predicate),
+                                self.order)
+
+    def minus(self, otherset):
+        if not self._view_with(otherset):
+            return super().minus(otherset)
+        return SqliteTagSetView(self.store, self.singular, self.plural,
+                                "(%s) AND tagstr NOT IN (SELECT tagstr FROM tags WHERE %s)" % (self.predicate, otherset.predicate),
+                                self.order)
+
+    def union(self, otherset):
+        if not self._view_with(otherset):
+            return super().union(otherset)
+        # This set's tags come first, in their order, then the rest of the other's
+        order = [ "CASE WHEN %s THEN 0 ELSE 1 END" % self.predicate ]
+        for i in range(max(len(self.order), len(otherset.order))):
+            order.append("CASE WHEN %s THEN %s ELSE %s END" % (
+                self.predicate,
+                self.order[i] if i < len(self.order) else "0",
+                otherset.order[i] if i < len(otherset.order) else "0"))
+        return SqliteTagSetView(self.store, self.singular, self.plural,
+                                "(%s) OR (%s)" % (self.predicate, otherset.predicate), order)
+
+    def symmetric_difference(self, otherset):
+        if not self._view_with(otherset):
+            return super().symmetric_difference(otherset)
+        return self.minus(otherset).union(otherset.minus(self))
+
+    __and__ = intersection
+    __sub__ = minus
+    __or__ = union
+    __xor__ = symmetric_difference
+
+# A tag set stored in a SqliteTagStore - see SqliteTagStore.tagset()
+class SqliteTagSet(SqliteTagSetView):
+    def repr_detail(self):
+        return "name=%r, singular=%r, plural=%r, store=%r" % (self.name, self.singular, self.plural, self.store)
+
+    def __init__(self, store, tagsetid, name, singular, plural):
+        super().__init__(store, singular, plural, "tagset = %i" % tagsetid, ["tags.rowid"])
+        self.tagsetid = tagsetid
+        self.name = name
+
+    @property
+    def version(self):
+        return self.store.version
+
+    def add_tag(self, tag):
+        self.store.add(self.tagsetid, tag)
+
+    # Removes the tags found in a file, or in any file below a directory
+    def discard_tags_from(self, path):
+        below = os.fsencode(path.rstrip(os.sep) + os.sep)
+        with self.store.connection:
+            self.store.execute("DELETE FROM tags WHERE tagset = ? AND file IN "
+                               "(SELECT id FROM files WHERE name = ? OR substr(name, 1, ?) = ?)",
+                               (self.tagsetid, os.fsencode(path), len(below), below))
+        self.store.version += 1
@@ -0,0 +1,280 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from abc import ABCMeta, abstractmethod
+
+from tagsets.filefinder import FileMatchVisitor, plan_walk_roots, search_subtree
+from tagsets.matcherindex import MatcherIndex, matchers_of
+
+logger = logging.getLogger(__name__)
+
+# Seconds without further changes before an update is made
+DEBOUNCE = 0.2
+# Seconds between scans by the polling watcher
+POLL_INTERVAL = 1.0
+
+# Watchers
+# ========
+#
+# A watcher reports the paths below the search roots that have changed. wait()
+# blocks for up to timeout seconds (or indefinitely if timeout is None) and returns
+# the set of changed paths - files or directories, which may no longer exist - or
+# an empty set if nothing changed.
+
+class WatcherBase(metaclass=ABCMeta):
+    def __repr__(self):
+        return "<%s at %s>(%s)" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self.repr_detail()
+        )
+
+    def repr_detail(self):
+        return "roots=%r" % self.roots
+
+    def __init__(self, index, roots):
+        self.index = index
+        self.roots = roots
+
+    @abstractmethod
+    def wait(self, timeout = None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class _DirectoryLister(FileMatchVisitor):
+    def __init__(self):
+        self.directories = []
+
+    def visit_directory(self, path):
+        self.directories.append(path)
+
+    def visit_file(self, path, matchers):
+        pass
+
+class _SnapshotTaker(FileMatchVisitor):
+    def __init__(self):
+        self.files = {}
+
+    def visit_file(self, path, matchers):
+        try:
+            self.visit_stat(path, os.stat(path))
+        except OSError:
+            pass
+
+    def visit_entry(self, entry, matchers):
+        try:
+            self.visit_stat(entry.path, entry.stat())
+        except OSError:
+            pass
+
+    def visit_stat(self, path, st):
+        self.files[path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+# Watches for changes by re-scanning the trees and comparing the files' identities
+class PollingWatcher(WatcherBase):
+    def __init__(self, index, roots, interval = POLL_INTERVAL):
+        super().__init__(index, roots)
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        taker = _SnapshotTaker()
+        for root in self.roots:
+            search_subtree(taker, self.index, root, 'scandir')
+        return taker.files
+
+    def poll(self):
+        snapshot = self.take_snapshot()
+        changed = set(path for path, identity in snapshot.items()
+                      if self.snapshot.get(path) != identity)
+        changed |= set(self.snapshot) - set(snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.poll()
+            if changed:
+                return changed
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+class WatcherUnavailable(Exception):
+    pass
+
+# Watches the directories of interest with inotify, through ctypes
+class InotifyWatcher(WatcherBase):
+    def __init__(self, index, roots):
+        super().__init__(index, roots)
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise WatcherUnavailable("inotify is not available: %s" % e)
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherUnavailable("inotify_init1 failed: %s" % os.strerror(ctypes.get_errno()))
+        self.watches = {}
+        for root in roots:
+            self.watch_tree(root)
+
+    def watch_tree(self, path):
+        lister = _DirectoryLister()
+        search_subtree(lister, self.index, path, 'scandir')
+        for directory in lister.directories:
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                logger.warning("Unable to watch %s: %s" % (directory, os.strerror(ctypes.get_errno())))
+            else:
+                self.watches[wd] = directory
+
+    def read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost - everything needs to be looked at again
+                    logger.warning("inotify event queue overflowed")
+                    changed.update(self.roots)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    changed.add(directory)
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+                changed.add(path)
+
+    def wait(self, timeout = None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        return self.read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+def create_watcher(index, roots):
+    try:
+        return InotifyWatcher(index, roots)
+    except WatcherUnavailable as e:
+        logger.info("%s - polling for changes instead" % e)
+        return PollingWatcher(index, roots)
+
+# Updating
+# ========
+
+def _outermost(paths):
+    # The paths that aren't below another of the paths, sorted
+    paths = set(paths)
+    def below_another(path):
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in paths:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+    return sorted(path for path in paths if not below_another(path))
+
+# Keeps tagsets up to date with changes to the files, by discarding the tags found
+# in each changed path and searching it again
+class TagSetUpdater:
+    def __init__(self, matchers, grepper, tagsets, engine = 'walk', walker_options = None):
+        self.index = MatcherIndex(matchers)
+        self.roots = [root for root, _ in plan_walk_roots(matchers)]
+        self.grepper = grepper
+        self.tagsets = tagsets
+        self.engine = engine
+        self.walker_options = walker_options
+
+    def update(self, paths):
+        # Paths below another changed path are searched again with it, so they're
+        # left out rather than searched twice
+        info = logger.isEnabledFor(logging.INFO)
+        for path in _outermost(paths):
+            if info:
+                logger.info("Updating tags from %s" % path)
+            for ts in self.tagsets:
+                ts.discard_tags_from(path)
+
+            if os.path.isdir(path):
+                search_subtree(self.grepper, self.index, path, self.engine, walker_options = self.walker_options)
+            elif os.path.isfile(path):
+                groups = self.index.groups_interested_in_files(os.path.dirname(path))
+                if groups:
+                    groups &= self.index.classify(os.path.basename(path))
+                if groups:
+                    self.grepper.visit_file(path, matchers_of(groups))
+        self.grepper.finish()
+
+def watch(updater, on_change, watcher = None, debounce = DEBOUNCE):
+    # Runs until interrupted, calling on_change after each debounced batch of changes
+    if watcher is None:
+        watcher = create_watcher(updater.index, updater.roots)
+    logger.info("Watching for changes with %r" % watcher)
+    try:
+        while True:
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            updater.update(changed)
+            on_change()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -1,7 +1,9 @@
+import json
 import os
 import pytest
 import yaml
 
+import tagsets.config
 from tagsets.config import Config, TagConf, FileSearchConf, GlobSearchConf
 from tagsets.tagsearch import TagFileMatcher, TagTextMatcher
 from testsupport import PathGenerator
@@ -272,3 +274,95 @@ tagsets:
  #              - "refs"
  #            files:
  #              - "*.doc"
+
+def test_global_and_tagset_encodings():
+    yaml_conf = {
+        'basepath': '/path',
+        'encoding': 'latin-1',
+        'encodingerrors': 'skip',
+        'tagsets': [
+            {'defaults': {
+                'singular': 'tag',
+                'plural': 'tags',
+                'search': [{'file': 'file.txt'}],
+                'regex': 'tag\\[([\\w-]+)\\]' }},
+            {'overridden': {
+                'singular': 'tag',
+                'plural': 'tags',
+                'encoding': 'utf-16',
+                'encodingerrors': 'strict',
+                'search': [{'file': 'file.txt'}],
+                'regex': 'tag\\[([\\w-]+)\\]' }} ] }
+
+    conf = Config.fromyaml(yaml_conf)
+    matchers = dict( (fm.textmatcher.name, fm.textmatcher) for fm in conf.build_matchers() )
+
+    assert matchers['defaults'].encoding == 'latin-1'
+    assert matchers['defaults'].errors == 'skip'
+    assert matchers['overridden'].encoding == 'utf-16'
+    assert matchers['overridden'].errors == 'strict'
+
+def test_unknown_encoding():
+    yaml_conf = {
+        'basepath': '/path',
+        'tagsets': [
+            {'tagset': {
+                'singular': 'tag',
+                'plural': 'tags',
+                'encoding': 'no-such-encoding',
+                'search': [{'file': 'file.txt'}],
+                'regex': 'tag\\[([\\w-]+)\\]' }} ] }
+
+    conf = Config.fromyaml(yaml_conf)
+    with pytest.raises(LookupError):
+        conf.build_matchers()
+
+def test_config_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    conf = Config.fromfile(pg.getpath('multiple-tagsets.yaml'), cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # The cached config is used without parsing the file again
+    def parse_config(data):
+        raise AssertionError("config parsed again")
+    monkeypatch.setattr(tagsets.config, 'parse_config', parse_config)
+    cached = Config.fromfile(pg.getpath('multiple-tagsets.yaml'), cache_dir)
+
+    assert sorted(cached.tagconfs) == sorted(conf.tagconfs)
+    assert [ tc.regex for tc in cached.tagconfs.values() ] == [ tc.regex for tc in conf.tagconfs.values() ]
+    assert cached.basepath == conf.basepath
+
+def test_config_cache_is_keyed_by_contents(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    config_file = tmp_path / "config.yaml"
+    with open(pg.getpath('multiple-tagsets.yaml')) as f:
+        contents = f.read()
+    config_file.write_text(contents)
+    Config.fromfile(str(config_file), cache_dir)
+
+    config_file.write_text(contents.replace('/path', '/another/path'))
+    conf = Config.fromfile(str(config_file), cache_dir)
+
+    assert conf.basepath == '/another/path'
+    # The file's entry is replaced rather than added to
+    assert len(os.listdir(cache_dir)) == 1
+    assert Config.fromfile(str(config_file), cache_dir).basepath == '/another/path'
+
+def test_config_cache_is_json(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    Config.fromfile(pg.getpath('multiple-tagsets.yaml'), cache_dir)
+
+    for name in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, name)) as f:
+            entry = json.load(f)
+        assert entry['config']['basepath'] == '/path'
+
+def test_unreadable_config_cache_is_ignored(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    Config.fromfile(pg.getpath('multiple-tagsets.yaml'), cache_dir)
+    for name in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, name), 'wb') as f:
+            f.write(b"not JSON")
+
+    conf = Config.fromfile(pg.getpath('multiple-tagsets.yaml'), cache_dir)
+    assert conf.basepath == '/path'
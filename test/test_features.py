@@ -1,5 +1,8 @@
+import json
 import os
 import pytest
+import subprocess
+import sys
 
 import tagsets.cli
 
@@ -10,6 +13,14 @@ TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "feat
 
 pg = PathGenerator(TEST_DATA_PATH)
 
+# Test support code
+
+@pytest.fixture(autouse=True)
+def config_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "config-cache"
+    monkeypatch.setenv('TAGSETS_CACHE_DIR', str(cache_dir))
+    return cache_dir
+
 # Tests
 
 def test_no_args():
@@ -33,3 +44,222 @@ def test_list_tags(capsys):
 
     # Output should contain found tag (tag 'TAG-1' at line 1 in file1 in subdir1)
     assert( (testdir.getpath('subdir1/file1') + ':1 : TAG-1') in out)
+
+def test_list_tags_with_jobs(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--jobs', '2', '--walker', 'scandir',
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert( (testdir.getpath('subdir1/file1') + ':1 : TAG-1') in out)
+
+def test_list_tags_with_pipeline(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--list-tags'])
+        expected,err = capsys.readouterr()
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--pipeline', '--readers', '2', '--match-workers', '1', '--queue-size', '1',
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert out == expected
+
+def test_pipeline_with_jobs():
+    with pytest.raises(SystemExit):
+        tagsets.cli.main(['-c', 'config.yaml', '--pipeline', '--jobs', '2', '--list-tags'])
+
+def test_pipeline_with_regex_budget(capsys):
+    with pytest.raises(SystemExit) as e:
+        tagsets.cli.main(['-c', 'config.yaml', '--pipeline', '--regex-budget', '0.5', '--list-tags'])
+
+    assert e.value.code == 2
+    out,err = capsys.readouterr()
+    assert "--pipeline can't be used with --regex-budget" in err
+
+def test_list_tags_with_stats(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--stats', 'json',
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    stats = json.loads(err)
+    assert( (testdir.getpath('subdir1/file1') + ':1 : TAG-1') in out)
+    assert(stats['counts']['files_grepped'] >= 1)
+    assert(stats['matches']['tags'] >= 1)
+    assert(set(stats['phases']) >= {'config', 'walk', 'grep', 'script'})
+
+def test_list_tags_with_regex_profile(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--profile-regexes', '--regex-budget', '10',
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert( (testdir.getpath('subdir1/file1') + ':1 : TAG-1') in out)
+    assert("Slowest regexes" in err)
+    assert("tags: tag\\[" in err)
+
+def test_streamed_list_tags(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--list-tags'])
+        listed,_ = capsys.readouterr()
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--list-tags', '--stream'])
+        streamed,_ = capsys.readouterr()
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--list-tags', '--stream', '--group'])
+        grouped,_ = capsys.readouterr()
+
+    assert( ('tags\t' + testdir.getpath('subdir1/file1') + ':1 : TAG-1\n') in streamed)
+    assert(grouped == listed)
+
+def test_stream_needs_list_tags():
+    with pytest.raises(SystemExit):
+        tagsets.cli.main(['-c', 'config.yaml', '--stream', '-s', 'script'])
+
+def test_list_tags_with_threaded_walker(capsys):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--list-tags'])
+        expected,err = capsys.readouterr()
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--walker', 'threaded', '--fanout', '2',
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert out == expected
+
+def test_fanout_needs_threaded_walker():
+    with pytest.raises(SystemExit):
+        tagsets.cli.main(['-c', 'config.yaml', '--fanout', '2', '--list-tags'])
+
+def test_snapshot(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+    snapshot = str(tmp_path / "snapshot")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--save-snapshot', snapshot,
+                          '--list-tags'])
+        expected,err = capsys.readouterr()
+        tagsets.cli.main(['--load-snapshot', snapshot, '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert out == expected
+
+def test_snapshot_or_config_needed():
+    with pytest.raises(SystemExit):
+        tagsets.cli.main(['--list-tags'])
+
+def test_unreadable_snapshot(capsys, tmp_path):
+    with pytest.raises(SystemExit):
+        tagsets.cli.main(['--load-snapshot', str(tmp_path / "missing"), '--list-tags'])
+    out,err = capsys.readouterr()
+    assert "Unable to load snapshot" in err
+
+def test_list_tags_with_tag_store(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--list-tags'])
+        expected,err = capsys.readouterr()
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--tag-store', str(tmp_path / "tags.db"),
+                          '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert out == expected
+
+def test_config_cache(capsys, config_cache):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--list-tags'])
+        expected,err = capsys.readouterr()
+        assert len(os.listdir(str(config_cache))) == 1
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--list-tags'])
+
+    out,err = capsys.readouterr()
+    assert out == expected
+
+def test_no_config_cache(capsys, config_cache):
+    testdir = pg.getsubgenerator("list_tags")
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--no-config-cache', '--list-tags'])
+
+    assert not config_cache.exists()
+
+def test_startup_imports():
+    # The slow imports are left until they're needed
+    code = ("import sys, tagsets.cli; "
+            "print(' '.join(m for m in ('yaml', 'pykwalify', 'termcolor', 'asyncio', 'sqlite3') if m in sys.modules))")
+    output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+    assert output.strip() == ""
+
+def test_run_script(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+    script = tmp_path / "check.tss"
+    script.write_text('require "tags found": count(tags) > 0\n'
+                      'print "Tags:", count(tags)\n')
+
+    with working_directory(testdir.getroot()):
+        tagsets.cli.main(['-c', testdir.getpath('config.yaml'),
+                          '--explain', '--run-script', str(script)])
+
+    out,err = capsys.readouterr()
+    assert "tags found : " in out
+    assert "Overall result: " in out
+    assert "Query plan" in err
+
+def test_run_script_failing_requirement(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+    script = tmp_path / "check.tss"
+    script.write_text('require "no tags": empty(tags)\n')
+
+    with working_directory(testdir.getroot()):
+        with pytest.raises(SystemExit) as e:
+            tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--run-script', str(script)])
+
+    assert e.value.code == 1
+    out,err = capsys.readouterr()
+    assert "no tags : " in out
+
+def test_run_script_with_error(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+    script = tmp_path / "check.tss"
+    script.write_text('print nonesuch\n')
+
+    with working_directory(testdir.getroot()):
+        with pytest.raises(SystemExit):
+            tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--run-script', str(script)])
+
+    out,err = capsys.readouterr()
+    assert "check.tss:1: unknown tag set nonesuch" in err
+
+def test_run_script_dividing_by_zero(capsys, tmp_path):
+    testdir = pg.getsubgenerator("list_tags")
+    script = tmp_path / "check.tss"
+    script.write_text('require "ratio": count(tags) / count(tags - tags) > 0.5\n')
+
+    with working_directory(testdir.getroot()):
+        with pytest.raises(SystemExit) as e:
+            tagsets.cli.main(['-c', testdir.getpath('config.yaml'), '--run-script', str(script)])
+
+    assert e.value.code == 1
+    out,err = capsys.readouterr()
+    assert "check.tss:1: division by zero" in err
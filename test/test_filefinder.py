@@ -1,7 +1,8 @@
 import os
 import pytest
 
-from tagsets.filefinder import FileMatcher, FileMatchVisitor, search_paths
+from tagsets.filefinder import ENGINES, FileMatcher, FileMatchVisitor, plan_walk_roots, search_paths
+from tagsets.stats import Stats
 from testsupport import PathGenerator
 
 # TODO look into whether a fixture would be appropriate for the pathgenerator
@@ -22,23 +23,34 @@ class FileMatchTestVisitor(FileMatchVisitor):
         for m in matchers:
             self.visitations.append( (filename,m) )
 
+class EntryRecordingVisitor(FileMatchTestVisitor):
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+
+    def visit_entry(self, entry, matchers):
+        self.entries.append(entry)
+        super().visit_entry(entry, matchers)
+
 # Tests
 
-def test_walk_to_single_file():
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_walk_to_single_file(engine):
     testdir = pg.getsubgenerator("single_file")
     
     visitor = FileMatchTestVisitor()
     matcher = FileMatcher(testdir.getroot(), include_subdirs = False)
     matcher.add_file_pattern("file")
     
-    search_paths(visitor, [matcher] )
+    search_paths(visitor, [matcher], engine )
     
     assert len(visitor.visitations) == 1
     assert (testdir.getpath("file"),matcher) in visitor.visitations
 
 # Note this is a tricky test for coverage - it all depends on the order that directory entries are returned, which can't be controlled
 # TODO There may be a case for stubbing some of this
-def test_exclude_subdirs_for_one_party_but_not_another():
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_exclude_subdirs_for_one_party_but_not_another(engine):
     testdir = pg.getsubgenerator("exclude_subdirs_for_some_parties")
     
     visitor = FileMatchTestVisitor()
@@ -48,14 +60,15 @@ def test_exclude_subdirs_for_one_party_but_not_another():
     matcher2.add_file_pattern("file")
     matcher2.add_ignored_dirname("dir2")
     
-    search_paths(visitor, [matcher1,matcher2] )
+    search_paths(visitor, [matcher1,matcher2], engine )
     
     assert len(visitor.visitations) == 3
     assert (testdir.getpath("dir1/file"),matcher1) in visitor.visitations
     assert (testdir.getpath("dir1/file"),matcher2) in visitor.visitations
     assert (testdir.getpath("dir2/file"),matcher1) in visitor.visitations
 
-def test_ignoring_file_patterns():
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_ignoring_file_patterns(engine):
     testdir=pg.getsubgenerator("ignoring_file_patterns")
 
     visitor = FileMatchTestVisitor()
@@ -63,7 +76,115 @@ def test_ignoring_file_patterns():
     matcher.add_file_pattern("file*")
     matcher.add_ignore_pattern("*.doc")
     
-    search_paths(visitor, [matcher] )
+    search_paths(visitor, [matcher], engine )
     
     assert len(visitor.visitations) == 1
     assert (testdir.getpath("file1.txt"),matcher) in visitor.visitations
+
+def test_plan_groups_nested_matchers_under_one_root():
+    outer = FileMatcher("/src", include_subdirs = True)
+    inner = FileMatcher("/src/lib/include", include_subdirs = True)
+    other = FileMatcher("/doc", include_subdirs = False)
+
+    roots = plan_walk_roots([inner, other, outer])
+
+    assert roots == [ ("/doc", [other]), ("/src", [outer, inner]) ]
+
+def test_plan_treats_paths_component_wise():
+    src = FileMatcher("/src", include_subdirs = True)
+    src2 = FileMatcher("/src2", include_subdirs = True)
+    srcdash = FileMatcher("/src-gen", include_subdirs = True)
+    srcsub = FileMatcher("/src/sub/", include_subdirs = True)
+
+    roots = plan_walk_roots([src2, srcsub, srcdash, src])
+
+    assert roots == [ ("/src", [src, srcsub]), ("/src-gen", [srcdash]), ("/src2", [src2]) ]
+
+def test_search_only_walks_planned_roots(monkeypatch):
+    testdir = pg.getsubgenerator("exclude_subdirs_for_some_parties")
+    walked = []
+    real_walk = os.walk
+    def recording_walk(top, **kwargs):
+        walked.append(top)
+        return real_walk(top, **kwargs)
+    monkeypatch.setattr(os, "walk", recording_walk)
+
+    visitor = FileMatchTestVisitor()
+    matcher1 = FileMatcher(testdir.getpath("dir1"), include_subdirs = True)
+    matcher1.add_file_pattern("file")
+    matcher2 = FileMatcher(testdir.getpath("dir2"), include_subdirs = False)
+    matcher2.add_file_pattern("file")
+
+    search_paths(visitor, [matcher1, matcher2])
+
+    assert walked == [testdir.getpath("dir1"), testdir.getpath("dir2")]
+    assert len(visitor.visitations) == 2
+
+def test_scandir_engine_passes_dir_entries():
+    testdir = pg.getsubgenerator("ignoring_file_patterns")
+
+    visitor = EntryRecordingVisitor()
+    matcher = FileMatcher(testdir.getroot(), include_subdirs = True)
+    matcher.add_file_pattern("*.doc")
+
+    search_paths(visitor, [matcher], engine = "scandir")
+
+    assert sorted(e.name for e in visitor.entries) == ["file2.doc", "some_other.doc"]
+    assert all(isinstance(e, os.DirEntry) for e in visitor.entries)
+    assert len(visitor.visitations) == 2
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_walk_stats(engine):
+    testdir = pg.getsubgenerator("ignoring_file_patterns")
+
+    stats = Stats()
+    matcher = FileMatcher(testdir.getroot(), include_subdirs = True)
+    matcher.add_file_pattern("*.doc")
+
+    search_paths(FileMatchTestVisitor(), [matcher], engine, stats)
+
+    assert stats.directories == 1
+    assert stats.files_considered == 3
+    assert stats.files_accepted == 2
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        search_paths(FileMatchTestVisitor(), [], engine = "teleport")
+
+@pytest.mark.parametrize("fanout", [1, 3, 16])
+def test_threaded_engine_visits_in_walk_order(tmp_path, fanout):
+    for d in range(4):
+        for s in range(3):
+            subdir = tmp_path / ("dir%i" % d) / ("sub%i" % s)
+            subdir.mkdir(parents = True)
+            (subdir / "file.txt").write_text("")
+            (subdir / "file.doc").write_text("")
+        (tmp_path / ("dir%i" % d) / "top.txt").write_text("")
+    matcher1 = FileMatcher(str(tmp_path), include_subdirs = True)
+    matcher1.add_file_pattern("*.txt")
+    matcher1.add_ignored_dirname("sub1")
+    matcher2 = FileMatcher(str(tmp_path / "dir2"), include_subdirs = True)
+    matcher2.add_file_pattern("*.doc")
+
+    walked = FileMatchTestVisitor()
+    search_paths(walked, [matcher1, matcher2], "walk")
+    threaded = EntryRecordingVisitor()
+    search_paths(threaded, [matcher1, matcher2], "threaded", walker_options = { 'fanout': fanout })
+
+    assert threaded.visitations == walked.visitations
+    assert len(threaded.visitations) == 4 + 4 * 2 + 3
+    assert all(isinstance(e, os.DirEntry) for e in threaded.entries)
+
+def test_threaded_engine_stops_when_visitor_fails(tmp_path):
+    for d in range(20):
+        (tmp_path / ("dir%i" % d)).mkdir()
+        (tmp_path / ("dir%i" % d) / "file").write_text("")
+    matcher = FileMatcher(str(tmp_path), include_subdirs = True)
+    matcher.add_file_pattern("*")
+
+    class FailingVisitor(FileMatchVisitor):
+        def visit_file(self, filename, matchers):
+            raise RuntimeError(filename)
+
+    with pytest.raises(RuntimeError):
+        search_paths(FailingVisitor(), [matcher], "threaded", walker_options = { 'fanout': 2 })
@@ -1,7 +1,11 @@
+import concurrent.futures
 import os
 import pytest
+import re
 
-from tagsets.filegrepper import TextMatcher, TextMatchVisitor, grep_file
+import tagsets.filegrepper
+from tagsets.filegrepper import TextMatcher, TextMatchVisitor, grep_file, grep_files, required_literal
+from tagsets.stats import Stats
 from testsupport import PathGenerator
 
 # Path to the test files / directories
@@ -61,6 +65,194 @@ def test_single_file_two_tagsets():
     assert ("C",testdir.getpath("file"),16,tm2) in tmv.matches
 
 
+def test_grep_files_in_parallel_merges_in_enumeration_order():
+    tm1 = TextMatcher("decl\[([\w-]+)\]")
+    tm2 = TextMatcher("def\[([\w-]+)\]")
+    tm3 = TextMatcher("source\[([\w-]+)\]")
+    serial = MatchTestVisitor()
+    parallel = MatchTestVisitor()
+    workitems = [ (pg.getpath("single_file_single_tag/file"), [tm3], None),
+                  (pg.getpath("empty_file/file"), [tm1, tm3], None),
+                  (pg.getpath("single_file_two_tagsets/file"), [tm1, tm2], None) ]
+
+    for path, matchers, _ in workitems:
+        grep_file(path, matchers, serial)
+    grep_files(workitems, parallel, 2)
+
+    assert len(parallel.matches) == 6
+    assert parallel.matches == serial.matches
+
+def test_grep_files_without_pool_initializers(monkeypatch):
+    # As on Python 3.5 and 3.6, whose process pools can't initialise their workers
+    pool_class = concurrent.futures.ProcessPoolExecutor
+    def process_pool(jobs):
+        return pool_class(jobs)
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", process_pool)
+    tm1 = TextMatcher("decl\\[([\\w-]+)\\]")
+    tm2 = TextMatcher("def\\[([\\w-]+)\\]")
+    serial = MatchTestVisitor()
+    parallel = MatchTestVisitor()
+    workitems = [ (pg.getpath("single_file_two_tagsets/file"), [tm1, tm2], None),
+                  (pg.getpath("single_file_two_tagsets/file"), [tm2], None) ]
+
+    for path, matchers, _ in workitems:
+        grep_file(path, matchers, serial)
+    grep_files(workitems, parallel, 2, stats = Stats())
+
+    assert parallel.matches == serial.matches
+    assert parallel.matches
+
+def test_compiled_matchers_are_bounded():
+    path = pg.getpath("single_file_two_tagsets/file")
+    for i in range(300):
+        grep_file(path, [TextMatcher("decl\\[(%i)\\]" % i)], MatchTestVisitor())
+
+    info = tagsets.filegrepper._compile_matchers.cache_info()
+    assert info.currsize <= info.maxsize
+
+def naive_grep(path, matchers):
+    matches = []
+    with open(path) as f:
+        for linenumber, linestr in enumerate(f, start=1):
+            for g in matchers:
+                for m in re.findall(g.regex, linestr.rstrip('\n')):
+                    matches.append( (m, path, linenumber, g) )
+    return matches
+
+@pytest.mark.parametrize("regexes", [
+    ["decl\\[([\\w-]+)\\]", "l\\[([\\w-]+)\\]", "def\\[([\\w-]+)\\]"],
+    ["(e)\\1", "([A-C])\\]", "(?P<tag>de(c|f))"],
+    ["(?i)DECL", "def"],
+    ["(decl)?\\[(\\w)\\]", "^$", "tion\\Z"],
+])
+def test_combined_matchers_find_same_matches_as_separate_regexes(regexes):
+    path = pg.getpath("single_file_two_tagsets/file")
+    matchers = [TextMatcher(r) for r in regexes]
+    tmv = MatchTestVisitor()
+
+    grep_file(path, matchers, tmv)
+
+    assert tmv.matches == naive_grep(path, matchers)
+    assert tmv.matches
+
+@pytest.mark.parametrize("mmap_threshold", [1, 1024 * 1024])
+@pytest.mark.parametrize("regexes", [
+    ["decl\\[([\\w-]+)\\]", "l\\[([\\w-]+)\\]", "def\\[([\\w-]+)\\]"],
+    ["(?u)decl\\[(\\w)\\]", "(e)(f)"],
+    ["source\\[([\\w-]+)\\]", "^This", "tags?"],
+])
+def test_whole_file_mode_finds_same_matches_as_line_mode(monkeypatch, regexes, mmap_threshold):
+    monkeypatch.setattr(tagsets.filegrepper, "MMAP_THRESHOLD", mmap_threshold)
+    for path in [pg.getpath("single_file_two_tagsets/file"),
+                 pg.getpath("single_file_single_tag/file"),
+                 pg.getpath("empty_file/file")]:
+        matchers = [TextMatcher(r) for r in regexes]
+        lines = MatchTestVisitor()
+        whole = MatchTestVisitor()
+
+        grep_file(path, matchers, lines)
+        grep_file(path, matchers, whole, whole_file = True)
+
+        assert whole.matches == lines.matches
+
+def test_whole_file_mode_matches_across_lines():
+    path = pg.getpath("single_file_two_tagsets/file")
+    tm = TextMatcher("decl\\[(\\w)\\][^[]*def\\[(\\w)\\]")
+    tmv = MatchTestVisitor()
+
+    grep_file(path, [tm], tmv, whole_file = True)
+
+    assert tmv.matches == [ (("B", "A"), path, 8, tm), (("C", "C"), path, 14, tm) ]
+
+@pytest.mark.parametrize("mmap_threshold", [1, 1024 * 1024])
+@pytest.mark.parametrize("regexes", [
+    ["ref\\[([\\w-]+)\\]"],
+    ["(\\w+)\\]\\s*$", "\\bcaf"],
+    ["(?i)REF\\[(.)", "ref\\[([^\\]]+)\\]"],
+    ["ref\\[([a-z-]+)\\]", "caf\u00e9"],
+])
+def test_whole_file_mode_finds_same_matches_as_line_mode_in_non_ascii_text(tmp_path, monkeypatch, regexes, mmap_threshold):
+    monkeypatch.setattr(tagsets.filegrepper, "MMAP_THRESHOLD", mmap_threshold)
+    path = str(tmp_path / "file.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("ref[caf\u00e9]\nref[na\u00efve-x]  \nref[plain]\n\u00c9t\u00e9 caf\u00e9]\n")
+    matchers = [TextMatcher(r, "utf-8") for r in regexes]
+    lines = MatchTestVisitor()
+    whole = MatchTestVisitor()
+
+    grep_file(path, matchers, lines)
+    grep_file(path, matchers, whole, whole_file = True)
+
+    assert whole.matches == lines.matches
+    assert lines.matches
+
+@pytest.mark.parametrize("mmap_threshold", [1, 1024 * 1024])
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-16"])
+@pytest.mark.parametrize("newline", ["\r\n", "\r", "\n\r"])
+@pytest.mark.parametrize("regexes", [
+    ["TODO: (.*)"],
+    ["foo$", "^(\\w+)"],
+    ["ref\\[([\\w-]+)\\]\\s*$", "(e)(f)"],
+])
+def test_whole_file_mode_matches_line_mode_with_other_line_endings(tmp_path, monkeypatch, regexes, newline,
+                                                                   encoding, mmap_threshold):
+    monkeypatch.setattr(tagsets.filegrepper, "MMAP_THRESHOLD", mmap_threshold)
+    path = str(tmp_path / "file.txt")
+    with open(path, "w", encoding=encoding, newline="") as f:
+        f.write(newline.join(["TODO: fix this", "a foo", "ref[one] ", "", "def foo", "TODO: and this", "ref[two]"]))
+    matchers = [TextMatcher(r, encoding) for r in regexes]
+    lines = MatchTestVisitor()
+    whole = MatchTestVisitor()
+
+    grep_file(path, matchers, lines)
+    grep_file(path, matchers, whole, whole_file = True)
+
+    assert whole.matches == lines.matches
+    assert lines.matches
+
+@pytest.mark.parametrize("regex,literal", [
+    ("def\\[([\\w-]+)\\]", "def["),
+    ("(?:ref|see)\\[(TAG_[\\w\\._]+)\\]", "[TAG_"),
+    ("TODO", "TODO"),
+    ("(?i)TODO", None),
+    ("(?i:todo)x", "x"),
+    ("ab?cd", "cd"),
+    ("\\w+", None),
+])
+def test_required_literal(regex, literal):
+    assert required_literal(re.compile(regex)) == literal
+
+def test_file_without_required_literals_is_skipped(monkeypatch):
+    path = pg.getpath("single_file_two_tagsets/file")
+    tm = TextMatcher("TAG_(\\w+)")
+    tmv = MatchTestVisitor()
+    decoded = []
+    monkeypatch.setattr(tagsets.filegrepper, "_scan_line",
+                        lambda *args: decoded.append(args))
+
+    grep_file(path, [tm], tmv)
+
+    assert tmv.matches == []
+    assert decoded == []
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n", "\r"])
+@pytest.mark.parametrize("regexes", [
+    ["decl\\[([\\w-]+)\\]", "def\\[([\\w-]+)\\]"],
+    ["decl\\[([\\w-]+)\\]$", "\\w+\\[(C)\\]"],
+])
+def test_prefiltered_lines_match_line_by_line_scan(tmp_path, newline, regexes):
+    with open(pg.getpath("single_file_two_tagsets/file")) as f:
+        content = f.read()
+    path = str(tmp_path / "file")
+    with open(path, "w", newline="") as f:
+        f.write(content.replace("\n", newline))
+    matchers = [TextMatcher(r) for r in regexes]
+    tmv = MatchTestVisitor()
+
+    grep_file(path, matchers, tmv)
+
+    assert tmv.matches == naive_grep(path, matchers)
+    assert len(tmv.matches) >= 2
 
 # Test cases to add
 # =================
@@ -69,3 +261,60 @@ def test_single_file_two_tagsets():
 # duplicated tags
 # multiple tags on line
 # overlapping tags
+
+@pytest.mark.parametrize("whole_file", [False, True])
+def test_binary_files_are_skipped(tmp_path, whole_file):
+    path = tmp_path / "file.o"
+    path.write_bytes(b"\x7fELF\0\0\0source[tag1]\n" + b"source[tag2]\n" * 2000)
+    stats = Stats()
+
+    tmv = MatchTestVisitor()
+    grep_file(str(path), [TextMatcher("source\\[([\\w-]+)\\]")], tmv, whole_file, stats = stats)
+
+    assert tmv.matches == []
+    assert stats.files_binary == 1
+    assert stats.bytes_read == tagsets.filegrepper.BINARY_PREFIX
+
+def test_nul_bytes_are_text_in_utf16(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes("other\nsource[tag1]\n".encode("utf-16"))
+
+    tmv = MatchTestVisitor()
+    grep_file(str(path), [TextMatcher("source\\[([\\w-]+)\\]", encoding = "utf-16")], tmv)
+
+    assert [ (m[0], m[2]) for m in tmv.matches ] == [ ("tag1", 2) ]
+
+@pytest.mark.parametrize("whole_file", [False, True])
+@pytest.mark.parametrize("errors, expected", [
+    ("replace", [ ("caf\ufffd", 1), ("tag2", 2) ]),
+    ("ignore", [ ("caf", 1), ("tag2", 2) ]),
+    ("skip", []),
+])
+def test_decode_error_policies(tmp_path, whole_file, errors, expected):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"source[caf\xe9]\nsource[tag2]\n")
+
+    tmv = MatchTestVisitor()
+    grep_file(str(path), [TextMatcher("source\\[([^\\]]+)\\]", "utf-8", errors)], tmv, whole_file)
+
+    assert [ (m[0], m[2]) for m in tmv.matches ] == expected
+
+def test_strict_decode_errors_are_raised(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"source[caf\xe9]\n")
+
+    with pytest.raises(UnicodeDecodeError):
+        grep_file(str(path), [TextMatcher("source\\[([^\\]]+)\\]", "utf-8", "strict")], MatchTestVisitor())
+
+def test_matchers_with_different_encodings(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"a[caf\xe9] b[x]\nb[y] a[z]\n")
+    a_latin1 = TextMatcher("a\\[([^\\]]+)\\]", "latin-1")
+    b_utf8 = TextMatcher("b\\[([^\\]]+)\\]", "utf-8")
+    a_utf8 = TextMatcher("a\\[([^\\]]+)\\]", "utf-8", "skip")
+
+    tmv = MatchTestVisitor()
+    grep_file(str(path), [a_latin1, b_utf8, a_utf8], tmv)
+
+    assert [ (m[0], m[2], m[3]) for m in tmv.matches ] == [
+        ("caf\xe9", 1, a_latin1), ("x", 1, b_utf8), ("z", 2, a_latin1), ("y", 2, b_utf8) ]
@@ -0,0 +1,159 @@
+import os
+import shutil
+import subprocess
+import pytest
+
+import tagsets.gitindex
+from tagsets.filefinder import FileMatcher, FileMatchVisitor, search_paths
+from tagsets.gitindex import MODE_DIRECTORY, MODE_FILE, MODE_GITLINK, GitIndexError, parse_index, tracked_files
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git not available")
+
+# Test support code
+
+class FileRecordingVisitor(FileMatchVisitor):
+    def __init__(self):
+        super().__init__()
+        self.files = []
+
+    def visit_file(self, path, matchers):
+        self.files.append(path)
+
+def git(repo, *args):
+    return subprocess.run(["git", "-c", "core.quotepath=off"] + list(args), cwd=str(repo),
+                          check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = tmp_path / "repo"
+    (repo / "src" / "lib").mkdir(parents=True)
+    (repo / "src" / "main.c").write_text("main\n")
+    (repo / "src" / "lib" / "lib.c").write_text("lib\n")
+    (repo / "src" / "lib" / ("long_name_" * 12 + ".c")).write_text("long\n")
+    (repo / "docs").mkdir()
+    (repo / "docs" / "notes.txt").write_text("notes\n")
+    git(repo, "init", "-q")
+    git(repo, "add", "-A")
+
+    # Untracked build output
+    (repo / "src" / "build").mkdir()
+    (repo / "src" / "build" / "generated.c").write_text("generated\n")
+    (repo / "src" / "untracked.c").write_text("untracked\n")
+    return repo
+
+def stub_indexes(monkeypatch, indexes):
+    # indexes maps worktree roots to their entries
+    def stub_tracked_files(path):
+        for root in sorted(indexes, key=len, reverse=True):
+            if path == root or path.startswith(root + os.sep):
+                return root, indexes[root]
+        return None
+    monkeypatch.setattr(tagsets.gitindex, "tracked_files", stub_tracked_files)
+
+@pytest.fixture
+def sparse_tree(tmp_path):
+    (tmp_path / "a" / "b" / "c").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "f.c").write_text("f\n")
+    (tmp_path / "a" / "b" / "c" / "g.c").write_text("g\n")
+    (tmp_path / "top.c").write_text("top\n")
+    return tmp_path
+
+def ls_files(repo):
+    return [ (line.split("\t", 1)[1], int(line.split()[0], 8)) for line in git(repo, "ls-files", "-s").splitlines() ]
+
+# Tests
+
+@pytest.mark.parametrize("version", [2, 3, 4])
+def test_index_versions(repo, version):
+    (repo / "src" / "intent.c").write_text("intent\n")
+    git(repo, "add", "--intent-to-add", "src/intent.c")
+    git(repo, "update-index", "--index-version", str(version))
+
+    root, entries = tracked_files(str(repo / "src"))
+
+    assert root == str(repo)
+    assert entries == ls_files(repo)
+
+def test_split_index_is_not_used(repo):
+    git(repo, "update-index", "--split-index")
+
+    assert tracked_files(str(repo)) is None
+
+def test_not_an_index():
+    with pytest.raises(GitIndexError):
+        parse_index(b"DIRX\0\0\0\2\0\0\0\0")
+
+def test_engine_only_visits_tracked_files(repo):
+    matcher = FileMatcher(str(repo / "src"))
+    matcher.add_file_pattern("*.c")
+    (repo / "src" / "lib" / "lib.c").unlink()
+
+    visitor = FileRecordingVisitor()
+    search_paths(visitor, [matcher], "gitindex")
+
+    assert visitor.files == [ str(repo / "src" / "lib" / ("long_name_" * 12 + ".c")),
+                              str(repo / "src" / "main.c") ]
+
+def test_engine_applies_ignored_dirs(repo):
+    matcher = FileMatcher(str(repo))
+    matcher.add_file_pattern("*")
+    matcher.add_ignored_dirname("lib")
+
+    visitor = FileRecordingVisitor()
+    search_paths(visitor, [matcher], "gitindex")
+
+    assert sorted(visitor.files) == [ str(repo / "docs" / "notes.txt"), str(repo / "src" / "main.c") ]
+
+def test_engine_walks_outside_git(tmp_path):
+    (tmp_path / "file.c").write_text("file\n")
+    matcher = FileMatcher(str(tmp_path))
+    matcher.add_file_pattern("*.c")
+
+    visitor = FileRecordingVisitor()
+    search_paths(visitor, [matcher], "gitindex")
+
+    assert visitor.files == [ str(tmp_path / "file.c") ]
+
+@pytest.mark.parametrize("include_subdirs", [True, False])
+def test_engine_walks_sparse_directories(sparse_tree, monkeypatch, include_subdirs):
+    stub_indexes(monkeypatch, { str(sparse_tree): [ ("a/b/", MODE_DIRECTORY), ("top.c", MODE_FILE) ] })
+    visits = {}
+    for engine in ["walk", "gitindex"]:
+        matcher = FileMatcher(str(sparse_tree / "a" / "b"), include_subdirs)
+        matcher.add_file_pattern("*.c")
+        visitor = FileRecordingVisitor()
+        search_paths(visitor, [matcher], engine)
+        visits[engine] = visitor.files
+
+    assert visits["gitindex"] == visits["walk"]
+    assert str(sparse_tree / "a" / "b" / "f.c") in visits["gitindex"]
+
+def test_engine_visits_sparse_directory_once(sparse_tree, monkeypatch):
+    stub_indexes(monkeypatch, { str(sparse_tree): [ ("a/b/", MODE_DIRECTORY), ("top.c", MODE_FILE) ] })
+    matcher = FileMatcher(str(sparse_tree))
+    matcher.add_file_pattern("*.c")
+    directories = []
+    visitor = FileRecordingVisitor()
+    visitor.visit_directory = directories.append
+
+    search_paths(visitor, [matcher], "gitindex")
+
+    assert sorted(visitor.files) == [ str(sparse_tree / "a" / "b" / "c" / "g.c"),
+                                      str(sparse_tree / "a" / "b" / "f.c"),
+                                      str(sparse_tree / "top.c") ]
+    assert sorted(directories) == sorted(set(directories))
+
+def test_engine_searches_submodules_with_their_own_index(sparse_tree, monkeypatch):
+    (sparse_tree / "a" / "b" / "untracked.c").write_text("untracked\n")
+    stub_indexes(monkeypatch, { str(sparse_tree): [ ("a/b", MODE_GITLINK), ("top.c", MODE_FILE) ],
+                                str(sparse_tree / "a" / "b"): [ ("c/g.c", MODE_FILE), ("f.c", MODE_FILE) ] })
+    matcher = FileMatcher(str(sparse_tree))
+    matcher.add_file_pattern("*.c")
+
+    visitor = FileRecordingVisitor()
+    search_paths(visitor, [matcher], "gitindex")
+
+    assert sorted(visitor.files) == [ str(sparse_tree / "a" / "b" / "c" / "g.c"),
+                                      str(sparse_tree / "a" / "b" / "f.c"),
+                                      str(sparse_tree / "top.c") ]
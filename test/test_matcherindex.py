@@ -0,0 +1,93 @@
+import pytest
+
+from tagsets.filefinder import FileMatcher
+from tagsets.matcherindex import MatcherIndex, matchers_of
+
+# Test support code
+
+def make_matcher(path, include_subdirs = True, ignoredirs = (), filepatterns = ("*",)):
+    matcher = FileMatcher(path, include_subdirs)
+    for dirname in ignoredirs:
+        matcher.add_ignored_dirname(dirname)
+    for pattern in filepatterns:
+        matcher.add_file_pattern(pattern)
+    return matcher
+
+def interested_matchers(index, path):
+    return matchers_of(index.groups_interested_in_files(path))
+
+# Tests
+
+def test_recursive_matcher_interested_in_subtree():
+    matcher = make_matcher("/src")
+    index = MatcherIndex([matcher])
+
+    assert interested_matchers(index, "/src") == {matcher}
+    assert interested_matchers(index, "/src/a/b") == {matcher}
+    assert interested_matchers(index, "/") == set()
+
+def test_paths_are_compared_by_component():
+    src = make_matcher("/src")
+    src2 = make_matcher("/src2")
+    index = MatcherIndex([src, src2])
+
+    assert interested_matchers(index, "/src") == {src}
+    assert interested_matchers(index, "/src2/x") == {src2}
+    assert index.state_for("/src3") is None
+
+def test_non_recursive_matcher_only_interested_in_its_own_directory():
+    matcher = make_matcher("/doc", include_subdirs = False)
+    index = MatcherIndex([matcher])
+
+    assert interested_matchers(index, "/doc") == {matcher}
+    assert index.state_for("/doc/sub") is None
+
+def test_ignored_dirs_exclude_whole_subtree():
+    matcher = make_matcher("/src", ignoredirs = [".git"])
+    other = make_matcher("/src")
+    index = MatcherIndex([matcher, other])
+
+    assert interested_matchers(index, "/src/.git") == {other}
+    assert interested_matchers(index, "/src/.git/objects") == {other}
+    assert interested_matchers(index, "/src/lib") == {matcher, other}
+
+def test_ignored_dir_below_all_matchers_prunes_walk():
+    index = MatcherIndex([make_matcher("/src", ignoredirs = ["build"])])
+
+    assert index.state_for("/src/a/build") is None
+
+def test_equivalent_matchers_share_a_group():
+    matcher1 = make_matcher("/src", filepatterns = ["*.c", "*.h"])
+    matcher2 = make_matcher("/src/", filepatterns = ["*.h", "*.c"])
+    matcher3 = make_matcher("/src", filepatterns = ["*.txt"])
+    index = MatcherIndex([matcher1, matcher2, matcher3])
+
+    assert len(index.groups) == 2
+    groups = index.groups_interested_in_files("/src/lib")
+    assert len(groups) == 2
+    assert matchers_of(groups) == {matcher1, matcher2, matcher3}
+
+def test_classifier_agrees_with_fnmatch():
+    patterns = ["*.c", "*.h", "*.tar.gz", "Makefile", "file*", "*", "test_?.py", "[ab]*.txt", "*_test.*"]
+    ignores = ["*.o", "file2*", "b*"]
+    names = ["main.c", "main.h", "x.tar.gz", "tar.gz", "Makefile", "Makefile.am", "file", "file1.txt",
+             "file2.doc", "test_a.py", "test_ab.py", "a.txt", "b.txt", "c.txt", "x_test.py", ".c", "c", "main.o"]
+
+    matchers = []
+    for pattern in patterns:
+        matchers.append(make_matcher("/src", filepatterns = [pattern]))
+        matchers.append(make_matcher("/src", filepatterns = [pattern], ignoredirs = ["x"]))
+        with_ignores = make_matcher("/src", filepatterns = [pattern])
+        for ignore in ignores:
+            with_ignores.add_ignore_pattern(ignore)
+        matchers.append(with_ignores)
+    index = MatcherIndex(matchers)
+
+    for name in names:
+        expected = {m for m in matchers if m.interested_in_file(name)}
+        assert matchers_of(index.classify(name)) == expected, name
+
+def test_classifier_with_no_matching_pattern():
+    index = MatcherIndex([make_matcher("/src", filepatterns = ["*.c"])])
+
+    assert not index.classify("main.cpp")
@@ -0,0 +1,101 @@
+import io
+import pytest
+import time
+
+from tagsets.output import BufferedTextWriter, TagStreamer
+from tagsets.tagset import Tag, TagSet
+
+# Test support code
+
+class CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+# Tests
+
+def test_writer_buffers_until_full():
+    stream = CountingStream()
+    writer = BufferedTextWriter(stream, buffer_size = 10, flush_interval = 60)
+
+    writer.write("12345")
+    assert stream.getvalue() == ""
+    writer.write("67890")
+    assert stream.getvalue() == "1234567890"
+    writer.write("x")
+    writer.flush()
+
+    assert stream.getvalue() == "1234567890x"
+    assert stream.writes == 2
+
+def test_writer_flushes_after_interval():
+    stream = io.StringIO()
+    writer = BufferedTextWriter(stream, flush_interval = 0)
+
+    writer.write("tag\n")
+
+    assert stream.getvalue() == "tag\n"
+
+def test_writer_flushes_waiting_text_without_further_writes():
+    stream = io.StringIO()
+    writer = BufferedTextWriter(stream, flush_interval = 0.05)
+
+    writer.write("tag\n")
+    assert stream.getvalue() == ""
+    deadline = time.monotonic() + 5
+    while not stream.getvalue() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert stream.getvalue() == "tag\n"
+
+def test_streamer_writes_tags_as_found():
+    out = io.StringIO()
+    streamer = TagStreamer(BufferedTextWriter(out))
+    defs = TagSet("defs", "def", "defs")
+
+    streamer.tag_found(defs, Tag("TAG_1", "a.c", 3))
+    streamer.finish()
+
+    assert out.getvalue() == "defs\ta.c:3 : TAG_1\n"
+
+def test_grouped_streamer_matches_summary():
+    defs = TagSet("defs", "def", "definitions")
+    refs = TagSet("refs", "ref", "references")
+    empty = TagSet("empty", "thing", "things")
+    found = [ (refs, Tag("TAG_1", "b.c", 1)), (defs, Tag("TAG_1", "a.c", 3)), (refs, Tag("TAG_2", "b.c", 7)) ]
+
+    out = io.StringIO()
+    streamer = TagStreamer(BufferedTextWriter(out), group = True, spool_size = 10)
+    for ts, tag in found:
+        streamer.tag_found(ts, tag)
+        ts.add_tag(tag)
+    streamer.finish([defs, refs, empty])
+
+    expected = io.StringIO()
+    for ts in [defs, refs, empty]:
+        expected.write("\n")
+        ts.print_summary(expected)
+    expected.write("\n")
+    assert out.getvalue() == expected.getvalue()
+
+def test_grouped_streamer_keeps_non_ascii_text():
+    # Enough tags that the spool is read back in several chunks, which split
+    # characters
+    defs = TagSet("defs", "def", "definitions")
+    out = io.StringIO()
+    streamer = TagStreamer(BufferedTextWriter(out), group = True, spool_size = 100)
+    for i in range(5000):
+        tag = Tag("caf\u00e9-\u00e9\u00e9%i" % i, "/src/b\udce9.c", i)
+        streamer.tag_found(defs, tag)
+        defs.add_tag(tag)
+    streamer.finish([defs])
+
+    expected = io.StringIO()
+    expected.write("\n")
+    defs.print_summary(expected)
+    expected.write("\n")
+    assert out.getvalue() == expected.getvalue()
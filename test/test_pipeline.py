@@ -0,0 +1,122 @@
+import os
+import pytest
+
+import tagsets.pipeline
+from tagsets.pipeline import PipelineOptions
+from tagsets.regexprofile import RegexProfile
+from tagsets.scancache import ScanCache
+from tagsets.stats import Stats
+from tagsets.tagsearch import TagFileMatcher, TagTextMatcher, TagMatcherVisitor
+from tagsets.tagset import TagSet
+import tagsets.filefinder
+
+# Helpers
+
+def make_tree(root, dirs = 5, files = 8):
+    for d in range(dirs):
+        subdir = root / ("dir%i" % d)
+        subdir.mkdir()
+        for f in range(files):
+            lines = [ "def[d%i-f%i]" % (d, f), "text" ]
+            lines += [ "ref[d%i-f%i-%i]" % (d, f, r) for r in range(f % 3) ]
+            (subdir / ("file%i" % f)).write_text("\n".join(lines) + "\n")
+
+def make_matchers(root, encoding = None, errors = None):
+    matchers = [ TagFileMatcher(str(root), TagTextMatcher("defs", r"def\[([\w-]+)\]", encoding, errors)),
+                 TagFileMatcher(str(root), TagTextMatcher("refs", r"ref\[([\w-]+)\]", encoding, errors)) ]
+    for matcher in matchers:
+        matcher.add_file_pattern("*")
+    return matchers
+
+def make_visitor(**kwargs):
+    return TagMatcherVisitor( { "defs": TagSet("defs", "def", "defs"), "refs": TagSet("refs", "ref", "refs") },
+                              **kwargs )
+
+def tags(visitor):
+    return dict( (name, [ (t.tagstr, t.filename, t.linenumber) for t in ts.tags ])
+                 for name, ts in visitor.tsmap.items() )
+
+def sequential(root, **kwargs):
+    visitor = make_visitor(**kwargs)
+    tagsets.filefinder.search_paths(visitor, make_matchers(root), stats = kwargs.get('stats'))
+    visitor.finish()
+    return visitor
+
+# Tests
+
+@pytest.mark.parametrize("options", [ PipelineOptions(),
+                                      PipelineOptions(readers = 1, matchers = 1, queue_size = 1),
+                                      PipelineOptions(readers = 3, matchers = 2, queue_size = 2) ])
+def test_pipeline_matches_sequential(tmp_path, options):
+    make_tree(tmp_path)
+
+    visitor = make_visitor()
+    tagsets.pipeline.search(visitor, make_matchers(tmp_path), options = options)
+
+    assert tags(visitor) == tags(sequential(tmp_path))
+    assert len(visitor.tsmap["defs"].tags) == 40
+
+@pytest.mark.parametrize("engine", sorted(tagsets.filefinder.ENGINES))
+def test_pipeline_engines(tmp_path, engine):
+    make_tree(tmp_path, dirs = 2, files = 3)
+
+    visitor = make_visitor()
+    tagsets.pipeline.search(visitor, make_matchers(tmp_path), engine)
+
+    assert tags(visitor) == tags(sequential(tmp_path))
+
+def test_pipeline_unknown_engine(tmp_path):
+    with pytest.raises(ValueError):
+        tagsets.pipeline.search(make_visitor(), make_matchers(tmp_path), 'nonesuch')
+
+def test_pipeline_rejects_regex_budget(tmp_path):
+    with pytest.raises(ValueError):
+        tagsets.pipeline.search(make_visitor(profile = RegexProfile(0.5)), make_matchers(tmp_path))
+
+def test_pipeline_whole_file(tmp_path):
+    make_tree(tmp_path, dirs = 2, files = 3)
+
+    visitor = make_visitor(grep_options = { 'whole_file': True })
+    tagsets.pipeline.search(visitor, make_matchers(tmp_path))
+
+    assert tags(visitor) == tags(sequential(tmp_path))
+
+def test_pipeline_stats(tmp_path):
+    make_tree(tmp_path, dirs = 2, files = 3)
+    (tmp_path / "binary").write_bytes(b"def[bin]\0\0")
+
+    stats = Stats()
+    visitor = make_visitor(stats = stats)
+    tagsets.pipeline.search(visitor, make_matchers(tmp_path), stats = stats)
+
+    expected = Stats()
+    sequential(tmp_path, stats = expected)
+    assert stats.counts() == expected.counts()
+    assert stats.matches == expected.matches
+    assert stats.files_binary == 1
+
+def test_pipeline_cache(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    make_tree(tree, dirs = 2, files = 3)
+    cache = ScanCache(str(tmp_path / "cache"))
+
+    first = make_visitor(cache = cache)
+    tagsets.pipeline.search(first, make_matchers(tree))
+
+    stats = Stats()
+    second = make_visitor(cache = cache, stats = stats)
+    tagsets.pipeline.search(second, make_matchers(tree), stats = stats)
+
+    assert tags(second) == tags(first)
+    assert stats.files_cached == 6
+    assert stats.files_grepped == 0
+
+def test_pipeline_error(tmp_path):
+    make_tree(tmp_path, dirs = 2, files = 3)
+    (tmp_path / "dir1" / "latin1").write_bytes(b"def[caf\xe9]\n")
+
+    visitor = make_visitor()
+    with pytest.raises(UnicodeDecodeError):
+        tagsets.pipeline.search(visitor, make_matchers(tmp_path, errors = 'strict'),
+                                options = PipelineOptions(queue_size = 1))
@@ -0,0 +1,169 @@
+import io
+import pytest
+
+from tagsets.query import ScriptError, compile_script, tokenize
+from tagsets.tagset import Tag, TagSet
+
+# Test support code
+
+def make_tsmap():
+    tsmap = {}
+    for name, tags in ( ("defs", [("a", 1), ("b", 2), ("c", 3)]),
+                        ("refs", [("a", 10), ("c", 11), ("d", 12), ("d", 13)]),
+                        ("todos", [("c", 20), ("e", 21)]) ):
+        ts = tsmap[name] = TagSet(name, name[:-1], name)
+        for tagstr, linenumber in tags:
+            ts.add_tag(Tag(tagstr, "/src/" + name, linenumber))
+    return tsmap
+
+def run(script, tsmap = None):
+    tsmap = tsmap if tsmap is not None else make_tsmap()
+    plan = compile_script(script, tsmap.keys())
+    out = io.StringIO()
+    passed = plan.run(tsmap, out)
+    return passed, out.getvalue()
+
+def requirement(script):
+    passed, output = run('require "check": ' + script)
+    return passed
+
+# Tests
+
+def test_tokenize():
+    assert tokenize('x = refs - defs # comment') == [
+        ('name', 'x'), ('op', '='), ('name', 'refs'), ('op', '-'), ('name', 'defs'), ('end', None) ]
+    assert tokenize('require "a \\"b\\"": count(x) >= 0.5') == [
+        ('keyword', 'require'), ('string', 'a "b"'), ('op', ':'), ('keyword', 'count'), ('op', '('),
+        ('name', 'x'), ('op', ')'), ('op', '>='), ('number', 0.5), ('end', None) ]
+
+@pytest.mark.parametrize("expression", [
+    "refs - defs",
+    "defs & refs",
+    "defs | todos - refs",
+    "defs ^ refs & todos",
+    "(defs | todos) - refs",
+    "refs - defs - todos",
+    "defs & refs | todos ^ defs",
+])
+def test_set_expressions_match_python(expression):
+    tsmap = make_tsmap()
+    passed, output = run("print " + expression, tsmap)
+
+    expected = io.StringIO()
+    eval(expression, {}, make_tsmap()).print_summary(expected)
+    assert output.split("\n", 2)[2] == expected.getvalue().split("\n", 2)[2]
+
+@pytest.mark.parametrize("condition, result", [
+    ("empty(refs - defs)", False),
+    ("empty(defs - defs)", True),
+    ("unique(defs)", True),
+    ("unique(refs)", False),
+    ('contains(refs, "d")', True),
+    ('contains(refs & defs, "d")', False),
+    ("count(refs) == 4", True),
+    ("count(defs & refs) >= 0.5 * count(defs)", True),
+    ("count(defs & refs) / count(defs) > 0.7", False),
+    ("(count(defs) + 1) * 2 == 8", True),
+    ("-count(defs) < 0", True),
+    ("not empty(refs) and empty(defs)", False),
+    ("empty(defs) or not unique(refs)", True),
+    ("not (empty(defs) or empty(refs))", True),
+    ("(count(defs) > 2 or empty(defs)) and unique(defs)", True),
+])
+def test_conditions(condition, result):
+    assert requirement(condition) == result
+
+def test_require_output():
+    passed, output = run('require "defined": empty(refs - defs)\n'
+                         'require "unique": unique(defs)\n')
+
+    assert not passed
+    lines = output.splitlines()
+    assert lines[0].startswith("defined : ") and "FAIL" in lines[0]
+    assert lines[1].startswith("unique : ") and "pass" in lines[1]
+    assert lines[2].startswith("Overall result: ") and "FAIL" in lines[2]
+
+def test_print():
+    passed, output = run('undefined = refs - defs\n'
+                         'print "Undefined:", count(undefined), "of", count(refs), 0.5\n'
+                         'print undefined if not empty(undefined)\n'
+                         'print defs if empty(defs)\n'
+                         'print todos\n')
+
+    assert passed
+    assert output == ("Undefined: 2 of 4 0.5\n"
+                      "undefined\n=========\n/src/refs:12 : d\n/src/refs:13 : d\n"
+                      "todos\n=====\n/src/todos:20 : c\n/src/todos:21 : e\n")
+
+def test_shared_subexpressions_are_planned_once():
+    plan = compile_script("undefined = refs - defs\n"
+                          "require \"a\": empty(refs - defs)\n"
+                          "require \"b\": count(undefined) < count((refs - defs) & todos)\n",
+                          ["defs", "refs", "todos"])
+
+    assert plan.nodes == [ ('tagset', 'refs'), ('tagset', 'defs'), ('minus', 0, 1),
+                           ('tagset', 'todos'), ('intersection', 2, 3) ]
+    assert plan.uses[2] == 3
+    assert "shared by 3 uses" in plan.explain()
+
+def test_shared_subexpressions_are_evaluated_once(monkeypatch):
+    tsmap = make_tsmap()
+    calls = []
+    minus = TagSet.minus
+    def counting_minus(self, other):
+        calls.append( (self.name, other.name) )
+        return minus(self, other)
+    monkeypatch.setattr(TagSet, 'minus', counting_minus)
+
+    run('x = refs - defs\nrequire "a": empty(refs - defs)\nprint count(x), count(refs - defs)\n', tsmap)
+
+    assert calls == [ ("refs", "defs") ]
+
+@pytest.mark.parametrize("script, line, message", [
+    ("x = refs -", 1, "expected a name"),
+    ("\n\nrequire empty(refs)", 3, "expected a string"),
+    ("refs = defs", 1, "refs is already defined"),
+    ("x = refs\nx = defs", 2, "x is already defined"),
+    ("print nope", 1, "unknown tag set nope"),
+    ("y = (refs", 1, "expected ')'"),
+    ('print "a" $', 1, "unexpected character '$'"),
+    ("refs - defs", 1, "expected an assignment"),
+    ('require "a": count(refs)', 1, "expected a comparison"),
+])
+def test_script_errors(script, line, message):
+    with pytest.raises(ScriptError) as e:
+        compile_script(script, ["defs", "refs", "todos"], "check.tss")
+    assert e.value.linenumber == line
+    assert message in str(e.value)
+    assert str(e.value).startswith("check.tss:%i: " % line)
+
+def test_division_by_zero_is_a_script_error():
+    tsmap = make_tsmap()
+    tsmap["nothing"] = TagSet("nothing", "thing", "things")
+    plan = compile_script('print "ok"\nrequire "covered": count(defs) / count(nothing) > 0.9\n',
+                          tsmap.keys(), "check.tss")
+
+    with pytest.raises(ScriptError) as e:
+        plan.run(tsmap, io.StringIO())
+    assert str(e.value) == "check.tss:2: division by zero"
+
+def test_unknown_tagsets_are_checked_when_run():
+    plan = compile_script("x = refs - nope\nprint x")
+
+    assert plan.tagsets_used() == ["nope", "refs"]
+    with pytest.raises(ScriptError):
+        plan.run(make_tsmap(), io.StringIO())
+
+def test_script_on_stored_tagsets():
+    from tagsets.tagstore import SqliteTagStore
+    store = SqliteTagStore(":memory:")
+    tsmap = {}
+    for name, ts in make_tsmap().items():
+        stored = tsmap[name] = store.tagset(name, ts.singular, ts.plural)
+        for tag in ts:
+            stored.add_tag(tag)
+    script = ('require "a": count(refs - defs) == 2 and contains(defs & refs, "c") and not unique(refs)\n'
+              'print (defs | todos) - refs\n')
+
+    assert run(script, tsmap) == run(script)
+    store.close()
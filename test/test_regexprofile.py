@@ -0,0 +1,67 @@
+import pytest
+
+from tagsets.filegrepper import TextMatchVisitor, grep_file, grep_files
+from tagsets.regexprofile import RegexBudgetExceeded, RegexProfile
+from tagsets.tagsearch import TagTextMatcher
+
+# Test support code
+
+class MatchTestVisitor(TextMatchVisitor):
+    def __init__(self):
+        super().__init__()
+        self.matches = []
+
+    def visit_match(self, captured_text, filename, linenumber, matcher):
+        self.matches.append( (captured_text, linenumber, matcher.name) )
+
+def make_matchers():
+    return [ TagTextMatcher("defs", "def\\[(\\w+)\\]"), TagTextMatcher("refs", "ref\\[(\\w+)\\]") ]
+
+@pytest.fixture
+def tagged_file(tmp_path):
+    path = tmp_path / "testfile"
+    path.write_text("def[tag1] ref[tag2]\nnothing\nref[tag1]\n")
+    return str(path)
+
+# Tests
+
+@pytest.mark.parametrize("whole_file", [False, True])
+def test_profiled_grep_finds_the_same_matches(tagged_file, whole_file):
+    matchers = make_matchers()
+    plain = MatchTestVisitor()
+    profiled = MatchTestVisitor()
+    profile = RegexProfile()
+
+    grep_file(tagged_file, matchers, plain, whole_file)
+    grep_file(tagged_file, matchers, profiled, whole_file, profile = profile)
+
+    assert profiled.matches == plain.matches
+    assert sorted(profile.regexes) == [ ("defs", "def\\[(\\w+)\\]"), ("refs", "ref\\[(\\w+)\\]") ]
+    seconds, applications, lines, nbytes, matches = profile.regexes[("refs", "ref\\[(\\w+)\\]")]
+    assert lines == 3
+    assert nbytes == (38 if whole_file else 35)
+    assert matches == 2
+    assert applications == (1 if whole_file else 3)
+    assert [path for path, _ in profile.worst_files()] == [tagged_file]
+    assert "refs: ref" in profile.format()
+
+def test_profile_is_collected_from_workers(tagged_file):
+    matchers = make_matchers()
+    profile = RegexProfile()
+
+    grep_files([ (tagged_file, matchers, None) ], MatchTestVisitor(), 2, profile = profile)
+
+    assert profile.regexes[("defs", "def\\[(\\w+)\\]")][4] == 1
+    assert list(profile.files) == [tagged_file]
+
+def test_runaway_regex_exceeds_budget(tmp_path):
+    path = tmp_path / "testfile"
+    path.write_text("ok!\n" + "a" * 40 + "\n")
+    matcher = TagTextMatcher("slow", "(a+)+!")
+
+    with pytest.raises(RegexBudgetExceeded) as excinfo:
+        grep_file(str(path), [matcher], MatchTestVisitor(), profile = RegexProfile(budget = 0.05))
+
+    assert excinfo.value.tagset == "slow"
+    assert excinfo.value.linenumber == 2
+    assert "tagset 'slow'" in str(excinfo.value)
@@ -0,0 +1,112 @@
+import os
+import pytest
+
+import tagsets.tagsearch
+from tagsets.scancache import ScanCache
+from tagsets.tagsearch import TagFileMatcher, TagTextMatcher, TagMatcherVisitor
+from tagsets.tagset import TagSet
+
+# Test support code
+
+class GrepRecorder:
+    def __init__(self, monkeypatch):
+        self.grepped = []
+        real_grep_file = tagsets.tagsearch.grep_file
+        def recording_grep_file(path, matchers, visitor, **options):
+            self.grepped.append( (path, [m.name for m in matchers]) )
+            real_grep_file(path, matchers, visitor, **options)
+        monkeypatch.setattr(tagsets.tagsearch, "grep_file", recording_grep_file)
+
+def scan(cachefile, path, regexes):
+    tms = [TagTextMatcher(name, regex) for name, regex in regexes]
+    fms = [TagFileMatcher(os.path.dirname(path), tm) for tm in tms]
+    tsmap = dict( (tm.name, TagSet(tm.name, tm.name, tm.name)) for tm in tms )
+
+    cache = ScanCache.load(cachefile)
+    tmv = TagMatcherVisitor(tsmap, cache = cache)
+    tmv.visit_file(path, fms)
+    tmv.finish()
+    cache.save()
+
+    return dict( (name, [(t.tagstr, t.linenumber) for t in ts.tags]) for name, ts in tsmap.items() )
+
+REGEXES = [ ("defs", "def\\[([\\w-]+)\\]"), ("refs", "ref\\[([\\w-]+)\\]") ]
+
+@pytest.fixture
+def tagged_file(tmp_path):
+    path = tmp_path / "testfile"
+    path.write_text("def[tag1]\nref[tag1]\nref[tag2]\n")
+    return str(path)
+
+# Tests
+
+def test_unchanged_file_is_replayed_from_cache(tmp_path, tagged_file, monkeypatch):
+    cachefile = str(tmp_path / "cache")
+    first = scan(cachefile, tagged_file, REGEXES)
+
+    recorder = GrepRecorder(monkeypatch)
+    second = scan(cachefile, tagged_file, REGEXES)
+
+    assert first == { "defs": [("tag1", 1)], "refs": [("tag1", 2), ("tag2", 3)] }
+    assert second == first
+    assert recorder.grepped == []
+
+def test_changed_file_is_grepped_again(tmp_path, tagged_file, monkeypatch):
+    cachefile = str(tmp_path / "cache")
+    scan(cachefile, tagged_file, REGEXES)
+    with open(tagged_file, "a") as f:
+        f.write("ref[tag3]\n")
+
+    recorder = GrepRecorder(monkeypatch)
+    result = scan(cachefile, tagged_file, REGEXES)
+
+    assert result["refs"] == [("tag1", 2), ("tag2", 3), ("tag3", 4)]
+    assert recorder.grepped == [ (tagged_file, ["defs", "refs"]) ]
+
+def test_regex_change_only_invalidates_its_tagset(tmp_path, tagged_file, monkeypatch):
+    cachefile = str(tmp_path / "cache")
+    scan(cachefile, tagged_file, REGEXES)
+
+    recorder = GrepRecorder(monkeypatch)
+    result = scan(cachefile, tagged_file, [ REGEXES[0], ("refs", "ref\\[(\\w+)1\\]") ])
+
+    assert result == { "defs": [("tag1", 1)], "refs": [("tag", 2)] }
+    assert recorder.grepped == [ (tagged_file, ["refs"]) ]
+
+def test_unreadable_cache_is_ignored(tmp_path, tagged_file):
+    cachefile = tmp_path / "cache"
+    cachefile.write_bytes(b"not a cache")
+
+    result = scan(str(cachefile), tagged_file, REGEXES)
+
+    assert result["defs"] == [("tag1", 1)]
+
+def test_parallel_warm_run_keeps_cold_run_tag_order(tmp_path):
+    paths = []
+    for i in range(6):
+        path = tmp_path / ("file%i" % i)
+        path.write_text("def[d%i]\nref[r%i]\n" % (i, i))
+        paths.append(str(path))
+    cachefile = str(tmp_path / "cache")
+
+    def scan_all():
+        tms = [TagTextMatcher(name, regex) for name, regex in REGEXES]
+        fms = [TagFileMatcher(str(tmp_path), tm) for tm in tms]
+        tsmap = dict( (tm.name, TagSet(tm.name, tm.name, tm.name)) for tm in tms )
+        cache = ScanCache.load(cachefile)
+        tmv = TagMatcherVisitor(tsmap, jobs = 2, cache = cache)
+        for path in paths:
+            tmv.visit_file(path, fms)
+        tmv.finish()
+        cache.save()
+        return dict( (name, [(t.tagstr, t.filename) for t in ts.tags]) for name, ts in tsmap.items() )
+
+    cold = scan_all()
+    # Change every other file, so that cached and grepped files alternate
+    for path in paths[1::2]:
+        with open(path, "a") as f:
+            f.write("\n")
+    warm = scan_all()
+
+    assert warm == cold
+    assert [ t for t, _ in cold["defs"] ] == [ "d%i" % i for i in range(6) ]
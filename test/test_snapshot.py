@@ -0,0 +1,90 @@
+import os
+import pytest
+
+import tagsets.snapshot
+import tagsets.tagset
+from tagsets.snapshot import SnapshotError
+from tagsets.tagset import Tag, TagSet
+
+# Test support code
+
+def contents(ts):
+    return (ts.name, ts.singular, ts.plural, [ (t.tagstr, t.filename, t.linenumber) for t in ts.tags ])
+
+def make_tagsets():
+    defs = TagSet("defs", "def", "defs")
+    defs.add_tag(Tag("tag1", "/src/a.c", 1))
+    defs.add_tag(Tag("tag2", "/src/a.c", 20))
+    defs.add_tag(Tag("café", "/src/b\udce9.c", 70000))
+    refs = TagSet("refs", "ref", "refs")
+    refs.add_tag(Tag("tag1", "/src/b\udce9.c", 3))
+    refs.add_tag(Tag("tag1", "/src/a.c", 4))
+    pairs = TagSet("pairs", "pair", "pairs")
+    pairs.add_tag(Tag(("tag1", "x"), "/src/a.c", 5))
+    pairs.add_tag(Tag(("tag1", ""), "/src/a.c", 6))
+    empty = TagSet("empty", "thing", "things")
+    return [defs, refs, pairs, empty]
+
+# Tests
+
+def test_snapshot_round_trip(tmp_path):
+    filename = str(tmp_path / "snapshot")
+    tss = make_tagsets()
+
+    tagsets.snapshot.save(filename, tss)
+    loaded = tagsets.snapshot.load(filename)
+
+    assert [ contents(ts) for ts in loaded ] == [ contents(ts) for ts in tss ]
+    assert loaded[1].contains(Tag("tag1", "/elsewhere", 1))
+    assert not os.path.exists(filename + ".tmp")
+
+def test_snapshot_uses_current_file_table(tmp_path, monkeypatch):
+    filename = str(tmp_path / "snapshot")
+    tss = make_tagsets()
+    expected = [ contents(ts) for ts in tss ]
+    tagsets.snapshot.save(filename, tss)
+
+    monkeypatch.setattr(tagsets.tagset, "FILES", tagsets.tagset.FileTable())
+    Tag("other", "/src/other.c", 1)
+    loaded = tagsets.snapshot.load(filename)
+
+    assert [ contents(ts) for ts in loaded ] == expected
+
+def test_snapshot_shares_strings(tmp_path):
+    filename = str(tmp_path / "snapshot")
+    ts = TagSet("defs", "def", "defs")
+    for i in range(1000):
+        ts.add_tag(Tag("a-rather-long-tag-string", "/a/rather/long/path/to/a/file.c", i))
+
+    tagsets.snapshot.save(filename, [ts])
+
+    # Three integers a tag, with the strings stored once
+    assert os.path.getsize(filename) < 1000 * 12 + 200
+
+def test_snapshot_of_expression(tmp_path):
+    filename = str(tmp_path / "snapshot")
+    defs, refs, pairs, empty = make_tagsets()
+
+    tagsets.snapshot.save(filename, [refs - defs, defs & refs])
+    loaded = tagsets.snapshot.load(filename)
+
+    assert loaded[0].name == "<calculated>"
+    assert loaded[0].count() == 0
+    assert [ t.tagstr for t in loaded[1].tags ] == ["tag1"]
+
+def test_not_a_snapshot(tmp_path):
+    filename = tmp_path / "snapshot"
+    filename.write_bytes(b"this is not a snapshot, is it?")
+
+    with pytest.raises(SnapshotError):
+        tagsets.snapshot.load(str(filename))
+
+def test_truncated_snapshot(tmp_path):
+    filename = tmp_path / "snapshot"
+    tagsets.snapshot.save(str(filename), make_tagsets())
+    data = filename.read_bytes()
+
+    for length in (len(data) - 1, len(data) // 2, 40):
+        filename.write_bytes(data[:length])
+        with pytest.raises(SnapshotError):
+            tagsets.snapshot.load(str(filename))
@@ -0,0 +1,43 @@
+import json
+import time
+import pytest
+
+from tagsets.stats import Stats, phase
+
+# Tests
+
+def test_counts_and_matches():
+    stats = Stats()
+    stats.files_grepped += 2
+    stats.add_counts({ "files_grepped": 1, "bytes_read": 10 })
+    stats.count_match("defs")
+    stats.count_match("defs")
+
+    assert stats.counts()["files_grepped"] == 3
+    assert stats.counts()["bytes_read"] == 10
+    assert stats.matches == { "defs": 2 }
+
+def test_nested_phase_time_is_excluded():
+    stats = Stats()
+    with stats.phase("walk"):
+        with stats.phase("grep"):
+            time.sleep(0.05)
+
+    assert stats.phases["grep"] >= 0.05
+    assert stats.phases["walk"] < 0.05
+
+def test_phase_without_stats():
+    with phase(None, "walk"):
+        pass
+
+def test_output_formats():
+    stats = Stats()
+    stats.directories = 4
+    stats.count_match("refs")
+    with stats.phase("walk"):
+        pass
+
+    assert json.loads(stats.to_json())["counts"]["directories"] == 4
+    assert json.loads(stats.to_json())["matches"] == { "refs": 1 }
+    assert "directories" in stats.format()
+    assert "walk" in stats.format()
@@ -1,6 +1,7 @@
 import os
 import pytest
 
+from tagsets.stats import Stats
 from tagsets.tagsearch import TagFileMatcher, TagTextMatcher, TagMatcherVisitor
 from tagsets.tagset import Tag, TagSet
 from testsupport import PathGenerator
@@ -28,3 +29,43 @@ def test_tagsearch():
 
     assert defs.count() == 1
     assert refs.count() == 2
+
+def test_tagsearch_with_jobs():
+    testdir = pg.getsubgenerator("tagsearch_test")
+
+    defs_tm = TagTextMatcher("defs", "def\[([\w-]+)\]")
+    refs_tm = TagTextMatcher("refs", "ref\[([\w-]+)\]")
+    defs_fm = TagFileMatcher(pg.getroot(), defs_tm)
+    refs_fm = TagFileMatcher(pg.getroot(), refs_tm)
+
+    defs = TagSet("defs", "def", "defs")
+    refs = TagSet("refs", "ref", "refs")
+    tmv = TagMatcherVisitor( { "defs": defs, "refs": refs }, jobs = 2 )
+
+    tmv.visit_file(testdir.getpath("testfile"), [defs_fm, refs_fm])
+    assert defs.count() == 0
+
+    tmv.finish()
+    assert defs.count() == 1
+    assert [ (t.tagstr, t.linenumber) for t in refs.tags ] == [ ("tag1", 2), ("tag2", 3) ]
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_tagsearch_stats(jobs):
+    testdir = pg.getsubgenerator("tagsearch_test")
+
+    defs_tm = TagTextMatcher("defs", "def\[([\w-]+)\]")
+    refs_tm = TagTextMatcher("refs", "ref\[([\w-]+)\]")
+    defs_fm = TagFileMatcher(pg.getroot(), defs_tm)
+    refs_fm = TagFileMatcher(pg.getroot(), refs_tm)
+
+    stats = Stats()
+    tmv = TagMatcherVisitor( { "defs": TagSet("defs", "def", "defs"), "refs": TagSet("refs", "ref", "refs") },
+                             jobs = jobs, stats = stats )
+    tmv.visit_file(testdir.getpath("testfile"), [defs_fm, refs_fm])
+    tmv.finish()
+
+    assert stats.files_grepped == 1
+    assert stats.bytes_read == os.path.getsize(testdir.getpath("testfile"))
+    assert stats.lines_scanned > 0
+    assert stats.matches == { "defs": 1, "refs": 2 }
+    assert "grep" in stats.phases
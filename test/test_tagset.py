@@ -1,7 +1,8 @@
 import copy
+import pickle
 import pytest
 
-from tagsets.tagset import Tag, TagSet
+from tagsets.tagset import FILES, Tag, TagSet
 
 # Test support code
 
@@ -34,6 +35,29 @@ def test_tag_properties():
     assert tag.filename == "/a/file/path"
     assert tag.linenumber == 13
 
+def test_tags_share_filenames():
+    tag1 = Tag("tag1", "/a/" + "file/path", 1)
+    tag2 = Tag("tag2", "/a/file/" + "path", 2)
+
+    assert tag1.fileid == tag2.fileid
+    assert FILES.filenames[tag1.fileid] == "/a/file/path"
+    assert not hasattr(tag1, "__dict__")
+
+def test_tag_filename_can_be_changed():
+    tag = Tag("tag", "/a/file/path", 1)
+    tag.filename = "/another/path"
+
+    assert tag.filename == "/another/path"
+
+def test_tag_pickles_with_its_filename():
+    tag = Tag(("tag", "group"), "/a/file/path", 13)
+
+    copied = pickle.loads(pickle.dumps(tag))
+
+    assert copied.tagstr == ("tag", "group")
+    assert copied.filename == "/a/file/path"
+    assert copied.linenumber == 13
+
 def test_set_membership():
     tag1 = Tag("tag1", "tag source", 1)
     tag2 = Tag("tag2", "tag source", 2)
@@ -176,3 +200,92 @@ def test_set_minus():
     # Original sets are unmodified
     assert_tagsets_eq(tset1, orig_tset1)
     assert_tagsets_eq(tset2, orig_tset2)
+
+def test_discard_tags_from_file_and_directory():
+    tset = TagSet("test", "test tag", "test tags")
+    tset.add_tag(Tag("tag1", "/src/a.c", 1))
+    tset.add_tag(Tag("tag2", "/src/lib/b.c", 2))
+    tset.add_tag(Tag("tag3", "/src/lib2/c.c", 3))
+    tset.add_tag(Tag("tag4", "/src/a.c", 4))
+
+    tset.discard_tags_from("/src/a.c")
+    assert [t.tagstr for t in tset.tags] == ["tag2", "tag3"]
+
+    tset.discard_tags_from("/src/lib")
+    assert [t.tagstr for t in tset.tags] == ["tag3"]
+
+def test_same_tag_added_twice_is_not_a_duplicate():
+    tag1 = Tag("tag1", "tag source", 1)
+    tset = TagSet("test", "test tag", "test tags")
+
+    tset.add_tag(tag1)
+    tset.add_tag(tag1)
+
+    assert tset.count() == 2
+    assert tset.contains_no_duplicates()
+
+def test_membership_after_discarding_tags():
+    tag1 = Tag("tag1", "/src/a.c", 1)
+    tag2 = Tag("tag2", "/src/b.c", 2)
+    tset = TagSet("test", "test tag", "test tags")
+    tset.add_tag(tag1)
+    tset.add_tag(tag2)
+
+    tset.discard_tags_from("/src/a.c")
+
+    assert not tset.contains(tag1)
+    assert tset.contains(tag2)
+
+def make_tagset(name, tagstrs):
+    tset = TagSet(name, name[:-1], name)
+    for i, tagstr in enumerate(tagstrs):
+        tset.add_tag(Tag(tagstr, name, i + 1))
+    return tset
+
+def test_set_union_and_symmetric_difference():
+    defs = make_tagset("defs", ["tag1", "tag2", "tag3"])
+    refs = make_tagset("refs", ["tag2", "tag4"])
+
+    union = defs | refs
+    assert union.name == "<calculated>"
+    assert union.plural == "defs"
+    assert [(t.tagstr, t.filename) for t in union] == [
+        ("tag1", "defs"), ("tag2", "defs"), ("tag3", "defs"), ("tag2", "refs"), ("tag4", "refs") ]
+    assert not union.contains_no_duplicates()
+
+    symdiff = defs ^ refs
+    assert [(t.tagstr, t.filename) for t in symdiff] == [
+        ("tag1", "defs"), ("tag3", "defs"), ("tag4", "refs") ]
+
+def test_set_operators():
+    defs = make_tagset("defs", ["tag1", "tag2", "tag3", "tag4"])
+    refs = make_tagset("refs", ["tag2", "tag3", "tag5"])
+    docs = make_tagset("docs", ["tag3"])
+
+    assert [t.tagstr for t in defs & refs & docs] == ["tag3"]
+    assert [t.tagstr for t in (defs - refs) | docs] == ["tag1", "tag4", "tag3"]
+    assert [t.tagstr for t in defs - refs - docs] == ["tag1", "tag4"]
+    assert (defs & make_tagset("none", [])).is_empty()
+
+def test_set_expressions_are_lazy_and_follow_changes():
+    defs = make_tagset("defs", ["tag1"])
+    refs = make_tagset("refs", [])
+
+    unreferenced = defs - refs
+    assert unreferenced.count() == 1
+
+    refs.add_tag(Tag("tag1", "refs", 1))
+    assert unreferenced.count() == 0
+
+    defs.discard_tags_from("defs")
+    refs.discard_tags_from("refs")
+    defs.add_tag(Tag("tag2", "defs", 1))
+    assert [t.tagstr for t in unreferenced] == ["tag2"]
+
+def test_common_subexpressions_are_shared():
+    defs = make_tagset("defs", ["tag1", "tag2"])
+    refs = make_tagset("refs", ["tag2"])
+
+    assert (defs - refs) is defs.minus(refs)
+    assert ((defs - refs) | refs).left is ((defs - refs) & refs).left
+    assert (defs & refs) is not (refs & defs)
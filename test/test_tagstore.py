@@ -0,0 +1,125 @@
+import io
+import pytest
+
+from tagsets.tagset import Tag, TagSet
+from tagsets.tagstore import SqliteTagSetView, SqliteTagStore
+
+# Test support code
+
+TAGS = {
+    "defs": [ ("tag1", "/src/a.c", 1), ("tag2", "/src/a.c", 2), ("tag3", "/src/b\udce9.c", 3) ],
+    "refs": [ ("tag1", "/src/b\udce9.c", 10), ("tag1", "/src/c.c", 11), ("tag4", "/src/c.c", 12),
+              ("tag3", "/src/sub/d.c", 13) ],
+    "todos": [ ("tag4", "/src/a.c", 20), ("tag1", "/src/a.c", 21) ],
+}
+
+def make_tagsets(store):
+    tss = []
+    for name, tags in TAGS.items():
+        ts = store.tagset(name, name[:-1], name) if store is not None else TagSet(name, name[:-1], name)
+        for tagstr, filename, linenumber in tags:
+            ts.add_tag(Tag(tagstr, filename, linenumber))
+        tss.append(ts)
+    return tss
+
+def contents(ts):
+    return [ (t.tagstr, t.filename, t.linenumber) for t in ts ]
+
+@pytest.fixture
+def store():
+    store = SqliteTagStore(":memory:", batch_size = 2)
+    yield store
+    store.close()
+
+# Tests
+
+def test_store_holds_tags(store):
+    defs, refs, todos = make_tagsets(store)
+
+    assert contents(defs) == TAGS["defs"]
+    assert defs.count() == 3
+    assert not defs.is_empty()
+    assert defs.contains(Tag("tag2", "/elsewhere", 1))
+    assert not defs.contains(Tag("tag4", "/src/a.c", 20))
+    assert defs.contains_no_duplicates()
+    assert not refs.contains_no_duplicates()
+
+@pytest.mark.parametrize("expression", [
+    lambda defs, refs, todos: refs & defs,
+    lambda defs, refs, todos: refs - defs,
+    lambda defs, refs, todos: defs | refs,
+    lambda defs, refs, todos: defs ^ refs,
+    lambda defs, refs, todos: (refs - defs) | (todos & refs),
+    lambda defs, refs, todos: (defs | todos) - (refs - todos),
+    lambda defs, refs, todos: defs & refs & todos,
+])
+def test_set_operations_match_in_memory(store, expression):
+    stored = expression(*make_tagsets(store))
+    in_memory = expression(*make_tagsets(None))
+
+    assert isinstance(stored, SqliteTagSetView)
+    assert contents(stored) == contents(in_memory)
+    assert stored.count() == in_memory.count()
+    assert stored.contains_no_duplicates() == in_memory.contains_no_duplicates()
+
+def test_mixing_with_in_memory_tagsets(store):
+    defs, refs, todos = make_tagsets(store)
+    mem_defs, mem_refs, mem_todos = make_tagsets(None)
+
+    assert contents(refs - mem_defs) == contents(mem_refs - mem_defs)
+    assert contents(mem_refs & defs) == contents(mem_refs & mem_defs)
+
+def test_views_follow_changes(store):
+    defs, refs, todos = make_tagsets(store)
+    undefined = refs - defs
+    assert [ t.tagstr for t in undefined ] == ["tag4"]
+
+    defs.add_tag(Tag("tag4", "/src/e.c", 1))
+    assert undefined.is_empty()
+
+    defs.discard_tags_from("/src")
+    assert defs.is_empty()
+    assert undefined.count() == refs.count()
+
+def test_discard_tags_from(store):
+    defs, refs, todos = make_tagsets(store)
+
+    refs.discard_tags_from("/src/sub")
+    refs.discard_tags_from("/src/c.c")
+
+    assert contents(refs) == [ ("tag1", "/src/b\udce9.c", 10) ]
+    assert defs.count() == 3
+
+def test_print_summary(store):
+    defs, refs, todos = make_tagsets(store)
+    mem_defs, mem_refs, mem_todos = make_tagsets(None)
+    out = io.StringIO()
+    expected = io.StringIO()
+
+    (refs - defs).print_summary(out)
+    (mem_refs - mem_defs).print_summary(expected)
+
+    assert out.getvalue() == expected.getvalue()
+
+def test_tuple_tags(store):
+    ts = store.tagset("pairs", "pair", "pairs")
+    ts.add_tag(Tag(("a", "b"), "/src/a.c", 1))
+
+    assert contents(ts) == [ (("a", "b"), "/src/a.c", 1) ]
+    assert ts.contains(Tag(("a", "b"), "/src/b.c", 1))
+
+def test_store_persists(tmp_path):
+    filename = str(tmp_path / "tags.db")
+    store = SqliteTagStore(filename)
+    make_tagsets(store)
+    store.close()
+
+    store = SqliteTagStore(filename)
+    defs, refs, todos = store.tagsets()
+    assert (refs.name, refs.singular, refs.plural) == ("refs", "ref", "refs")
+    assert contents(refs) == TAGS["refs"]
+
+    # A new search replaces a tag set's tags
+    assert store.tagset("refs", "ref", "refs").is_empty()
+    assert contents(defs) == TAGS["defs"]
+    store.close()
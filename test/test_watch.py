@@ -0,0 +1,147 @@
+import os
+import pytest
+
+from tagsets.matcherindex import MatcherIndex
+from tagsets.scancache import ScanCache
+from tagsets.tagsearch import TagFileMatcher, TagTextMatcher, TagMatcherVisitor
+from tagsets.tagset import TagSet
+from tagsets.watch import InotifyWatcher, PollingWatcher, TagSetUpdater, WatcherBase, WatcherUnavailable, watch
+
+# Test support code
+
+def make_tree(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.txt").write_text("tag[A]\n")
+    (tmp_path / "src" / "ignored.doc").write_text("tag[IGNORED]\n")
+    matcher = TagFileMatcher(str(tmp_path / "src"), TagTextMatcher("tags", "tag\\[(\\w+)\\]"))
+    matcher.add_file_pattern("*.txt")
+    return matcher
+
+def make_updater(matcher):
+    ts = TagSet("tags", "tag", "tags")
+    grepper = TagMatcherVisitor({"tags": ts})
+    updater = TagSetUpdater([matcher], grepper, [ts])
+    updater.update([matcher.path])
+    return updater, ts
+
+def tagstrs(ts):
+    return sorted(t.tagstr for t in ts.tags)
+
+class OneShotWatcher:
+    # Reports a single batch of changes, then interrupts the watch loop
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.closed = False
+
+    def wait(self, timeout = None):
+        if self.changes:
+            return self.changes.pop(0)
+        if timeout is None:
+            raise KeyboardInterrupt
+        return set()
+
+    def close(self):
+        self.closed = True
+
+# Tests
+
+def test_updater_regreps_changed_file(tmp_path):
+    matcher = make_tree(tmp_path)
+    updater, ts = make_updater(matcher)
+    assert tagstrs(ts) == ["A"]
+
+    (tmp_path / "src" / "a.txt").write_text("tag[B]\ntag[C]\n")
+    updater.update([str(tmp_path / "src" / "a.txt")])
+
+    assert tagstrs(ts) == ["B", "C"]
+
+def test_updater_regreps_changed_file_with_scan_cache(tmp_path):
+    matcher = make_tree(tmp_path)
+    ts = TagSet("tags", "tag", "tags")
+    grepper = TagMatcherVisitor({"tags": ts}, cache = ScanCache(str(tmp_path / "cache")))
+    updater = TagSetUpdater([matcher], grepper, [ts])
+    updater.update([matcher.path])
+    assert tagstrs(ts) == ["A"]
+
+    (tmp_path / "src" / "a.txt").write_text("tag[B]\ntag[C]\n")
+    updater.update([str(tmp_path / "src" / "a.txt")])
+
+    assert tagstrs(ts) == ["B", "C"]
+
+def test_updater_handles_new_directories_and_deletions(tmp_path):
+    matcher = make_tree(tmp_path)
+    updater, ts = make_updater(matcher)
+
+    (tmp_path / "src" / "sub").mkdir()
+    (tmp_path / "src" / "sub" / "b.txt").write_text("tag[B]\n")
+    (tmp_path / "src" / "a.txt").unlink()
+    updater.update([str(tmp_path / "src" / "sub"),
+                    str(tmp_path / "src" / "sub" / "b.txt"),
+                    str(tmp_path / "src" / "a.txt"),
+                    str(tmp_path / "src" / "ignored.doc")])
+
+    assert tagstrs(ts) == ["B"]
+
+def test_parallel_updater_greps_new_directory_contents_once(tmp_path):
+    matcher = make_tree(tmp_path)
+    ts = TagSet("tags", "tag", "tags")
+    updater = TagSetUpdater([matcher], TagMatcherVisitor({"tags": ts}, jobs = 2), [ts])
+    updater.update([matcher.path])
+
+    (tmp_path / "src" / "sub").mkdir()
+    (tmp_path / "src" / "sub" / "n.txt").write_text("tag[NEW]\n")
+    updater.update({str(tmp_path / "src" / "sub"), str(tmp_path / "src" / "sub" / "n.txt")})
+
+    assert tagstrs(ts) == ["A", "NEW"]
+
+def test_watch_debounces_changes_into_one_update(tmp_path):
+    matcher = make_tree(tmp_path)
+    updater, ts = make_updater(matcher)
+    path = str(tmp_path / "src" / "a.txt")
+    watcher = OneShotWatcher([ {path}, {path} ])
+    runs = []
+
+    (tmp_path / "src" / "a.txt").write_text("tag[D]\n")
+    watch(updater, lambda: runs.append(tagstrs(ts)), watcher)
+
+    assert runs == [ ["D"] ]
+    assert watcher.closed
+
+def test_polling_watcher_reports_changed_files(tmp_path):
+    matcher = make_tree(tmp_path)
+    watcher = PollingWatcher(MatcherIndex([matcher]), [matcher.path], interval = 0.01)
+
+    assert watcher.wait(0) == set()
+    (tmp_path / "src" / "b.txt").write_text("tag[B]\n")
+    (tmp_path / "src" / "other.doc").write_text("tag[B]\n")
+    (tmp_path / "src" / "a.txt").unlink()
+
+    assert watcher.wait(0) == { str(tmp_path / "src" / "b.txt"), str(tmp_path / "src" / "a.txt") }
+
+def test_inotify_watcher_reports_changes(tmp_path):
+    matcher = make_tree(tmp_path)
+    try:
+        watcher = InotifyWatcher(MatcherIndex([matcher]), [matcher.path])
+    except WatcherUnavailable:
+        pytest.skip("inotify not available")
+
+    try:
+        assert watcher.wait(0) == set()
+        (tmp_path / "src" / "sub").mkdir()
+        watcher.wait(1)
+        (tmp_path / "src" / "sub" / "b.txt").write_text("tag[B]\n")
+
+        changed = set()
+        while str(tmp_path / "src" / "sub" / "b.txt") not in changed:
+            more = watcher.wait(1)
+            assert more
+            changed |= more
+    finally:
+        watcher.close()
+
+def test_watchers_must_implement_wait():
+    class NoWait(WatcherBase):
+        pass
+
+    with pytest.raises(TypeError):
+        NoWait(None, [])